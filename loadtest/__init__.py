@@ -0,0 +1 @@
+"""Load testing tools for viringo, not part of the deployed application"""
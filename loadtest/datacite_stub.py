@@ -0,0 +1,300 @@
+"""Local stand-in for the DataCite REST API used for load testing viringo
+
+Serves a deterministic synthetic catalogue of any size with configurable latency.
+Point viringo at it with DATACITE_API_URL=http://localhost:8095 and run:
+
+    python -m loadtest.datacite_stub --records 1000000 --latency-ms 40
+
+Only the endpoints and parameters used by viringo.services.datacite are implemented:
+/dois with cursor paging, detail xml and client/provider/updated filtering,
+/dois/<doi> and /clients?include=provider.
+"""
+
+import argparse
+import base64
+import random
+import re
+import time
+from datetime import datetime, timedelta
+from urllib.parse import urlencode
+
+from flask import Flask, jsonify, request, abort
+
+# The synthetic record number is encoded in the DOI suffix
+DOI_PREFIX = '10.5072'
+DOI_PATTERN = re.compile(r'^' + re.escape(DOI_PREFIX) + r'/stub-(\d+)$', re.IGNORECASE)
+UPDATED_QUERY_PATTERN = re.compile(r'updated:\[(\S+)\s+TO\s+(\S+)\]')
+
+RESOURCE_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<resource xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xmlns="http://datacite.org/schema/kernel-4" xsi:schemaLocation="http://datacite.org/schema/kernel-4 http://schema.datacite.org/meta/kernel-4/metadata.xsd">
+  <identifier identifierType="DOI">{doi}</identifier>
+  <creators>
+    <creator><creatorName>Creator {number}, Synthetic</creatorName></creator>
+    <creator><creatorName>Tremblay, Marie</creatorName></creator>
+  </creators>
+  <titles><title>Synthetic record {number}</title></titles>
+  <publisher>{provider}</publisher>
+  <publicationYear>{year}</publicationYear>
+  <resourceType resourceTypeGeneral="Dataset">Dataset</resourceType>
+  <subjects><subject>load testing</subject><subject>subject {subject}</subject></subjects>
+  <dates><date dateType="Issued">{year}-01-01</date></dates>
+  <descriptions><description descriptionType="Abstract">{description}</description></descriptions>
+</resource>
+"""
+
+
+class SyntheticCatalog:
+    """A deterministic catalogue of DOIs spread over providers and clients
+
+    Record n belongs to client n % clients and has an updated date that grows with n,
+    so filters can be answered arithmetically without materialising the catalogue.
+    """
+
+    def __init__(self, records, providers=5, clients_per_provider=4,
+                 start=datetime(2011, 1, 1), step=timedelta(minutes=5)):
+        self.records = records
+        self.providers = providers
+        self.clients_per_provider = clients_per_provider
+        self.clients = providers * clients_per_provider
+        self.start = start
+        self.step = step
+
+    def provider_id(self, provider_number):
+        """Symbol for a provider number"""
+        return 'stub%d' % provider_number
+
+    def client_id(self, client_number):
+        """Symbol for a client number"""
+        provider_number = client_number // self.clients_per_provider
+        return '%s.repo%d' % (self.provider_id(provider_number), client_number)
+
+    def updated(self, number):
+        """Updated datetime of a record"""
+        return self.start + self.step * number
+
+    def residues(self, provider_id=None, client_id=None):
+        """Client numbers matching a provider or client filter"""
+        all_clients = range(self.clients)
+        if client_id:
+            return [k for k in all_clients if self.client_id(k) == client_id.lower()]
+        if provider_id:
+            return [k for k in all_clients
+                    if self.provider_id(k // self.clients_per_provider) == provider_id.lower()]
+        return list(all_clients)
+
+    def number_range(self, from_datetime=None, until_datetime=None):
+        """Record numbers [low, high) falling inside an updated date window"""
+        low, high = 0, self.records
+        if from_datetime:
+            low = max(low, -(-(from_datetime - self.start) // self.step))
+        if until_datetime:
+            high = min(high, (until_datetime - self.start) // self.step + 1)
+        return low, max(low, high)
+
+    def count(self, residues, low, high):
+        """Number of records in [low, high) belonging to the residue clients"""
+        total = 0
+        for residue in residues:
+            first = low + (residue - low) % self.clients
+            if first < high:
+                total += (high - 1 - first) // self.clients + 1
+        return total
+
+    def page(self, residues, low, high, after, size):
+        """Record numbers following 'after' in the filtered range, up to size"""
+        residues = set(residues)
+        numbers = []
+        number = max(low, after + 1)
+        while number < high and len(numbers) < size:
+            if number % self.clients in residues:
+                numbers.append(number)
+            number += 1
+        return numbers
+
+    def doi(self, number):
+        """DOI of a record"""
+        return '%s/stub-%d' % (DOI_PREFIX, number)
+
+    def number_from_doi(self, doi):
+        """Record number from a DOI, or None when not part of the catalogue"""
+        match = DOI_PATTERN.match(doi)
+        if not match or int(match.group(1)) >= self.records:
+            return None
+        return int(match.group(1))
+
+    def doi_json(self, number, detail=True):
+        """JSON-API representation of a record as returned by /dois"""
+        client_number = number % self.clients
+        provider = self.provider_id(client_number // self.clients_per_provider)
+        doi = self.doi(number)
+        updated = self.updated(number)
+        year = updated.year
+        # Make descriptions vary in size like real metadata does
+        description = ('Synthetic description of record %d. ' % number) * (1 + number % 7)
+
+        attributes = {
+            'doi': doi,
+            'identifiers': [{'identifier': 'https://doi.org/' + doi, 'identifierType': 'DOI'}],
+            'creators': [{'name': 'Creator %d, Synthetic' % number}, {'name': 'Tremblay, Marie'}],
+            'titles': [{'title': 'Synthetic record %d' % number}],
+            'publisher': provider,
+            'publicationYear': year,
+            'subjects': [{'subject': 'load testing'}, {'subject': 'subject %d' % (number % 97)}],
+            'contributors': [],
+            'dates': [{'date': '%d-01-01' % year, 'dateType': 'Issued'}],
+            'language': 'en',
+            'types': {'resourceTypeGeneral': 'Dataset', 'resourceType': 'Dataset'},
+            'relatedIdentifiers': [],
+            'sizes': [],
+            'formats': None,
+            'rightsList': [{'rights': 'CC-BY 4.0', 'rightsUri': 'https://creativecommons.org/licenses/by/4.0/'}],
+            'descriptions': [{'description': description, 'descriptionType': 'Abstract'}],
+            'geoLocations': [],
+            'fundingReferences': None,
+            'xml': None,
+            'metadataVersion': 1,
+            'isActive': True,
+            'state': 'findable',
+            'created': updated.isoformat() + 'Z',
+            'updated': updated.isoformat() + 'Z',
+        }
+        if detail:
+            attributes['xml'] = base64.b64encode(RESOURCE_XML.format(
+                doi=doi, number=number, provider=provider, year=year,
+                subject=number % 97, description=description
+            ).encode('utf-8')).decode('ascii')
+
+        return {
+            'id': doi,
+            'type': 'dois',
+            'attributes': attributes,
+            'relationships': {
+                'client': {'data': {'id': self.client_id(client_number), 'type': 'clients'}},
+                'provider': {'data': {'id': provider, 'type': 'providers'}}
+            }
+        }
+
+
+def parse_updated_query(query):
+    """Extract the updated date window viringo sends in the query param"""
+    if not query:
+        return None, None
+    match = UPDATED_QUERY_PATTERN.search(query)
+    if not match:
+        return None, None
+    return tuple(
+        None if value == '*' else datetime.fromisoformat(value.rstrip('Z'))
+        for value in match.groups()
+    )
+
+
+def create_stub_app(catalog, latency_ms=0, jitter_ms=0):
+    """Create the Flask application serving the synthetic catalogue"""
+    app = Flask(__name__)
+
+    @app.before_request
+    def simulate_latency():
+        if latency_ms or jitter_ms:
+            delay = latency_ms + random.uniform(-jitter_ms, jitter_ms)
+            time.sleep(max(0, delay) / 1000.0)
+
+    @app.route('/dois')
+    def list_dois():
+        size = int(request.args.get('page[size]', 25))
+        # Cursor 1 is what viringo sends to start cursor navigation
+        cursor = request.args.get('page[cursor]', '1')
+        after = -1 if cursor in ('', '1') else int(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        detail = request.args.get('detail', 'false').lower() == 'true'
+
+        residues = catalog.residues(
+            provider_id=request.args.get('provider_id'),
+            client_id=request.args.get('client_id')
+        )
+        low, high = catalog.number_range(*parse_updated_query(request.args.get('query')))
+        numbers = catalog.page(residues, low, high, after, size)
+
+        links = {'self': request.url}
+        if len(numbers) == size:
+            next_cursor = base64.urlsafe_b64encode(str(numbers[-1]).encode('ascii')).decode('ascii')
+            params = dict(request.args.items())
+            params['page[cursor]'] = next_cursor
+            links['next'] = request.base_url + '?' + urlencode(params)
+
+        return jsonify({
+            'data': [catalog.doi_json(number, detail) for number in numbers],
+            'meta': {'total': catalog.count(residues, low, high)},
+            'links': links
+        })
+
+    @app.route('/dois/<path:doi>')
+    def get_doi(doi):
+        number = catalog.number_from_doi(doi)
+        if number is None:
+            abort(404)
+        return jsonify({'data': catalog.doi_json(number)})
+
+    @app.route('/clients')
+    def list_clients():
+        size = int(request.args.get('page[size]', 25))
+        page_number = int(request.args.get('page[number]', 1))
+        first = (page_number - 1) * size
+        client_numbers = range(first, min(first + size, catalog.clients))
+
+        data = []
+        provider_numbers = set()
+        for client_number in client_numbers:
+            provider_number = client_number // catalog.clients_per_provider
+            provider_numbers.add(provider_number)
+            data.append({
+                'id': catalog.client_id(client_number),
+                'type': 'clients',
+                'attributes': {'name': 'Stub repository %d' % client_number},
+                'relationships': {'provider': {'data': {
+                    'id': catalog.provider_id(provider_number), 'type': 'providers'
+                }}}
+            })
+
+        included = []
+        if request.args.get('include') == 'provider':
+            included = [{
+                'id': catalog.provider_id(provider_number),
+                'type': 'providers',
+                'attributes': {'name': 'Stub provider %d' % provider_number}
+            } for provider_number in sorted(provider_numbers)]
+
+        links = {'self': request.url}
+        if first + size < catalog.clients:
+            # Like the API, keep the request's other parameters in the link
+            params = dict(request.args.items())
+            params.update({'page[number]': page_number + 1, 'page[size]': size})
+            links['next'] = request.base_url + '?' + urlencode(params)
+
+        return jsonify({
+            'data': data,
+            'included': included,
+            'meta': {'total': catalog.clients},
+            'links': links
+        })
+
+    return app
+
+
+def main():
+    """Run the stand-in server from the command line"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8095)
+    parser.add_argument('--records', type=int, default=100000, help='Number of synthetic DOIs')
+    parser.add_argument('--providers', type=int, default=5)
+    parser.add_argument('--clients-per-provider', type=int, default=4)
+    parser.add_argument('--latency-ms', type=float, default=0, help='Added latency per API call')
+    parser.add_argument('--jitter-ms', type=float, default=0, help='Random +/- variation of the latency')
+    args = parser.parse_args()
+
+    catalog = SyntheticCatalog(args.records, args.providers, args.clients_per_provider)
+    app = create_stub_app(catalog, args.latency_ms, args.jitter_ms)
+    app.run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
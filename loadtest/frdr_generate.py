@@ -0,0 +1,334 @@
+"""Synthetic FRDR database generator for scale testing viringo
+
+Creates the FRDR schema (loadtest/frdr_schema.sql) in a local Postgres and fills
+it with deterministic synthetic records, bulk loaded with COPY:
+
+    python -m loadtest.frdr_generate --db frdr_scale --user postgres --records 1000000
+
+Running it again with a larger --records appends to the existing catalogue, so the
+same database can be grown through several catalogue sizes.
+
+The distributions aim to look like the real harvested catalogue: record counts
+are skewed across many repositories, titles and descriptions are a mix of
+English only, French only and bilingual, creators, subjects, tags and
+geolocations are multi-valued, and a small share of rows are deleted, have no
+item_url or no title so the validity filters have something to remove.
+"""
+
+import argparse
+import hashlib
+import io
+import os
+import random
+import time
+import uuid
+
+import psycopg2
+
+SCHEMA_PATH = os.path.join(os.path.dirname(__file__), 'frdr_schema.sql')
+
+# Sizes of the shared vocabularies the join tables point into
+VOCABULARY_SIZES = {
+    'creators': 200000,
+    'affiliations': 2000,
+    'subjects': 300,
+    'tags': 5000,
+}
+RIGHTS = [
+    'CC-BY 4.0 https://creativecommons.org/licenses/by/4.0/',
+    'CC0 1.0 https://creativecommons.org/publicdomain/zero/1.0/',
+    'CC-BY-NC 4.0 https://creativecommons.org/licenses/by-nc/4.0/',
+    'Open Government Licence - Canada https://open.canada.ca/en/open-government-licence-canada',
+    'All rights reserved',
+]
+ACCESS = ['Public', 'Restricted', 'Embargoed']
+PLACES = [
+    ('Canada', 'Nova Scotia', 'Halifax'),
+    ('Canada', 'Québec', 'Montréal'),
+    ('Canada', 'Ontario', 'Toronto'),
+    ('Canada', 'British Columbia', 'Vancouver'),
+    ('Canada', 'Nunavut', 'Iqaluit'),
+]
+# 2011-01-01 to 2021-01-01 as unix timestamps
+TIMESTAMP_RANGE = (1293840000, 1609459200)
+
+
+def connect(args):
+    """Connect to the target database"""
+    return psycopg2.connect(
+        dbname=args.db, user=args.user, password=args.password, host=args.server, port=args.port
+    )
+
+
+def record_uuid(number):
+    """Deterministic but unordered uuid of a record number"""
+    return str(uuid.UUID(bytes=hashlib.md5(b'frdr-record-%d' % number).digest()))
+
+
+def copy_value(value):
+    """Format a value for COPY text format"""
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+
+
+class CopyBuffer:
+    """Buffers rows for one table and bulk loads them with COPY"""
+
+    def __init__(self, table, columns):
+        self.table = table
+        self.columns = columns
+        self.buffer = io.StringIO()
+        self.rows = 0
+
+    def add(self, *values):
+        self.buffer.write('\t'.join(copy_value(value) for value in values))
+        self.buffer.write('\n')
+        self.rows += 1
+
+    def flush(self, cursor):
+        if not self.rows:
+            return
+        self.buffer.seek(0)
+        cursor.copy_expert(
+            'COPY %s (%s) FROM STDIN' % (self.table, ', '.join(self.columns)), self.buffer
+        )
+        self.buffer = io.StringIO()
+        self.rows = 0
+
+
+def create_schema(con):
+    """Create the schema if needed"""
+    with open(SCHEMA_PATH) as schema_file:
+        with con.cursor() as cursor:
+            cursor.execute(schema_file.read())
+    con.commit()
+
+
+def repository_weights(repositories, rng):
+    """Zipf like weights so a few repositories hold most of the records"""
+    weights = [1.0 / (rank + 1) ** 0.9 for rank in range(repositories)]
+    rng.shuffle(weights)
+    return weights
+
+
+def populate_vocabularies(con, repositories, rng):
+    """Fill repositories and the shared vocabularies when the database is empty"""
+    with con.cursor() as cursor:
+        cursor.execute("SELECT count(*) FROM repositories")
+        if cursor.fetchone()[0]:
+            return
+
+        buffers = [
+            CopyBuffer('repositories', [
+                'repository_id', 'repository_url', 'repository_name', 'repository_thumbnail',
+                'item_url_pattern', 'last_crawl_timestamp', 'homepage_url', 'repo_oai_name']),
+            CopyBuffer('creators', ['creator_id', 'creator']),
+            CopyBuffer('affiliations', ['affiliation_id', 'affiliation']),
+            CopyBuffer('subjects', ['subject_id', 'subject', 'language']),
+            CopyBuffer('tags', ['tag_id', 'tag', 'language']),
+            CopyBuffer('publishers', ['publisher_id', 'publisher']),
+            CopyBuffer('rights', ['rights_id', 'rights']),
+            CopyBuffer('access', ['access_id', 'access']),
+        ]
+        repos, creators, affiliations, subjects, tags, publishers, rights, access = buffers
+
+        for number in range(1, repositories + 1):
+            name = 'Synthetic Repository %d' % number
+            repos.add(number, 'https://repo%d.example.org/oai' % number, name, None, None,
+                      TIMESTAMP_RANGE[1], 'https://repo%d.example.org' % number, 'repo%d' % number)
+            publishers.add(number, name)
+
+        for number in range(1, VOCABULARY_SIZES['creators'] + 1):
+            creators.add(number, 'Surname%d, Given%d' % (number, rng.randint(1, 5000)))
+        for number in range(1, VOCABULARY_SIZES['affiliations'] + 1):
+            affiliations.add(number, 'Institution %d' % number)
+
+        # Each language has its own half of the subject and tag vocabularies
+        for table, size, label_en, label_fr in [
+                (subjects, VOCABULARY_SIZES['subjects'], 'Subject', 'Sujet'),
+                (tags, VOCABULARY_SIZES['tags'], 'keyword', 'mot-clé')]:
+            for number in range(1, size + 1):
+                if number % 2:
+                    table.add(number, '%s %d' % (label_en, number), 'en')
+                else:
+                    table.add(number, '%s %d' % (label_fr, number), 'fr')
+
+        for number, statement in enumerate(RIGHTS, 1):
+            rights.add(number, statement)
+        for number, value in enumerate(ACCESS, 1):
+            access.add(number, value)
+
+        for buffer in buffers:
+            buffer.flush(cursor)
+            # Keep the serial sequences in step with the explicit ids
+            id_column = buffer.columns[0]
+            cursor.execute("SELECT setval(pg_get_serial_sequence(%s, %s), (SELECT max(" +
+                           id_column + ") FROM " + buffer.table + "))", [buffer.table, id_column])
+    con.commit()
+
+
+def pick_language(rng):
+    """Language mix of a record: English only, French only or bilingual"""
+    roll = rng.random()
+    if roll < 0.6:
+        return ['en']
+    if roll < 0.7:
+        return ['fr']
+    return ['en', 'fr']
+
+
+def vocabulary_id(rng, size, language):
+    """Random id from the half of a vocabulary in the given language"""
+    number = rng.randint(1, size // 2) * 2
+    return number - 1 if language == 'en' else number
+
+
+def record_rng(number, seed):
+    """Random generator for one record, the repository is always its first draw"""
+    return random.Random(seed * 1000003 + number)
+
+
+def record_repository(number, weights, seed):
+    """Repository id a record number is generated into"""
+    return record_rng(number, seed).choices(range(1, len(weights) + 1), weights)[0]
+
+
+def add_record(number, weights, buffers, seed):
+    """Generate one record and all of its child rows into the copy buffers"""
+    rng = record_rng(number, seed)
+    uuid_ = record_uuid(number)
+    repository_id = rng.choices(range(1, len(weights) + 1), weights)[0]
+    languages = pick_language(rng)
+    modified = rng.randint(*TIMESTAMP_RANGE)
+    published = time.gmtime(modified - rng.randint(0, 86400 * 365))
+
+    # Mostly plain dates with some full timestamps as the harvested data has both
+    if rng.random() < 0.8:
+        pub_date = time.strftime('%Y-%m-%d', published)
+    else:
+        pub_date = time.strftime('%Y-%m-%dT%H:%M:%SZ', published)
+
+    title_en = 'Synthetic dataset %d about %s' % (number, rng.choice(['oceans', 'soil', 'ice', 'health'])) \
+        if 'en' in languages else ''
+    title_fr = 'Jeu de données synthétique %d' % number if 'fr' in languages else ''
+    item_url = 'https://doi.org/10.80240/frdr-%d' % number
+    deleted = 0
+
+    # A small share of invalid rows which viringo has to filter out
+    roll = rng.random()
+    if roll < 0.02:
+        deleted = 1
+    elif roll < 0.03:
+        item_url = None
+    elif roll < 0.035:
+        title_en, title_fr = '', ''
+
+    buffers['records'].add(
+        uuid_, repository_id, title_en, title_fr, pub_date,
+        'Series %d' % (number % 50) if rng.random() < 0.1 else '',
+        'https://repo%d.example.org/oai' % repository_id, item_url, deleted, str(number),
+        modified, modified
+    )
+
+    for position in range(min(12, int(rng.expovariate(0.4)) + 1)):
+        buffers['records_x_creators'].add(uuid_, rng.randint(1, VOCABULARY_SIZES['creators']), 0)
+    for position in range(int(rng.expovariate(1.2))):
+        buffers['records_x_creators'].add(uuid_, rng.randint(1, VOCABULARY_SIZES['creators']), 1)
+    for position in range(rng.randint(0, 2)):
+        buffers['records_x_affiliations'].add(uuid_, rng.randint(1, VOCABULARY_SIZES['affiliations']))
+    buffers['records_x_publishers'].add(uuid_, repository_id)
+    buffers['records_x_rights'].add(uuid_, rng.randint(1, len(RIGHTS)))
+    if rng.random() < 0.7:
+        buffers['records_x_access'].add(uuid_, 1 if rng.random() < 0.85 else rng.randint(2, len(ACCESS)))
+
+    for language in languages:
+        for position in range(rng.randint(1, 3)):
+            buffers['records_x_subjects'].add(
+                uuid_, vocabulary_id(rng, VOCABULARY_SIZES['subjects'], language))
+        for position in range(rng.randint(0, 10)):
+            buffers['records_x_tags'].add(uuid_, vocabulary_id(rng, VOCABULARY_SIZES['tags'], language))
+        for position in range(1 if rng.random() < 0.9 else 2):
+            buffers['descriptions'].add(
+                uuid_, ('Synthetic abstract for record %d. ' % number) * rng.randint(1, 20), language)
+
+    if rng.random() < 0.2:
+        west = rng.uniform(-141, -53)
+        south = rng.uniform(42, 83)
+        buffers['geobbox'].add(uuid_, west, west + rng.uniform(0, 10), south + rng.uniform(0, 5), south)
+    if rng.random() < 0.1:
+        buffers['geopoint'].add(uuid_, rng.uniform(42, 83), rng.uniform(-141, -53))
+    if rng.random() < 0.15:
+        country, province, city = rng.choice(PLACES)
+        buffers['geoplace'].add(uuid_, country, province, city, None, None)
+
+
+def generate_records(con, total_records, repositories, seed, batch_size=10000):
+    """Append records until the catalogue holds total_records records"""
+    with con.cursor() as cursor:
+        cursor.execute("SELECT count(*) FROM records")
+        start = cursor.fetchone()[0]
+
+    weights = repository_weights(repositories, random.Random(seed))
+    buffers = {
+        'records': CopyBuffer('records', [
+            'record_uuid', 'repository_id', 'title', 'title_fr', 'pub_date', 'series', 'source_url',
+            'item_url', 'deleted', 'local_identifier', 'modified_timestamp',
+            'upstream_modified_timestamp']),
+        'records_x_creators': CopyBuffer('records_x_creators', ['record_uuid', 'creator_id', 'is_contributor']),
+        'records_x_affiliations': CopyBuffer('records_x_affiliations', ['record_uuid', 'affiliation_id']),
+        'records_x_publishers': CopyBuffer('records_x_publishers', ['record_uuid', 'publisher_id']),
+        'records_x_rights': CopyBuffer('records_x_rights', ['record_uuid', 'rights_id']),
+        'records_x_access': CopyBuffer('records_x_access', ['record_uuid', 'access_id']),
+        'records_x_subjects': CopyBuffer('records_x_subjects', ['record_uuid', 'subject_id']),
+        'records_x_tags': CopyBuffer('records_x_tags', ['record_uuid', 'tag_id']),
+        'descriptions': CopyBuffer('descriptions', ['record_uuid', 'description', 'language']),
+        'geobbox': CopyBuffer('geobbox', ['record_uuid', 'westLon', 'eastLon', 'northLat', 'southLat']),
+        'geopoint': CopyBuffer('geopoint', ['record_uuid', 'lat', 'lon']),
+        'geoplace': CopyBuffer('geoplace', [
+            'record_uuid', 'country', 'province_state', 'city', 'other', 'place_name']),
+    }
+
+    started = time.perf_counter()
+    for number in range(start, total_records):
+        add_record(number, weights, buffers, seed)
+        if (number + 1) % batch_size == 0 or number + 1 == total_records:
+            with con.cursor() as cursor:
+                for buffer in buffers.values():
+                    buffer.flush(cursor)
+            con.commit()
+            print("%d records (%.0f records/sec)" % (
+                number + 1, (number + 1 - start) / (time.perf_counter() - started)))
+
+    with con.cursor() as cursor:
+        cursor.execute("ANALYZE")
+    con.commit()
+
+
+def add_connection_arguments(parser):
+    """Database connection arguments shared by the FRDR load testing tools"""
+    parser.add_argument('--server', default=os.getenv('OAIPMH_POSTGRES_SERVER', 'localhost'))
+    parser.add_argument('--port', default=os.getenv('OAIPMH_POSTGRES_PORT', '5432'))
+    parser.add_argument('--db', default=os.getenv('OAIPMH_POSTGRES_DB', 'frdr_scale'))
+    parser.add_argument('--user', default=os.getenv('OAIPMH_POSTGRES_USER', 'postgres'))
+    parser.add_argument('--password', default=os.getenv('OAIPMH_POSTGRES_PASSWORD', ''))
+
+
+def main():
+    """Generate the synthetic catalogue from the command line"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_connection_arguments(parser)
+    parser.add_argument('--records', type=int, default=100000, help='Total catalogue size')
+    parser.add_argument('--repositories', type=int, default=60)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    con = connect(args)
+    create_schema(con)
+    populate_vocabularies(con, args.repositories, random.Random(args.seed))
+    generate_records(con, args.records, args.repositories, args.seed)
+    con.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""Check cached FRDR results are invalidated by the change notification triggers
+
+Installs the triggers of viringo.services.frdr_notify on a synthetic catalogue
+from loadtest.frdr_generate, caches a record and the first page of its set,
+changes the record in another transaction and reports how long the listener
+took to drop both:
+
+    python -m loadtest.frdr_notify_harness --db frdr_scale --changes 20
+"""
+
+import argparse
+import time
+
+from viringo import cache
+from viringo import config
+from viringo.services import frdr, frdr_indexes, frdr_notify
+from . import frdr_generate
+
+
+def cached_entries(name):
+    """Number of values cached for a function"""
+    return cache.get_cache(name).stats()['entries']
+
+
+def wait_for(predicate, timeout):
+    """Seconds until predicate holds, None when it didn't within timeout"""
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        if predicate():
+            return time.perf_counter() - started
+        time.sleep(0.001)
+    return None
+
+
+def main():
+    """Run the harness from the command line"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    frdr_generate.add_connection_arguments(parser)
+    parser.add_argument('--changes', type=int, default=10, help='Number of changes to time')
+    parser.add_argument('--timeout', type=float, default=5, help='Seconds to wait for each invalidation')
+    args = parser.parse_args()
+
+    # Cache in this process for long enough that only invalidation drops entries
+    config.CACHE_BACKEND = 'local'
+    config.CACHE_FRESH_SECONDS = 3600
+    connection_args = dict(db=args.db, user=args.user, password=args.password,
+                           server=args.server, port=args.port)
+
+    con = frdr_generate.connect(args)
+    con.autocommit = True
+    with con.cursor() as cursor:
+        cursor.execute(frdr_notify.trigger_ddl())
+
+    sample = frdr_indexes.sample_values(con)
+    if sample is None:
+        raise SystemExit('No records to change, generate a catalogue with loadtest.frdr_generate first')
+    identifier = 'oai:%s:%s' % (sample['set'], sample['local_identifier'])
+
+    listener = frdr_notify.Listener(channel=config.FRDR_NOTIFY_CHANNEL, poll_seconds=1, **connection_args)
+    listener.start()
+    if wait_for(lambda: listener.counters['connects'], args.timeout) is None:
+        raise SystemExit('The listener did not connect')
+
+    latencies = []
+    for change in range(args.changes):
+        frdr.get_metadata(identifier, **connection_args)
+        frdr.get_metadata_list(set=sample['set'], **connection_args)
+
+        with con.cursor() as cursor:
+            cursor.execute(
+                "UPDATE records SET title = %s WHERE record_uuid = %s",
+                ['Changed title %d' % change, sample['record_uuid']])
+        latency = wait_for(
+            lambda: not cached_entries('frdr.get_metadata') and not cached_entries('frdr.get_metadata_list'),
+            args.timeout)
+        if latency is None:
+            raise SystemExit('Change %d was not invalidated within %ss' % (change, args.timeout))
+        latencies.append(latency)
+
+    listener.stop()
+    latencies.sort()
+    print('%d changes invalidated, median %.1fms, max %.1fms' % (
+        len(latencies), latencies[len(latencies) // 2] * 1000, latencies[-1] * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""Compare planning time of plain and prepared FRDR queries
+
+Runs the queries of a GetRecord and of a ListRecords page against a synthetic
+catalogue from loadtest.frdr_generate, once with every query planned on each
+execution and once with the prepared statements of viringo.services.frdr_db:
+
+    python -m loadtest.frdr_prepared_bench --db frdr_scale --repeat 200
+"""
+
+import argparse
+import json
+import time
+
+from viringo import config
+from viringo.services import frdr, frdr_db, frdr_indexes
+from . import frdr_generate
+
+
+def planning_time(con, statements):
+    """Total planning time in milliseconds Postgres reports for the statements"""
+    total = 0
+    with con.cursor() as cursor:
+        for statement, params in statements:
+            cursor.execute("EXPLAIN (ANALYZE, FORMAT JSON) " + statement.sql, params)
+            plan = cursor.fetchone()[0]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            total += plan[0].get('Planning Time', 0)
+    return total
+
+
+def request_statements(sample):
+    """The statements, with parameters, a GetRecord and a ListRecords page run"""
+    child_statements = [(frdr.CHILDREN_SQL, [sample['record_uuid']] * frdr.CHILDREN_SQL.parameter_count)]
+    return {
+        'GetRecord': [(frdr.RECORD_SQL, [sample['local_identifier'], sample['set']])] + child_statements,
+        'ListRecords set': [frdr.records_list_query(set=sample['set'])] + child_statements,
+    }
+
+
+def time_requests(con, statements, repeat, prepared):
+    """Mean wall time in milliseconds to execute the statements"""
+    config.POSTGRES_PREPARED_STATEMENTS = prepared
+    started = time.perf_counter()
+    with con.cursor() as cursor:
+        for _ in range(repeat):
+            for statement, params in statements:
+                frdr_db.execute(cursor, statement, params)
+                cursor.fetchall()
+    return (time.perf_counter() - started) * 1000 / repeat
+
+
+def main():
+    """Run the comparison from the command line"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    frdr_generate.add_connection_arguments(parser)
+    parser.add_argument('--repeat', type=int, default=200, help='Timed runs per request')
+    args = parser.parse_args()
+
+    with frdr_db.connection(args.db, args.user, args.password, args.server, args.port) as con:
+        sample = frdr_indexes.sample_values(con)
+        if sample is None:
+            parser.error('No records in %s, generate a catalogue first' % args.db)
+
+        for name, statements in request_statements(sample).items():
+            planning = planning_time(con, statements)
+            # One untimed run of each to warm caches and prepare the statements
+            time_requests(con, statements, 1, True)
+            plain = time_requests(con, statements, args.repeat, False)
+            prepared = time_requests(con, statements, args.repeat, True)
+            print("%-16s %2d queries  planning %7.3fms/request  plain %8.3fms  prepared %8.3fms  saved %6.1f%%" % (
+                name, len(statements), planning, plain, prepared, (plain - prepared) / plain * 100))
+
+    frdr_db.close_pools()
+
+
+if __name__ == '__main__':
+    main()
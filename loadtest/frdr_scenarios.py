@@ -0,0 +1,126 @@
+"""Time the FRDR OAI verbs at several synthetic catalogue sizes
+
+Grows the synthetic catalogue from loadtest.frdr_generate through each size and
+times ListRecords, ListIdentifiers and GetRecord through FRDROAIServer at each:
+
+    python -m loadtest.frdr_scenarios --db frdr_scale --sizes 10000,100000,1000000
+"""
+
+import argparse
+import json
+import random
+import statistics
+import time
+from datetime import datetime
+
+from oaipmh import error
+
+from viringo import config
+from viringo.catalogs import FRDROAIServer
+from . import frdr_generate
+
+
+def timed(func, repeat):
+    """Call func repeat times and return the timings in milliseconds"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def summarise(timings):
+    """Summary statistics of a list of timings"""
+    ordered = sorted(timings)
+    return {
+        'mean_ms': round(statistics.mean(ordered), 2),
+        'p50_ms': round(ordered[len(ordered) // 2], 2),
+        'p95_ms': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 2),
+        'max_ms': round(ordered[-1], 2),
+    }
+
+
+def scenarios(server, size, rng, weights, seed):
+    """The named scenarios to run against a catalogue of the given size"""
+    deep_offset = str(max(0, int(size * 0.9) // config.RESULT_SET_SIZE * config.RESULT_SET_SIZE))
+    window_from, window_until = frdr_generate.TIMESTAMP_RANGE[1] - 86400 * 30, frdr_generate.TIMESTAMP_RANGE[1]
+
+    def get_record():
+        # Random records, a few of which are filtered rows that are not found
+        number = rng.randrange(size)
+        repository = frdr_generate.record_repository(number, weights, seed)
+        try:
+            server.getRecord('oai_dc', 'oai:repo%d:%d' % (repository, number))
+        except error.IdDoesNotExistError:
+            pass
+
+    return {
+        'ListRecords first page': lambda: server.listRecords(metadataPrefix='oai_dc'),
+        'ListRecords deep page': lambda: server.listRecords(
+            metadataPrefix='oai_dc', paging_cursor=deep_offset),
+        'ListRecords set': lambda: server.listRecords(metadataPrefix='oai_dc', set='repo1'),
+        'ListRecords last 30 days': lambda: server.listRecords(
+            metadataPrefix='oai_dc',
+            from_=datetime.utcfromtimestamp(window_from),
+            until=datetime.utcfromtimestamp(window_until)),
+        'ListIdentifiers first page': lambda: server.listIdentifiers(metadataPrefix='oai_dc'),
+        'ListIdentifiers deep page': lambda: server.listIdentifiers(
+            metadataPrefix='oai_dc', paging_cursor=deep_offset),
+        'GetRecord': get_record,
+    }
+
+
+def main():
+    """Run the scenarios from the command line"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    frdr_generate.add_connection_arguments(parser)
+    parser.add_argument('--sizes', default='10000,100000,1000000',
+                        help='Comma separated catalogue sizes, grown in order')
+    parser.add_argument('--repositories', type=int, default=60)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=10, help='Timed runs per scenario')
+    parser.add_argument('--no-generate', action='store_true',
+                        help='Use the database as it is instead of growing it')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+    args = parser.parse_args()
+
+    # The FRDR catalog reads its connection details from the config module
+    config.POSTGRES_SERVER = args.server
+    config.POSTGRES_PORT = args.port
+    config.POSTGRES_DB = args.db
+    config.POSTGRES_USER = args.user
+    config.POSTGRES_PASSWORD = args.password
+
+    con = frdr_generate.connect(args)
+    frdr_generate.create_schema(con)
+    frdr_generate.populate_vocabularies(con, args.repositories, random.Random(args.seed))
+
+    server = FRDROAIServer()
+    rng = random.Random(args.seed)
+    weights = frdr_generate.repository_weights(args.repositories, random.Random(args.seed))
+    results = {}
+    for size in [int(size) for size in args.sizes.split(',')]:
+        if not args.no_generate:
+            frdr_generate.generate_records(con, size, args.repositories, args.seed)
+
+        results[size] = {}
+        for name, scenario in scenarios(server, size, rng, weights, args.seed).items():
+            # One untimed call to warm caches
+            scenario()
+            results[size][name] = summarise(timed(scenario, args.repeat))
+
+    con.close()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    for size, timings in results.items():
+        print("Catalogue size %d" % size)
+        for name, summary in timings.items():
+            print("  %-28s mean %9.2fms  p50 %9.2fms  p95 %9.2fms  max %9.2fms" % (
+                name, summary['mean_ms'], summary['p50_ms'], summary['p95_ms'], summary['max_ms']))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+-- Minimal FRDR harvester schema covering the tables and columns read by
+-- viringo/services/frdr.py. Only primary keys are created here so that the
+-- index advisor can be used to compare plans with and without indexes.
+
+CREATE TABLE IF NOT EXISTS repositories (
+    repository_id serial PRIMARY KEY,
+    repository_url text,
+    repository_name text,
+    repository_thumbnail text,
+    item_url_pattern text,
+    last_crawl_timestamp integer,
+    homepage_url text,
+    repo_oai_name text
+);
+
+CREATE TABLE IF NOT EXISTS records (
+    record_uuid uuid PRIMARY KEY,
+    repository_id integer NOT NULL REFERENCES repositories (repository_id),
+    title text NOT NULL DEFAULT '',
+    title_fr text NOT NULL DEFAULT '',
+    pub_date text NOT NULL DEFAULT '',
+    series text NOT NULL DEFAULT '',
+    source_url text,
+    item_url text,
+    deleted integer NOT NULL DEFAULT 0,
+    local_identifier text,
+    modified_timestamp integer NOT NULL DEFAULT 0,
+    upstream_modified_timestamp integer NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS geobbox (
+    geobbox_id serial PRIMARY KEY,
+    record_uuid uuid NOT NULL,
+    westLon numeric,
+    eastLon numeric,
+    northLat numeric,
+    southLat numeric
+);
+
+CREATE TABLE IF NOT EXISTS geopoint (
+    geopoint_id serial PRIMARY KEY,
+    record_uuid uuid NOT NULL,
+    lat numeric,
+    lon numeric
+);
+
+CREATE TABLE IF NOT EXISTS geoplace (
+    geoplace_id serial PRIMARY KEY,
+    record_uuid uuid NOT NULL,
+    country text,
+    province_state text,
+    city text,
+    other text,
+    place_name text
+);
+
+CREATE TABLE IF NOT EXISTS creators (
+    creator_id serial PRIMARY KEY,
+    creator text NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS records_x_creators (
+    records_x_creators_id serial PRIMARY KEY,
+    record_uuid uuid NOT NULL,
+    creator_id integer NOT NULL,
+    is_contributor integer NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS affiliations (
+    affiliation_id serial PRIMARY KEY,
+    affiliation text NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS records_x_affiliations (
+    records_x_affiliations_id serial PRIMARY KEY,
+    record_uuid uuid NOT NULL,
+    affiliation_id integer NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS subjects (
+    subject_id serial PRIMARY KEY,
+    subject text NOT NULL,
+    language text NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS records_x_subjects (
+    records_x_subjects_id serial PRIMARY KEY,
+    record_uuid uuid NOT NULL,
+    subject_id integer NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS publishers (
+    publisher_id serial PRIMARY KEY,
+    publisher text NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS records_x_publishers (
+    records_x_publishers_id serial PRIMARY KEY,
+    record_uuid uuid NOT NULL,
+    publisher_id integer NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS rights (
+    rights_id serial PRIMARY KEY,
+    rights text NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS records_x_rights (
+    records_x_rights_id serial PRIMARY KEY,
+    record_uuid uuid NOT NULL,
+    rights_id integer NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS descriptions (
+    description_id serial PRIMARY KEY,
+    record_uuid uuid NOT NULL,
+    description text NOT NULL,
+    language text NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS tags (
+    tag_id serial PRIMARY KEY,
+    tag text NOT NULL,
+    language text NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS records_x_tags (
+    records_x_tags_id serial PRIMARY KEY,
+    record_uuid uuid NOT NULL,
+    tag_id integer NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS access (
+    access_id serial PRIMARY KEY,
+    access text NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS records_x_access (
+    records_x_access_id serial PRIMARY KEY,
+    record_uuid uuid NOT NULL,
+    access_id integer NOT NULL
+);
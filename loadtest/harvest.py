@@ -0,0 +1,225 @@
+"""Harvest load generator for a running viringo instance
+
+Runs N concurrent harvesters that each walk ListRecords or ListIdentifiers
+through resumption tokens, then reports throughput, page latency and the
+memory of the viringo worker processes:
+
+    python -m loadtest.harvest --url http://localhost:8091/oai --harvesters 8 \\
+        --verb ListRecords --prefix oai_dc --process-name gunicorn
+"""
+
+import argparse
+import json
+import math
+import os
+import threading
+import time
+
+import requests
+from lxml import etree
+
+NS_OAIPMH = '{http://www.openarchives.org/OAI/2.0/}'
+
+
+def percentile(values, fraction):
+    """Nearest rank percentile of a list of values"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(math.ceil(fraction * len(ordered))) - 1))
+    return ordered[index]
+
+
+def parse_page(content, verb):
+    """Return the number of items and the resumption token in an OAI response page"""
+    root = etree.fromstring(content)
+    error = root.find(NS_OAIPMH + 'error')
+    if error is not None:
+        if error.get('code') == 'noRecordsMatch':
+            return 0, None
+        raise ValueError('%s: %s' % (error.get('code'), error.text))
+
+    element = root.find(NS_OAIPMH + verb)
+    item = 'record' if verb == 'ListRecords' else 'header'
+    count = len(element.findall(NS_OAIPMH + item))
+    token = element.find(NS_OAIPMH + 'resumptionToken')
+    token = token.text if token is not None and token.text else None
+    return count, token
+
+
+class Harvester(threading.Thread):
+    """Walks one complete list through its resumption tokens"""
+
+    def __init__(self, url, params, verb, max_pages=None, timeout=60):
+        super(Harvester, self).__init__(daemon=True)
+        self.url = url
+        self.params = params
+        self.verb = verb
+        self.max_pages = max_pages
+        self.timeout = timeout
+        self.latencies = []
+        self.records = 0
+        self.errors = []
+
+    def run(self):
+        session = requests.Session()
+        params = dict(self.params)
+        while True:
+            start = time.perf_counter()
+            try:
+                response = session.get(self.url, params=params, timeout=self.timeout)
+                response.raise_for_status()
+                count, token = parse_page(response.content, self.verb)
+            except (requests.RequestException, ValueError, etree.XMLSyntaxError) as err:
+                self.errors.append(str(err))
+                return
+            finally:
+                self.latencies.append(time.perf_counter() - start)
+
+            self.records += count
+            if not token or (self.max_pages and len(self.latencies) >= self.max_pages):
+                return
+            params = {'verb': self.verb, 'resumptionToken': token}
+
+
+def find_pids(process_name):
+    """Pids of processes whose command line contains process_name"""
+    pids = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit() or int(entry) == os.getpid():
+            continue
+        try:
+            with open('/proc/%s/cmdline' % entry, 'rb') as cmdline_file:
+                cmdline = cmdline_file.read().replace(b'\0', b' ').decode('utf-8', 'replace')
+        except OSError:
+            continue
+        if process_name in cmdline:
+            pids.append(int(entry))
+    return pids
+
+
+def resident_memory(pid):
+    """Resident set size of a process in KiB, or None if it has gone"""
+    try:
+        with open('/proc/%d/status' % pid) as status_file:
+            for line in status_file:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+    return None
+
+
+class MemorySampler(threading.Thread):
+    """Samples the resident memory of the worker processes while harvesting"""
+
+    def __init__(self, pids, interval=0.5):
+        super(MemorySampler, self).__init__(daemon=True)
+        self.pids = pids
+        self.interval = interval
+        self.peak = {}
+        self.last = {}
+        self.stopped = threading.Event()
+
+    def sample(self):
+        for pid in self.pids:
+            rss = resident_memory(pid)
+            if rss is not None:
+                self.last[pid] = rss
+                self.peak[pid] = max(rss, self.peak.get(pid, 0))
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.sample()
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.sample()
+
+
+def run_harvest(url, verb, prefix, sets, harvesters, max_pages=None, pids=None):
+    """Run the concurrent harvest and return a report dictionary"""
+    workers = []
+    for number in range(harvesters):
+        params = {'verb': verb, 'metadataPrefix': prefix}
+        if sets:
+            # Spread harvesters over the requested sets
+            params['set'] = sets[number % len(sets)]
+        workers.append(Harvester(url, params, verb, max_pages))
+
+    sampler = MemorySampler(pids or [])
+    sampler.start()
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+    sampler.stop()
+
+    latencies = [latency for worker in workers for latency in worker.latencies]
+    records = sum(worker.records for worker in workers)
+
+    return {
+        'verb': verb,
+        'metadataPrefix': prefix,
+        'harvesters': harvesters,
+        'elapsed_seconds': round(elapsed, 3),
+        'pages': len(latencies),
+        'records': records,
+        'records_per_second': round(records / elapsed, 1) if elapsed else 0.0,
+        'latency_p50_ms': round(percentile(latencies, 0.50) * 1000, 1),
+        'latency_p99_ms': round(percentile(latencies, 0.99) * 1000, 1),
+        'latency_max_ms': round(max(latencies) * 1000, 1) if latencies else 0.0,
+        'errors': [error for worker in workers for error in worker.errors],
+        'worker_rss_kib': {
+            str(pid): {'peak': sampler.peak[pid], 'last': sampler.last.get(pid)}
+            for pid in sorted(sampler.peak)
+        },
+    }
+
+
+def print_report(report):
+    """Print a harvest report in a human readable form"""
+    print("%(verb)s %(metadataPrefix)s with %(harvesters)d harvesters" % report)
+    print("  records: %(records)d in %(pages)d pages over %(elapsed_seconds).1fs" % report)
+    print("  throughput: %(records_per_second).1f records/sec" % report)
+    print("  page latency: p50 %(latency_p50_ms).1fms p99 %(latency_p99_ms).1fms "
+          "max %(latency_max_ms).1fms" % report)
+    for pid, rss in report['worker_rss_kib'].items():
+        print("  worker %s rss: peak %.1f MiB, last %.1f MiB" % (
+            pid, rss['peak'] / 1024.0, (rss['last'] or 0) / 1024.0))
+    if report['errors']:
+        print("  errors: %d (first: %s)" % (len(report['errors']), report['errors'][0]))
+
+
+def main():
+    """Run the harvest load generator from the command line"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default='http://localhost:8091/oai', help='OAI-PMH base URL')
+    parser.add_argument('--verb', default='ListRecords', choices=['ListRecords', 'ListIdentifiers'])
+    parser.add_argument('--prefix', default='oai_dc', help='metadataPrefix to harvest')
+    parser.add_argument('--set', action='append', dest='sets', help='Set to harvest, repeatable')
+    parser.add_argument('--harvesters', type=int, default=4, help='Number of concurrent harvesters')
+    parser.add_argument('--max-pages', type=int, help='Stop each harvester after this many pages')
+    parser.add_argument('--pid', type=int, action='append', dest='pids', help='Worker pid to sample')
+    parser.add_argument('--process-name', help='Sample all processes with this in their command line')
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+    args = parser.parse_args()
+
+    pids = list(args.pids or [])
+    if args.process_name:
+        pids.extend(find_pids(args.process_name))
+
+    report = run_harvest(args.url, args.verb, args.prefix, args.sets, args.harvesters,
+                         args.max_pages, pids)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+"""Local stand-in for a Redis server to try the redis cache backend against
+
+Speaks enough RESP for viringo.cache_stores.RedisStore, keeping keys in memory.
+It is used for the cache and the rate limits, see viringo.ratelimit:
+
+    python -m loadtest.resp_stub --port 6399
+    OAIPMH_CACHE_BACKEND=redis OAIPMH_CACHE_REDIS_URL=redis://127.0.0.1:6399/0 gunicorn -w 4 wsgi:application
+
+Implements PING, AUTH, SELECT, GET, SET, DEL, SADD, SPOP, SCAN, FLUSHDB and
+WATCH, MULTI and EXEC transactions. Expiry options of SET are accepted and
+ignored.
+"""
+
+import argparse
+import re
+import socketserver
+import threading
+
+
+class RespHandler(socketserver.StreamRequestHandler):
+    """Answers the commands of one client connection"""
+
+    def read_command(self):
+        """Read a command sent as an array of bulk strings, None once the client has gone"""
+        line = self.rfile.readline()
+        if not line:
+            return None
+        count = int(line[1:-2])
+        args = []
+        for _ in range(count):
+            length = int(self.rfile.readline()[1:-2])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def write_reply(self, reply):
+        """Write a reply: bytes as a bulk string, str as a simple string, int, list or None"""
+        self.wfile.write(encode_reply(reply))
+
+    def handle(self):
+        # Versions of the keys watched, and the commands queued after MULTI
+        watched = {}
+        queued = None
+        while True:
+            args = self.read_command()
+            if args is None:
+                return
+            command = args[0].upper()
+            if command == b'WATCH':
+                watched.update(self.server.versions_of(args[1:]))
+                self.write_reply('OK')
+            elif command == b'UNWATCH':
+                watched = {}
+                self.write_reply('OK')
+            elif command == b'MULTI':
+                queued = []
+                self.write_reply('OK')
+            elif command == b'EXEC':
+                self.write_reply(self.server.run_transaction(queued or [], watched))
+                watched, queued = {}, None
+            elif queued is not None:
+                queued.append(args)
+                self.write_reply('QUEUED')
+            else:
+                self.write_reply(self.server.run(args))
+
+
+def encode_reply(reply):
+    """RESP encoding of a reply"""
+    if reply is None:
+        return b'$-1\r\n'
+    if isinstance(reply, Exception):
+        return b'-ERR %s\r\n' % str(reply).encode('utf-8')
+    if isinstance(reply, str):
+        return b'+%s\r\n' % reply.encode('utf-8')
+    if isinstance(reply, int):
+        return b':%d\r\n' % reply
+    if isinstance(reply, list):
+        return b'*%d\r\n' % len(reply) + b''.join(encode_reply(item) for item in reply)
+    return b'$%d\r\n%s\r\n' % (len(reply), reply)
+
+
+class RespServer(socketserver.ThreadingTCPServer):
+    """An in memory key value server"""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address):
+        socketserver.ThreadingTCPServer.__init__(self, address, RespHandler)
+        self.data = {}
+        # Bumped whenever a key changes, FLUSHDB changes every key
+        self.versions = {}
+        self.flushes = 0
+        self.lock = threading.RLock()
+
+    def versions_of(self, keys):
+        """The current versions of keys, for WATCH"""
+        with self.lock:
+            return {key: (self.flushes, self.versions.get(key, 0)) for key in keys}
+
+    def _changed(self, key):
+        self.versions[key] = self.versions.get(key, 0) + 1
+
+    def run_transaction(self, commands, watched):
+        """Run queued commands unless a watched key changed, None when it did"""
+        with self.lock:
+            if self.versions_of(watched) != watched:
+                return None
+            return [self.run(args) for args in commands]
+
+    def run(self, args):
+        """Run a command and return its reply"""
+        command = args[0].upper()
+        with self.lock:
+            if command in (b'PING', b'AUTH', b'SELECT', b'FLUSHDB'):
+                if command == b'FLUSHDB':
+                    self.data.clear()
+                    self.flushes += 1
+                return 'PONG' if command == b'PING' else 'OK'
+            if command == b'GET':
+                return self.data.get(args[1])
+            if command == b'SET':
+                self.data[args[1]] = args[2]
+                self._changed(args[1])
+                return 'OK'
+            if command == b'DEL':
+                for key in args[1:]:
+                    self._changed(key)
+                return sum(1 for key in args[1:] if self.data.pop(key, None) is not None)
+            if command == b'SADD':
+                members = self.data.setdefault(args[1], set())
+                added = len(set(args[2:]) - members)
+                members.update(args[2:])
+                self._changed(args[1])
+                return added
+            if command == b'SPOP':
+                members = self.data.get(args[1], set())
+                popped = [members.pop() for _ in range(min(len(members), int(args[2])))]
+                if not members:
+                    self.data.pop(args[1], None)
+                self._changed(args[1])
+                return popped
+            if command == b'SCAN':
+                pattern = b'*'
+                if b'MATCH' in args:
+                    pattern = args[args.index(b'MATCH') + 1]
+                matcher = glob_pattern(pattern)
+                keys = [key for key in self.data if matcher.match(key)]
+                return [b'0', keys]
+        return ValueError('unknown command %s' % command.decode('utf-8', 'replace'))
+
+
+def glob_pattern(pattern):
+    """Compile a redis glob pattern, where a backslash escapes the next character"""
+    regex = b''
+    escaped = False
+    for char in [pattern[i:i + 1] for i in range(len(pattern))]:
+        if escaped:
+            regex += re.escape(char)
+            escaped = False
+        elif char == b'\\':
+            escaped = True
+        elif char == b'*':
+            regex += b'.*'
+        elif char == b'?':
+            regex += b'.'
+        else:
+            regex += re.escape(char)
+    return re.compile(regex + b'\\Z', re.DOTALL)
+
+
+def main():
+    """Run the stand-in server from the command line"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6399)
+    args = parser.parse_args()
+
+    server = RespServer((args.host, args.port))
+    print("Serving RESP on %s:%s" % (args.host, args.port))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
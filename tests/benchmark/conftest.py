@@ -0,0 +1,43 @@
+"""Shared inputs for the benchmark suite, scaled to realistic page sizes"""
+
+import copy
+import json
+import pytest
+
+from ..integration import factories
+
+# Page sizes benchmarked, the first is the default RESULT_SET_SIZE
+PAGE_SIZES = [50, 200]
+
+
+def scale_datacite_page(page_size):
+    """Return DataCite API json entries from the fixtures repeated up to a page size"""
+    with open('tests/integration/fixtures/datacite_api_dois.json') as json_file:
+        fixture = json.load(json_file)
+
+    entries = []
+    while len(entries) < page_size:
+        for entry in fixture['data']:
+            entry = copy.deepcopy(entry)
+            entry['id'] = entry['id'] + '-' + str(len(entries))
+            entries.append(entry)
+    return entries[:page_size]
+
+
+def datacite_metadata_page(page_size):
+    """Return a page of DataCite metadata results built from the factories"""
+    return [
+        factories.MetadataFactory(identifier='10.5072/not-a-real-doi-%d' % i)
+        for i in range(page_size)
+    ]
+
+
+def frdr_record_page(page_size):
+    """Return a page of assembled FRDR records built from the factories"""
+    return [factories.FRDRRecordFactory() for _ in range(page_size)]
+
+
+@pytest.fixture(params=PAGE_SIZES, ids=lambda size: 'page%d' % size)
+def page_size(request):
+    """Parametrize a benchmark over the page sizes"""
+    return request.param
@@ -0,0 +1,33 @@
+"""Microbenchmarks for datestamp parsing"""
+
+import dateutil.parser
+import dateutil.tz
+import pytest
+
+from viringo import datestamps
+
+pytest.importorskip('pytest_benchmark')
+
+# A page worth of the datestamp shapes the backends return
+DATESTAMPS = ['2019-03-%02dT10:30:37.000Z' % day for day in range(1, 29)] + \
+    ['2018-%02d-01' % month for month in range(1, 13)] + \
+    ['2017-06-%02d' % day for day in range(1, 11)]
+
+
+def dateutil_to_utc(value):
+    """The conversion the services made before datestamps existed"""
+    return dateutil.parser.parse(value).astimezone(dateutil.tz.UTC).replace(tzinfo=None)
+
+
+def uncached_to_utc(value):
+    """datestamps.to_utc without the memoization"""
+    return datestamps.parse.__wrapped__(value).astimezone(dateutil.tz.UTC).replace(tzinfo=None)
+
+
+@pytest.mark.parametrize('to_utc', [dateutil_to_utc, uncached_to_utc, datestamps.to_utc],
+                         ids=['dateutil', 'fromisoformat', 'memoized'])
+def test_datestamp_to_utc(benchmark, to_utc):
+    """Benchmark converting a page of datestamps to naive UTC datetimes"""
+    results = benchmark(lambda: [to_utc(value) for value in DATESTAMPS])
+
+    assert results == [dateutil_to_utc(value) for value in DATESTAMPS]
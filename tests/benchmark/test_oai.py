@@ -0,0 +1,83 @@
+"""Benchmarks for full OAI-PMH verb requests with stubbed backends"""
+
+import pytest
+
+from viringo import config
+from viringo import render
+from .conftest import datacite_metadata_page, frdr_record_page, scale_datacite_page
+from viringo.services import datacite
+from viringo.services import frdr
+
+pytest.importorskip('pytest_benchmark')
+
+
+@pytest.mark.parametrize('url', [
+    '/oai?verb=ListRecords&metadataPrefix=oai_dc&set=DATACITE.DATACITE',
+    '/oai?verb=ListRecords&metadataPrefix=oai_datacite&set=DATACITE.DATACITE',
+    '/oai?verb=ListRecords&metadataPrefix=datacite&set=DATACITE.DATACITE',
+    '/oai?verb=ListIdentifiers&metadataPrefix=oai_dc&set=DATACITE.DATACITE',
+], ids=['ListRecords-oai_dc', 'ListRecords-oai_datacite', 'ListRecords-datacite', 'ListIdentifiers'])
+def test_datacite_list_verbs(benchmark, client, mocker, url):
+    """Benchmark a full page of a listing verb against a stubbed DataCite backend"""
+    results = datacite_metadata_page(config.RESULT_SET_SIZE)
+    mocked_get_metadata_list = mocker.patch('viringo.services.datacite.get_metadata_list')
+    mocked_get_metadata_list.return_value = results, 1000, 'next-cursor'
+
+    response = benchmark(client.get, url)
+
+    assert response.status_code == 200
+
+
+def test_datacite_get_record(benchmark, client, mocker):
+    """Benchmark a GetRecord request against a stubbed DataCite backend"""
+    mocked_get_metadata = mocker.patch('viringo.services.datacite.get_metadata')
+    mocked_get_metadata.return_value = datacite_metadata_page(1)[0]
+
+    response = benchmark(
+        client.get,
+        '/oai?verb=GetRecord&metadataPrefix=oai_datacite&identifier=doi:10.5072/not-a-real-doi-0'
+    )
+
+    assert response.status_code == 200
+
+
+def test_frdr_list_records(benchmark, client, mocker):
+    """Benchmark a full ListRecords page against a stubbed FRDR backend"""
+    mocker.patch('viringo.config.CATALOG_SET', 'FRDR')
+    mocked_get_metadata_list = mocker.patch('viringo.services.frdr.get_metadata_list')
+
+    # The stub builds the metadata too as that is part of the FRDR service cost
+    def get_metadata_list(**kwargs):
+        results = [frdr.build_metadata(record) for record in frdr_record_page(config.RESULT_SET_SIZE)]
+        return results, 1000, config.RESULT_SET_SIZE
+
+    mocked_get_metadata_list.side_effect = get_metadata_list
+
+    response = benchmark(
+        client.get, '/oai?verb=ListRecords&metadataPrefix=oai_datacite&set=example'
+    )
+
+    assert response.status_code == 200
+
+
+@pytest.mark.parametrize('workers', [0, 2, 4], ids=lambda workers: 'workers%d' % workers)
+def test_datacite_list_records_render_pool(benchmark, client, mocker, page_size, workers):
+    """Benchmark building and rendering a ListRecords page on the render pool"""
+    entries = scale_datacite_page(page_size)
+    mocker.patch('viringo.config.RENDER_POOL_WORKERS', workers)
+    mocker.patch('viringo.config.RENDER_POOL_MIN_RECORDS', 1)
+    mocked_get_metadata_list = mocker.patch('viringo.services.datacite.get_metadata_list')
+
+    def get_metadata_list(build=True, **kwargs):
+        if build:
+            return [datacite.build_metadata(entry) for entry in entries], 1000, 'next-cursor'
+        return entries, 1000, 'next-cursor'
+
+    mocked_get_metadata_list.side_effect = get_metadata_list
+
+    # Start the workers outside of the timed rounds
+    client.get('/oai?verb=ListRecords&metadataPrefix=oai_dc')
+    response = benchmark(client.get, '/oai?verb=ListRecords&metadataPrefix=oai_dc')
+    render.shutdown_pool()
+
+    assert response.status_code == 200
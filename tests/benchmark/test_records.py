@@ -0,0 +1,80 @@
+"""Benchmarks for building records and writing metadata formats"""
+
+import pytest
+from oaipmh import common
+from lxml import etree
+
+from viringo import catalogs
+from viringo import metadata
+from viringo.services import datacite
+from viringo.services import frdr
+from .conftest import scale_datacite_page, datacite_metadata_page, frdr_record_page
+
+pytest.importorskip('pytest_benchmark')
+
+
+def test_datacite_build_metadata(benchmark, page_size):
+    """Benchmark parsing a page of DataCite API json into metadata objects"""
+    entries = scale_datacite_page(page_size)
+
+    results = benchmark(lambda: [datacite.build_metadata(entry) for entry in entries])
+
+    assert len(results) == page_size
+
+
+def test_frdr_build_metadata(benchmark, page_size):
+    """Benchmark building a page of FRDR records into metadata objects"""
+
+    # build_metadata modifies the record so each round needs fresh records
+    def setup():
+        return (frdr_record_page(page_size),), {}
+
+    def build(records):
+        return [frdr.build_metadata(record) for record in records]
+
+    results = benchmark.pedantic(build, setup=setup, rounds=20)
+
+    assert len(results) == page_size
+
+
+def test_frdr_construct_datacite_xml(benchmark, page_size):
+    """Benchmark rendering a page of FRDR records to DataCite xml"""
+    records = frdr_record_page(page_size)
+
+    results = benchmark(lambda: [frdr.construct_datacite_xml(record) for record in records])
+
+    assert len(results) == page_size
+
+
+def test_datacite_build_metadata_map(benchmark, page_size):
+    """Benchmark building metadata maps for a page of DataCite results"""
+    server = catalogs.DataCiteOAIServer()
+    results = datacite_metadata_page(page_size)
+
+    maps = benchmark(lambda: [server.build_metadata_map(result) for result in results])
+
+    assert len(maps) == page_size
+
+
+@pytest.mark.parametrize('writer', [
+    metadata.oai_dc_writer,
+    metadata.oai_datacite_writer,
+    metadata.datacite_writer
+], ids=lambda writer: writer.__name__)
+def test_metadata_writers(benchmark, page_size, writer):
+    """Benchmark writing a page of records with each metadata format writer"""
+    server = catalogs.DataCiteOAIServer()
+    records = [
+        common.Metadata(None, server.build_metadata_map(result))
+        for result in datacite_metadata_page(page_size)
+    ]
+
+    def write():
+        element = etree.Element('ListRecords')
+        for record in records:
+            writer(etree.SubElement(element, 'metadata'), record)
+        return element
+
+    element = benchmark(write)
+
+    assert len(element) == page_size
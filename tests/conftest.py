@@ -1,6 +1,11 @@
 """Test fixture configuration"""
 import pytest
 from viringo import create_app
+from viringo import admission
+from viringo import cache
+from viringo import circuit
+from viringo import pagesize
+from viringo import ratelimit
 
 @pytest.fixture
 def app():
@@ -15,3 +20,13 @@ def app():
 def client(app):
     """Create a test client fixture"""
     return app.test_client()
+
+@pytest.fixture(autouse=True)
+def reset_backend_state():
+    """Start every test with closed circuits, empty caches and no rate limits used or load observed"""
+    yield
+    circuit.reset()
+    cache.reset()
+    ratelimit.reset()
+    admission.reset()
+    pagesize.reset()
@@ -99,3 +99,67 @@ class MetadataFactory(factory.Factory):
     client = 'DATACITE.DATACITE'
     provider = 'DATACITE'
     active = True
+
+
+class FRDRRecordFactory(factory.DictFactory):
+    """Constructs test data for an assembled FRDR database record"""
+    class Meta:
+        rename = {
+            'dc_contributor_author': 'dc:contributor.author',
+            'dc_contributor': 'dc:contributor',
+            'datacite_creator_affiliation': 'datacite:creatorAffiliation',
+            'frdr_category_en': 'frdr:category_en',
+            'frdr_category_fr': 'frdr:category_fr',
+            'frdr_keywords_en': 'frdr:keywords_en',
+            'frdr_keywords_fr': 'frdr:keywords_fr',
+            'dc_publisher': 'dc:publisher',
+            'dc_rights': 'dc:rights',
+            'dc_description_en': 'dc:description_en',
+            'dc_description_fr': 'dc:description_fr',
+            'frdr_access': 'frdr:access',
+        }
+
+    record_uuid = factory.Sequence(lambda n: '00000000-0000-0000-0000-%012d' % n)
+    title_en = 'Fake FRDR dataset'
+    title_fr = 'Faux jeu de données FRDR'
+    pub_date = '2019-06-05'
+    series = ''
+    source_url = 'https://example.org/oai'
+    item_url = factory.Sequence(lambda n: 'https://doi.org/10.5072/frdr-%d' % n)
+    deleted = 0
+    local_identifier = factory.Sequence(lambda n: '%d' % n)
+    modified_timestamp = 1559750400
+    repository_url = 'https://example.org'
+    repository_name = 'Example Repository'
+    repository_thumbnail = ''
+    item_url_pattern = ''
+    last_crawl_timestamp = 1559750400
+    homepage_url = 'https://example.org'
+    repo_oai_name = 'example'
+    datacite_geoLocation = factory.Dict({
+        'geoLocationBox': factory.List([factory.Dict({
+            'westBoundLongitude': -141.0,
+            'eastBoundLongitude': -52.6,
+            'northBoundLatitude': 83.1,
+            'southBoundLatitude': 41.7
+        })]),
+        'geoLocationPlace': factory.List([factory.Dict({
+            'country': 'Canada',
+            'province_state': 'Nova Scotia',
+            'city': 'Halifax',
+            'additional': None,
+            'place_name': None
+        })])
+    })
+    dc_contributor_author = factory.List(['Fenner, Martin', 'Hallett, Richard'])
+    datacite_creator_affiliation = factory.List(['DataCite'])
+    dc_contributor = factory.List(['Tremblay, Marie'])
+    frdr_category_en = factory.List(['Oceanography'])
+    frdr_category_fr = factory.List(['Océanographie'])
+    frdr_keywords_en = factory.List(['ocean', 'temperature'])
+    frdr_keywords_fr = factory.List(['océan', 'température'])
+    dc_publisher = factory.List(['Example Repository'])
+    dc_rights = factory.List(['CC-BY 4.0 https://creativecommons.org/licenses/by/4.0/'])
+    dc_description_en = factory.List(['A fake dataset used for testing.'])
+    dc_description_fr = factory.List(['Un faux jeu de données pour les tests.'])
+    frdr_access = factory.List(['Public'])
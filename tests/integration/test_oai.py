@@ -1,8 +1,22 @@
 """Tests for http endpoints of OAI-PMH verbs"""
 
 import datetime
+import gzip
+import json
+import time
 from lxml import etree
-
+import requests
+
+from viringo import admission
+from viringo import circuit
+from viringo import deadline
+from viringo import export
+from viringo import incremental
+from viringo import oai
+from viringo import render
+from viringo import snapshots
+from viringo.services import datacite
+from viringo.services import datacite_mirror
 from . import factories
 
 def construct_oai_xml_comparisons(fixture_file_path, target_xml, oai_element):
@@ -264,3 +278,392 @@ def test_responds_to_get_post(client):
 
     assert response.status_code == 200
     assert response.content_type == 'application/xml; charset=utf-8'
+
+def test_profiled_request(client, mocker, tmpdir):
+    """Test an admin can profile a request and get the report back"""
+    mocker.patch('viringo.config.PROFILE_SECRET', 'sekret')
+    mocker.patch('viringo.config.PROFILE_DIR', str(tmpdir))
+    handle_oai_request = mocker.spy(oai, 'handle_oai_request')
+
+    response = client.get('/oai', headers={'X-Viringo-Profile': 'sekret'})
+
+    assert response.status_code == 200
+    # Profiled requests keep to the request deadline too
+    assert isinstance(handle_oai_request.call_args[0][1], deadline.Deadline)
+    assert response.content_type == 'application/xml; charset=utf-8'
+    profile_id = response.headers['X-Viringo-Profile-Id']
+    assert tmpdir.join(profile_id + '.prof').check()
+
+    response = client.get('/oai', headers={
+        'X-Viringo-Profile': 'sekret',
+        'X-Viringo-Profile-Return': '1'
+    })
+
+    assert response.status_code == 200
+    assert response.content_type.startswith('text/plain')
+    assert b'Top functions by cumulative time' in response.get_data()
+
+def test_list_records_render_pool(client, mocker):
+    """Test records rendered on the render pool match those rendered in process"""
+    with open('tests/integration/fixtures/datacite_api_dois.json') as json_file:
+        entries = json.load(json_file)['data']
+
+    # The service returns unparsed entries when the catalog builds them on the pool
+    def get_metadata_list(build=True, **kwargs):
+        if build:
+            return [datacite.build_metadata(entry) for entry in entries], len(entries), None
+        return entries, len(entries), None
+
+    mocker.patch('viringo.services.datacite.get_metadata_list', side_effect=get_metadata_list)
+    mocker.patch('viringo.config.RENDER_POOL_MIN_RECORDS', 1)
+
+    responses = {}
+    for workers in [0, 2]:
+        mocker.patch('viringo.config.RENDER_POOL_WORKERS', workers)
+        for url in [
+                '/oai?verb=ListRecords&metadataPrefix=oai_dc',
+                '/oai?verb=ListRecords&metadataPrefix=oai_datacite',
+                '/oai?verb=ListIdentifiers&metadataPrefix=oai_dc'
+            ]:
+            response = client.get(url)
+            assert response.status_code == 200
+            assert b'viringo-fragment' not in response.get_data()
+            # Compare everything after the responseDate, element by element as
+            # spliced records aren't indented and repeat namespace declarations
+            responses[(workers, url)] = [
+                (element.tag, sorted(element.attrib.items()), (element.text or '').strip())
+                for child in etree.fromstring(response.get_data())[1:] for element in child.iter()
+            ]
+    render.shutdown_pool()
+
+    for (workers, url), target in responses.items():
+        assert target
+        assert target == responses[(0, url)]
+
+def test_list_records_incremental(client, mocker):
+    """Test incremental harvests are closed at a high-water mark and answered from the watermark"""
+    mocker.patch('viringo.config.INCREMENTAL_WATERMARK_TTL', 60)
+    incremental.WATERMARKS.clear()
+    mocked_get_latest_change = mocker.patch('viringo.services.datacite.get_latest_change')
+    mocked_get_latest_change.return_value = datetime.datetime(2019, 5, 1)
+    mocked_get_metadata_list = mocker.patch('viringo.services.datacite.get_metadata_list')
+    mocked_get_metadata_list.return_value = [factories.MetadataFactory()], 1, None
+
+    response = client.get('/oai?verb=ListRecords&metadataPrefix=oai_dc&set=DATACITE&from=2019-05-02')
+
+    assert response.status_code == 200
+    assert b'noRecordsMatch' in response.get_data()
+    assert not mocked_get_metadata_list.called
+
+    response = client.get('/oai?verb=ListRecords&metadataPrefix=oai_dc&set=DATACITE&from=2019-04-30')
+
+    assert response.status_code == 200
+    assert b'noRecordsMatch' not in response.get_data()
+    assert mocked_get_latest_change.call_count == 1
+    until = mocked_get_metadata_list.call_args[1]['until_datetime']
+    assert until >= datetime.datetime.utcnow().replace(microsecond=0)
+
+def test_backend_unavailable(client, mocker):
+    """Test an unreachable DataCite API is answered with a 503 and calls then fail fast"""
+    mocker.patch('viringo.config.CIRCUIT_FAILURE_THRESHOLD', 1)
+    mocker.patch('viringo.config.CIRCUIT_RESET_SECONDS', 30)
+    mocked_requests_get = mocker.patch('viringo.services.datacite.requests.get')
+    mocked_requests_get.side_effect = requests.ConnectionError('unreachable')
+
+    url = '/oai?verb=GetRecord&metadataPrefix=oai_dc&identifier=doi:10.5072/not-a-real-doi'
+    response = client.get(url)
+
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '30'
+
+    response = client.get(url)
+
+    assert response.status_code == 503
+    assert mocked_requests_get.call_count == 1
+
+def test_stale_record_served_while_backend_unavailable(client, mocker):
+    """Test a cached record is still served once the DataCite API fails"""
+    # Cache records only until the next request, which then has to fetch again
+    mocker.patch('viringo.config.CACHE_FRESH_SECONDS', 0)
+    mocker.patch('viringo.config.CACHE_STALE_SECONDS', 0.000001)
+    mocked_requests_get = mocker.patch('viringo.services.datacite.requests.get')
+    with open('tests/integration/fixtures/datacite_api_doi.json') as json_file:
+        mocked_requests_get.return_value.json.return_value = json.load(json_file)
+    mocked_requests_get.return_value.status_code = 200
+
+    url = '/oai?verb=GetRecord&metadataPrefix=oai_dc&identifier=doi:10.5072/not-a-real-doi'
+    assert client.get(url).status_code == 200
+
+    mocked_requests_get.return_value.status_code = 500
+    response = client.get(url)
+
+    assert response.status_code == 200
+    assert b'<record>' in response.get_data()
+
+def test_backend_timeout_follows_request_deadline(client, mocker):
+    """Test DataCite calls wait no longer than the request has left and time out as a 503"""
+    mocker.patch('viringo.config.REQUEST_DEADLINE_SECONDS', 0.2)
+    mocker.patch('viringo.config.DATACITE_API_TIMEOUT', 30)
+    mocker.patch('viringo.config.CIRCUIT_FAILURE_THRESHOLD', 1)
+
+    def timing_out(url, timeout=None, **kwargs):
+        time.sleep(timeout)
+        raise requests.Timeout('timed out')
+    mocked_requests_get = mocker.patch('viringo.services.datacite.requests.get', side_effect=timing_out)
+
+    response = client.get('/oai?verb=GetRecord&metadataPrefix=oai_dc&identifier=doi:10.5072/not-a-real-doi')
+
+    assert response.status_code == 503
+    assert mocked_requests_get.call_args[1]['timeout'] <= 0.2
+    # Running out of time is not held against the API
+    assert circuit.stats()['datacite']['state'] == circuit.CLOSED
+
+def test_list_identifiers_from_mirror(client, mocker, tmp_path):
+    """Test a synced mirror answers list and record requests without calling the API"""
+    mocker.patch('viringo.config.DATACITE_MIRROR_PATH', str(tmp_path / 'mirror.sqlite'))
+    with open('tests/integration/fixtures/datacite_api_dois.json') as json_file:
+        mocker.patch('viringo.services.datacite_mirror.fetch_page', return_value=(json.load(json_file), 0))
+    datacite_mirror.sync(str(tmp_path / 'mirror.sqlite'))
+    mocked_requests_get = mocker.patch('viringo.services.datacite.requests.get')
+
+    response = client.get('/oai?verb=ListIdentifiers&metadataPrefix=oai_dc&set=DATACITE.DATACITE')
+
+    assert response.status_code == 200
+    assert response.get_data().count(b'<header>') == 25
+    assert b'completeListSize="25"' in response.get_data()
+
+    response = client.get('/oai?verb=GetRecord&metadataPrefix=oai_dc&identifier=doi:10.5438/0001')
+
+    assert response.status_code == 200
+    assert not mocked_requests_get.called
+
+def test_list_records_from_snapshot(client, mocker, tmp_path):
+    """Test full harvests are answered from an exported snapshot and resumed through its pages"""
+    with open('tests/integration/fixtures/datacite_api_dois.json') as json_file:
+        entries = json.load(json_file)['data']
+    records = [datacite.build_metadata(entry) for entry in entries]
+
+    # Two pages, the second one reached with cursor 2
+    def get_metadata_list(cursor=None, **kwargs):
+        if cursor == 2:
+            return records[1:], len(records), None
+        return records[:1], len(records), 2
+
+    mocker.patch('viringo.services.datacite.get_metadata_list', side_effect=get_metadata_list)
+    mocker.patch('viringo.config.SNAPSHOT_DIR', str(tmp_path))
+    live = client.get('/oai?verb=ListRecords&metadataPrefix=oai_dc')
+
+    manifest = snapshots.export(metadata_prefixes=['oai_dc'], workers=0)
+    assert manifest['partitions'] == [
+        {'metadataPrefix': 'oai_dc', 'set': None, 'pages': 2, 'records': len(records)}]
+
+    # The live path isn't called any more
+    mocker.patch('viringo.services.datacite.get_metadata_list', side_effect=AssertionError)
+    first = client.get('/oai?verb=ListRecords&metadataPrefix=oai_dc')
+    assert first.status_code == 200
+    assert first.content_type == 'application/xml; charset=utf-8'
+    assert 'Content-Encoding' not in first.headers
+
+    def list_records(response):
+        return etree.fromstring(response.get_data()).find('{http://www.openarchives.org/OAI/2.0/}ListRecords')
+
+    live_records = [etree.tostring(record) for record in list_records(live)[:-1]]
+    assert [etree.tostring(record) for record in list_records(first)[:-1]] == live_records
+
+    token = list_records(first)[-1]
+    assert token.get('completeListSize') == str(len(records))
+    second = client.get('/oai?verb=ListRecords&resumptionToken=' + token.text,
+                        headers={'Accept-Encoding': 'gzip'})
+    assert second.headers['Content-Encoding'] == 'gzip'
+    last_page = etree.fromstring(gzip.decompress(second.get_data()))
+    last_token = last_page.find('.//{http://www.openarchives.org/OAI/2.0/}resumptionToken')
+    assert len(last_token.getparent()) == len(records)
+    assert not last_token.text
+
+    # Incremental harvests still go to the backend
+    mocker.patch('viringo.services.datacite.get_metadata_list', return_value=([], 0, None))
+    response = client.get('/oai?verb=ListRecords&metadataPrefix=oai_dc&from=2020-01-01')
+    assert b'noRecordsMatch' in response.get_data()
+
+def test_export_jsonl(client, mocker):
+    """Test the JSON Lines export sends every record once across continuation tokens"""
+    with open('tests/integration/fixtures/datacite_api_dois.json') as json_file:
+        entries = json.load(json_file)['data']
+    records = [datacite.build_metadata(entry) for entry in entries]
+    assert len(records) > 2
+
+    # Pages of two records, the cursor being the index of a page's first record
+    def get_metadata_list(cursor=None, **kwargs):
+        start = cursor or 0
+        next_cursor = start + 2 if start + 2 < len(records) else None
+        return records[start:start + 2], len(records), next_cursor
+
+    mocker.patch('viringo.services.datacite.get_metadata_list', side_effect=get_metadata_list)
+    mocker.patch('viringo.config.EXPORT_ENABLED', True)
+
+    identifiers = []
+    url = '/oai/export.jsonl?limit=3'
+    while True:
+        response = client.get(url, headers={'Accept-Encoding': 'gzip'})
+        assert response.status_code == 200
+        assert response.headers['Content-Encoding'] == 'gzip'
+        lines = [json.loads(line) for line in gzip.decompress(response.get_data()).splitlines()]
+        assert len(lines) <= 4
+        identifiers.extend(line['identifier'] for line in lines[:-1])
+        token = lines[-1]['continuation']
+        if token is None:
+            break
+        url = '/oai/export.jsonl?limit=3&token=' + token
+
+    assert identifiers == ['doi:' + record.identifier for record in records]
+
+    response = client.get('/oai/export.jsonl?limit=1')
+    line = json.loads(response.get_data().splitlines()[0])
+    assert line['metadata']['title'] == records[0].titles
+    assert line['metadata']['xml'] == records[0].xml.decode('utf-8')
+
+    assert client.get('/oai/export.jsonl?token=not-a-token').status_code == 400
+    assert client.get('/oai/export.jsonl?from=yesterday').status_code == 400
+
+    mocker.patch('viringo.config.EXPORT_ENABLED', False)
+    assert client.get('/oai/export.jsonl').status_code == 404
+
+def test_export_jsonl_rejects_bad_positions(client, mocker):
+    """Test a continuation token edited to hold a position the catalog never hands out is a 400"""
+    mocker.patch('viringo.config.EXPORT_ENABLED', True)
+    iter_metadata_list = mocker.patch('viringo.services.frdr.iter_metadata_list')
+
+    mocker.patch('viringo.config.CATALOG_SET', 'FRDR')
+    assert client.get('/oai/export.jsonl?token=' + export.encode_token({}, "1' OR 1=1")).status_code == 400
+    assert client.get('/oai/export.jsonl?token=' + export.encode_token({}, 7)).status_code == 400
+    assert not iter_metadata_list.called
+
+    mocker.patch('viringo.config.CATALOG_SET', 'DataCite')
+    for position in ['abc', [1, -1], [{}, 0], None]:
+        assert client.get('/oai/export.jsonl?token=' + export.encode_token({}, position)).status_code == 400
+
+def test_batch_get_record(client, mocker):
+    """Test many identifiers are resolved in one response, in the order asked"""
+    with open('tests/integration/fixtures/datacite_api_dois.json') as json_file:
+        entries = json.load(json_file)['data']
+    records = {entry['id']: datacite.build_metadata(entry) for entry in entries}
+    dois = list(records)[:3]
+
+    mocked_get_metadata = mocker.patch(
+        'viringo.services.datacite.get_metadata', side_effect=lambda doi: records.get(doi))
+    mocker.patch('viringo.config.EXPORT_ENABLED', True)
+
+    identifiers = ['doi:' + dois[2], 'doi:10.5072/unknown', 'doi:' + dois[0]]
+    response = client.get('/oai/records.jsonl?' + '&'.join('identifier=' + i for i in identifiers))
+    assert response.status_code == 200
+    lines = [json.loads(line) for line in response.get_data().splitlines()]
+
+    assert [line['identifier'] for line in lines] == identifiers
+    assert lines[0]['metadata']['title'] == records[dois[2]].titles
+    assert lines[1]['error'] == 'idDoesNotExist'
+    assert mocked_get_metadata.call_count == 3
+
+    response = client.post('/oai/records.jsonl', data='\n'.join(identifiers), content_type='text/plain')
+    assert [json.loads(line)['identifier'] for line in response.get_data().splitlines()] == identifiers
+
+    assert client.get('/oai/records.jsonl').status_code == 400
+
+def test_rate_limited_harvester(client, mocker):
+    """Test a harvester over its ListRecords rate gets a 503 with Retry-After and can still GetRecord"""
+    mocker.patch('viringo.config.RATE_LIMIT_ENABLED', True)
+    mocker.patch('viringo.config.RATE_LIMIT_EXPENSIVE_RATE', 0.1)
+    mocker.patch('viringo.config.RATE_LIMIT_EXPENSIVE_BURST', 1)
+    mocker.patch('viringo.config.RATE_LIMIT_TOKENS', 'b')
+    mocker.patch('viringo.services.datacite.get_metadata_list', return_value=([], 0, None))
+
+    assert client.get('/oai?verb=ListRecords&metadataPrefix=oai_dc').status_code == 200
+    response = client.get('/oai?verb=ListRecords&metadataPrefix=oai_dc')
+    assert response.status_code == 503
+    assert 1 <= int(response.headers['Retry-After']) <= 10
+
+    assert client.get('/oai?verb=Identify').status_code == 200
+    response = client.get('/oai?verb=ListRecords&metadataPrefix=oai_dc', headers={'X-Harvester-Token': 'b'})
+    assert response.status_code == 200
+
+def test_shed_under_backend_latency(client, mocker):
+    """Test new list harvests get a 503 with Retry-After while the backend is slow, and cheap verbs don't"""
+    mocker.patch('viringo.config.ADMISSION_ENABLED', True)
+    mocker.patch('viringo.config.ADMISSION_MAX_BACKEND_LATENCY_SECONDS', 1)
+    mocker.patch('viringo.services.datacite.get_metadata_list', return_value=([], 0, None))
+    for _ in range(10):
+        admission.observe_backend('datacite', 1.6)
+
+    response = client.get('/oai?verb=ListRecords&metadataPrefix=oai_dc')
+    assert response.status_code == 503
+    assert int(response.headers['Retry-After']) >= 1
+    assert client.get('/oai?verb=Identify').status_code == 200
+
+def test_page_size_by_verb(client, mocker):
+    """Test list harvests ask the backend for pages of the size configured for their verb and prefix"""
+    mocker.patch('viringo.config.RESULT_SET_SIZE', 50)
+    mocker.patch('viringo.config.PAGE_SIZES', 'ListIdentifiers=300,ListRecords:datacite=20')
+    mocked_get_metadata_list = mocker.patch(
+        'viringo.services.datacite.get_metadata_list', return_value=([factories.MetadataFactory()], 1, None))
+
+    client.get('/oai?verb=ListIdentifiers&metadataPrefix=oai_dc')
+    assert mocked_get_metadata_list.call_args[1]['page_size'] == 300
+    client.get('/oai?verb=ListRecords&metadataPrefix=datacite')
+    assert mocked_get_metadata_list.call_args[1]['page_size'] == 20
+    client.get('/oai?verb=ListRecords&metadataPrefix=oai_dc')
+    assert mocked_get_metadata_list.call_args[1]['page_size'] == 50
+
+def test_mirror_cursor_from_resumption_token_is_checked(client, mocker):
+    """Test a mirror cursor edited into a resumption token is rejected rather than failing the request"""
+    decode = mocker.patch('oaipmh.server.decodeResumptionToken')
+    decode.return_value = ({'metadataPrefix': 'oai_dc', 'paging_cursor': '["mirror", 1, "x"]'}, 1)
+
+    response = client.get('/oai?verb=ListRecords&resumptionToken=edited')
+
+    assert response.status_code == 200
+    assert b'code="badResumptionToken"' in response.get_data()
+
+def test_page_size_from_resumption_token_is_checked(client, mocker):
+    """Test a page size edited into a resumption token is kept within bounds or rejected"""
+    mocker.patch('viringo.config.PAGE_SIZE_MAX', 500)
+    decode = mocker.patch('oaipmh.server.decodeResumptionToken')
+    mocked_get_metadata_list = mocker.patch(
+        'viringo.services.datacite.get_metadata_list', return_value=([factories.MetadataFactory()], 1, None))
+    mocker.patch('viringo.services.datacite.get_sets', return_value=([['DATACITE', 'DataCite']], 1))
+
+    decode.return_value = ({'metadataPrefix': 'oai_dc', 'paging_cursor': 'next', 'page_size': '1000000'}, 1)
+    client.get('/oai?verb=ListRecords&resumptionToken=edited')
+    assert mocked_get_metadata_list.call_args[1]['page_size'] == 500
+
+    decode.return_value = ({'metadataPrefix': 'oai_dc', 'paging_cursor': 'next', 'page_size': 'many'}, 1)
+    response = client.get('/oai?verb=ListRecords&resumptionToken=edited')
+    assert response.status_code == 200
+    assert b'code="badResumptionToken"' in response.get_data()
+
+    # ListSets tokens have no page size to take
+    decode.return_value = ({'paging_cursor': '50', 'page_size': '10'}, 1)
+    response = client.get('/oai?verb=ListSets&resumptionToken=edited')
+    assert response.status_code == 200
+    assert b'<ListSets' in response.get_data()
+
+def test_page_cost_is_measured_in_bytes(client, mocker):
+    """Test the size of a page taught to viringo.pagesize is the length of the encoded response"""
+    observe = mocker.patch('viringo.pagesize.observe')
+    record = factories.MetadataFactory(titles=['\u00e9t\u00e9 ' * 100])
+    mocker.patch('viringo.services.datacite.get_metadata_list', return_value=([record], 1, None))
+
+    response = client.get('/oai?verb=ListRecords&metadataPrefix=oai_dc')
+
+    assert observe.call_args[0][3] == len(response.get_data())
+
+def test_stats_need_the_admin_secret(client, mocker):
+    """Test the worker counters are only shown to admins sending the configured secret"""
+    assert client.get('/stats').status_code == 404
+
+    mocker.patch('viringo.config.STATS_SECRET', 'letmein')
+    assert client.get('/stats').status_code == 403
+    assert client.get('/stats', headers={'X-Viringo-Stats': 'guess'}).status_code == 403
+    assert client.get('/stats', headers={'X-Viringo-Stats': 'lètmein'}).status_code == 403
+
+    response = client.get('/stats', headers={'X-Viringo-Stats': 'letmein'})
+    assert response.status_code == 200
+    assert 'circuits' in response.get_json()
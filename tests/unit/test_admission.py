@@ -0,0 +1,59 @@
+"""Unit tests for admission control"""
+
+import pytest
+
+from viringo import admission
+
+def test_average_decays_while_nothing_is_observed(mocker):
+    """Test the moving average follows observations and halves every half-life"""
+    average = admission.DecayingAverage()
+    assert average.get(now=100) == 0
+
+    average.observe(10, now=100)
+    assert average.get(now=100) == pytest.approx(10 * admission.SMOOTHING)
+    assert average.get(now=100 + admission.HALF_LIFE_SECONDS) == pytest.approx(5 * admission.SMOOTHING)
+
+def test_queue_wait_units():
+    """Test X-Request-Start is understood in seconds, milliseconds and microseconds"""
+    assert admission.queue_wait({}) is None
+    assert admission.queue_wait({'X-Request-Start': 'garbage'}) is None
+    assert admission.queue_wait({'X-Request-Start': 't=1700000000.5'}, now=1700000001) == pytest.approx(0.5)
+    assert admission.queue_wait({'X-Request-Start': 't=1700000000500'}, now=1700000001) == pytest.approx(0.5)
+    assert admission.queue_wait({'X-Request-Start': '1700000000500000'}, now=1700000001) == pytest.approx(0.5)
+    # Clocks out of step never give a negative wait
+    assert admission.queue_wait({'X-Request-Start': 't=1700000002'}, now=1700000001) == 0
+
+def test_requests_are_shed_in_tiers(mocker):
+    """Test new list harvests are shed first, then resumed ones, then cheap verbs"""
+    mocker.patch('viringo.config.ADMISSION_MAX_BACKEND_LATENCY_SECONDS', 1)
+    mocker.patch('viringo.config.ADMISSION_RETRY_AFTER_SECONDS', 10)
+    pressure = mocker.patch('viringo.admission.pressure', return_value=1.2)
+
+    with pytest.raises(admission.Overloaded) as err:
+        admission.admit('ListRecords', False, {})
+    assert err.value.retry_after == 12
+    with pytest.raises(admission.Overloaded):
+        admission.admit(None, False, {})
+    admission.admit('ListRecords', True, {}).release()
+    admission.admit('GetRecord', False, {}).release()
+
+    pressure.return_value = 100
+    with pytest.raises(admission.Overloaded) as err:
+        admission.admit('Identify', False, {})
+    # Never asked to wait for ever
+    assert err.value.retry_after == 60
+    assert admission.stats()['shed'] == 3
+
+def test_in_flight_and_latency_pressure(mocker):
+    """Test in-flight requests and slow backends raise the pressure"""
+    mocker.patch('viringo.config.ADMISSION_MAX_IN_FLIGHT', 2)
+    mocker.patch('viringo.config.ADMISSION_MAX_BACKEND_LATENCY_SECONDS', 1)
+
+    ticket = admission.admit('GetRecord', False, {})
+    assert admission.pressure() == pytest.approx(0.5)
+    ticket.release()
+    ticket.release()
+    assert admission.stats()['in_flight'] == 0
+
+    admission.observe_backend('datacite', 10)
+    assert admission.pressure() == pytest.approx(10 * admission.SMOOTHING, rel=0.01)
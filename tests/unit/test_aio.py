@@ -0,0 +1,242 @@
+"""Unit tests for the ASGI adapter and asynchronous backend calls"""
+
+import asyncio
+import threading
+from types import ModuleType
+
+import pytest
+from flask import Flask, Response, request
+
+from viringo import aio
+from viringo import circuit
+from viringo import deadline
+from viringo.services import datacite
+from viringo.services import datacite_async
+from viringo.services import frdr
+from viringo.services import frdr_async
+
+def asgi_request(application, path, query_string=b'', method='GET', body=b''):
+    """Send a request through an ASGI application, returning its status, headers and body"""
+    messages = []
+    sent = [{'type': 'http.request', 'body': body, 'more_body': False}]
+
+    async def receive():
+        return sent.pop(0)
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query_string,
+             'headers': [(b'host', b'localhost'), (b'content-type', b'text/plain')],
+             'client': ('127.0.0.1', 1234), 'server': ('localhost', 80)}
+
+    async def run():
+        await application(scope, receive, send)
+    asyncio.run(run())
+    start = messages[0]
+    return start['status'], dict(start['headers']), b''.join(message.get('body', b'') for message in messages[1:])
+
+def test_adapter_answers_with_the_wsgi_app():
+    """Test requests reach the Flask app in a thread and streamed responses arrive whole"""
+    app = Flask(__name__)
+
+    @app.route('/echo', methods=['GET', 'POST'])
+    def echo():
+        return request.args.get('verb', '') + ':' + request.get_data(as_text=True)
+
+    @app.route('/stream')
+    def stream():
+        return Response((b'%d\n' % number for number in range(100)), mimetype='text/plain')
+
+    application = aio.ASGIAdapter(app, threads=2)
+
+    status, headers, body = asgi_request(application, '/echo', b'verb=Identify', 'POST', b'payload')
+    assert status == 200
+    assert headers[b'content-type'].startswith(b'text/html')
+    assert body == b'Identify:payload'
+
+    status, _, body = asgi_request(application, '/stream')
+    assert body.splitlines() == [b'%d' % number for number in range(100)]
+
+    assert asgi_request(application, '/missing')[0] == 404
+
+def test_delegate_runs_on_the_loop_with_the_deadline(mocker):
+    """Test a delegated call runs as its coroutine on the loop, with the caller's deadline current"""
+    mocker.patch('viringo.config.ASYNC_SERVICES', True)
+
+    async def get_metadata_async(identifier):
+        return identifier, deadline.current()
+
+    mocker.patch('viringo.services.frdr_async.get_metadata', get_metadata_async)
+
+    @aio.delegate('viringo.services.frdr_async')
+    def get_metadata(identifier):
+        return 'sync'
+
+    request_deadline = deadline.Deadline(10)
+
+    async def main():
+        aio.start(asyncio.get_running_loop())
+        try:
+            def call():
+                with deadline.activate(request_deadline):
+                    return get_metadata('oai:a:1')
+            return await asyncio.get_running_loop().run_in_executor(None, call)
+        finally:
+            await aio.stop()
+
+    assert get_metadata('oai:a:1') == 'sync'
+    assert asyncio.run(main()) == ('oai:a:1', request_deadline)
+
+class FakePool:
+    """An asyncpg pool whose connections answer every query with the same rows, slowly"""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.queries = 0
+        self.running = 0
+        self.most_running = 0
+
+    def acquire(self):
+        return FakeConnection(self)
+
+class FakeConnection:
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def fetch(self, sql, *params, timeout=None):
+        assert '%s' not in sql
+        self.pool.queries += 1
+        self.pool.running += 1
+        self.pool.most_running = max(self.pool.most_running, self.pool.running)
+        await asyncio.sleep(0.01)
+        self.pool.running -= 1
+        return self.pool.rows
+
+def test_record_children_take_one_round_trip():
+    """Test a record's child lookups are one query, attached as the sync assembly does"""
+    children = ['[]', '[{"lat": 5, "lon": 6}]', '[]'] + ['[{"publisher": "FRDR"}]'] * len(frdr.CHILD_TABLE_SQL)
+    pool = FakePool([children])
+
+    record = asyncio.run(frdr_async.assemble_record({'record_uuid': 'u'}, pool))
+
+    assert pool.queries == 1
+    assert record['datacite_geoLocation'] == {'geoLocationPoint': [{'pointLatitude': 5, 'pointLongitude': 6}]}
+    assert record['dc:publisher'] == ['FRDR']
+
+def test_batch_child_lookups_run_concurrently():
+    """Test the batch lookups of many records are in flight together"""
+    pool = FakePool([])
+
+    records = asyncio.run(frdr_async.assemble_records([{'record_uuid': 'u1'}, {'record_uuid': 'u2'}], pool))
+
+    assert pool.most_running == len(frdr.CHILD_LOOKUP_BATCH_SQL)
+    assert [record['dc:publisher'] for record in records] == [[], []]
+
+class FakeResponse:
+    """An httpx response stand in"""
+
+    def __init__(self, status_code, json=None):
+        self.status_code = status_code
+        self._json = json
+
+    def json(self):
+        return self._json
+
+class FakeAsyncClient:
+    """An httpx.AsyncClient stand in answering from a dict of url to response, noting the threads it ran on"""
+
+    def __init__(self, responses, **kwargs):
+        self.responses = responses
+        self.kwargs = kwargs
+        self.urls = []
+        self.threads = set()
+
+    async def get(self, url, timeout=None):
+        self.urls.append(url)
+        self.threads.add(threading.get_ident())
+        await asyncio.sleep(0)
+        response = self.responses[url]
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    async def aclose(self):
+        pass
+
+@pytest.fixture
+def fake_httpx(mocker):
+    """A stand in httpx module, whose clients answer from fake_httpx.responses"""
+    httpx = ModuleType('httpx')
+    httpx.HTTPError = type('HTTPError', (Exception,), {})
+    httpx.TimeoutException = type('TimeoutException', (httpx.HTTPError,), {})
+    httpx.Limits = lambda **kwargs: kwargs
+    httpx.responses = {}
+    httpx.clients = []
+
+    def client(**kwargs):
+        httpx.clients.append(FakeAsyncClient(httpx.responses, **kwargs))
+        return httpx.clients[-1]
+
+    httpx.AsyncClient = client
+    mocker.patch.dict('sys.modules', {'httpx': httpx})
+    mocker.patch('viringo.services.datacite_async._client', None)
+    circuit.reset()
+    yield httpx
+    circuit.reset()
+
+def test_async_api_call_get(fake_httpx, mocker):
+    """Test the async DataCite call adds the parameters and turns failures into BackendUnavailable"""
+    mocker.patch('viringo.config.DATACITE_API_URL', 'https://api.test')
+    fake_httpx.responses['https://api.test/dois?page[size]=1'] = FakeResponse(200, {'data': []})
+    fake_httpx.responses['https://api.test/down'] = FakeResponse(503)
+    fake_httpx.responses['https://api.test/refused'] = fake_httpx.HTTPError('refused')
+
+    response = asyncio.run(datacite_async.api_call_get('https://api.test/dois', {'page[size]': 1}))
+    assert response.json() == {'data': []}
+
+    for url in ['https://api.test/down', 'https://api.test/refused']:
+        with pytest.raises(circuit.BackendUnavailable):
+            asyncio.run(datacite_async.api_call_get(url))
+    assert circuit.stats()['datacite']['failures'] == 2
+    assert len(fake_httpx.clients) == 1
+
+def test_datacite_batch_is_delegated_to_the_loop(fake_httpx, mocker):
+    """Test a batch GetRecord under the loop looks its DOIs up as coroutines on the loop's thread"""
+    mocker.patch('viringo.config.ASYNC_SERVICES', True)
+    mocker.patch('viringo.config.DATACITE_API_URL', 'https://api.test')
+    mocker.patch('viringo.services.datacite.build_metadata', side_effect=lambda data: data['id'])
+    for doi in ['10.1/a', '10.1/b']:
+        fake_httpx.responses['https://api.test/dois/' + doi] = FakeResponse(200, {'data': {'id': doi}})
+    fake_httpx.responses['https://api.test/dois/10.1/missing'] = FakeResponse(404)
+
+    async def main():
+        aio.start(asyncio.get_running_loop())
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                None, datacite.get_metadata_batch, ['10.1/a', '10.1/missing', '10.1/b']), threading.get_ident()
+        finally:
+            await aio.stop()
+
+    results, loop_thread = asyncio.run(main())
+
+    assert results == {'10.1/a': '10.1/a', '10.1/b': '10.1/b'}
+    assert fake_httpx.clients[0].threads == {loop_thread}
+
+def test_async_get_sets_follows_next_links_with_a_query(fake_httpx, mocker):
+    """Test the parameters are added to a next link's own query rather than starting a second one"""
+    mocker.patch('viringo.config.DATACITE_API_URL', 'https://api.test')
+    next_link = 'https://api.test/clients?page%5Bnumber%5D=2&page%5Bsize%5D=1000'
+    fake_httpx.responses['https://api.test/clients?include=provider&page[size]=1000'] = FakeResponse(200, {
+        'data': [{'id': 'b', 'attributes': {'name': 'B'}}], 'included': [], 'links': {'next': next_link}})
+    fake_httpx.responses[next_link + '&include=provider&page[size]=1000'] = FakeResponse(200, {
+        'data': [{'id': 'a', 'attributes': {'name': 'A'}}], 'included': [], 'links': {}})
+
+    assert asyncio.run(datacite_async.get_sets()) == ([('a', 'A'), ('b', 'B')], 2)
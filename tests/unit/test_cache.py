@@ -0,0 +1,68 @@
+"""Unit tests for the stale-while-revalidate cache"""
+
+import time
+
+import pytest
+
+from viringo import cache
+from viringo import circuit
+
+def test_fresh_values_are_served_from_cache(mocker):
+    """Test a fresh value is served without fetching again"""
+    swr = cache.StaleWhileRevalidateCache('test', 10, 60, 60)
+    fetch = mocker.Mock(return_value='page')
+
+    assert swr.get('key', fetch) == 'page'
+    assert swr.get('key', fetch) == 'page'
+
+    assert fetch.call_count == 1
+    assert swr.stats()['hits'] == 1
+
+def test_stale_values_are_refreshed_in_background(mocker):
+    """Test a stale value is served while a replacement is fetched"""
+    swr = cache.StaleWhileRevalidateCache('test', 10, 0, 60)
+    swr.get('key', lambda: 'old')
+
+    assert swr.get('key', lambda: 'new') == 'old'
+
+    for _ in range(100):
+        if swr.stats()['refreshes']:
+            break
+        time.sleep(0.01)
+    swr.fresh_seconds = 60
+    assert swr.get('key', lambda: 'newer') == 'new'
+
+def test_stale_value_served_while_backend_unavailable(mocker):
+    """Test an expired value is served rather than failing while the backend is down"""
+    swr = cache.StaleWhileRevalidateCache('test', 10, 0, 0)
+    unavailable = mocker.Mock(side_effect=circuit.BackendUnavailable('down'))
+    swr.get('key', lambda: 'old')
+
+    assert swr.get('key', unavailable) == 'old'
+    assert swr.stats()['served_stale_on_error'] == 1
+
+    with pytest.raises(circuit.BackendUnavailable):
+        swr.get('other', unavailable)
+
+def test_entries_are_bounded():
+    """Test the least recently used values are dropped"""
+    swr = cache.StaleWhileRevalidateCache('test', 2, 60, 0)
+    for key in ['a', 'b', 'c']:
+        swr.get(key, lambda: key)
+
+    assert swr.stats()['entries'] == 2
+
+def test_configured_backend_is_shared_by_caches(mocker, tmp_path):
+    """Test every cache uses the one shared store when a shared backend is configured"""
+    mocker.patch('viringo.config.CACHE_BACKEND', 'shared')
+    mocker.patch('viringo.config.CACHE_SHARED_PATH', str(tmp_path / 'cache'))
+    mocker.patch('viringo.config.CACHE_FRESH_SECONDS', 60)
+
+    records = cache.get_cache('datacite.get_metadata')
+    pages = cache.get_cache('datacite.get_metadata_list')
+    records.get('key', lambda: 'record')
+
+    assert records.store is pages.store
+    assert records.stats()['backend'] == 'shared'
+    assert pages.get('key', lambda: 'page') == 'page'
+    assert records.get('key', lambda: 'refetched') == 'record'
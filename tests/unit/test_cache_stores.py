@@ -0,0 +1,176 @@
+"""Unit tests for the cache storage backends"""
+
+import multiprocessing
+import threading
+
+import pytest
+
+from loadtest import resp_stub
+from viringo import cache
+from viringo import cache_stores
+
+def store_in_child(path):
+    """Store a value from another process"""
+    store = cache_stores.SharedStore(path, 16, 4096)
+    store.set('test', ('page', 1), {'records': ['a', 'b']})
+    store.close()
+
+@pytest.fixture
+def resp_server():
+    """A stand-in redis server on a free port"""
+    server = resp_stub.RespServer(('127.0.0.1', 0))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def test_local_store_evicts_least_recently_used():
+    """Test the local store is bounded and counts its evictions"""
+    store = cache_stores.LocalStore(2)
+    store.set('test', 'a', 1)
+    store.set('test', 'b', 2)
+    store.get('test', 'a')
+    store.set('test', 'c', 3)
+
+    assert store.get('test', 'b') is None
+    assert store.get('test', 'a') == 1
+    assert store.stats()['evictions'] == 1
+    assert store.stats()['entries'] == 2
+
+def test_shared_store_is_shared_between_processes(tmp_path):
+    """Test a value stored by one process is read by another mapping the same file"""
+    path = str(tmp_path / 'cache')
+    store = cache_stores.SharedStore(path, 16, 4096)
+
+    child = multiprocessing.get_context('fork').Process(target=store_in_child, args=(path,))
+    child.start()
+    child.join()
+
+    assert store.get('test', ('page', 1)) == {'records': ['a', 'b']}
+    assert store.get('test', ('page', 2)) is None
+
+    store.set('test', ('page', 3), 'x' * 8192)
+    assert store.stats()['too_large'] == 1
+
+    store.delete('test', ('page', 1))
+    assert store.get('test', ('page', 1)) is None
+    store.close()
+
+def test_shared_store_counts_slot_evictions(tmp_path):
+    """Test a value replacing another key in its slot counts as an eviction"""
+    store = cache_stores.SharedStore(str(tmp_path / 'cache'), 1, 4096)
+    store.set('test', 'a', 1)
+    store.set('test', 'b', 2)
+
+    assert store.get('test', 'a') is None
+    assert store.get('test', 'b') == 2
+    assert store.stats()['evictions'] == 1
+    store.close()
+
+def test_shared_store_update_never_evicts_another_key(tmp_path):
+    """Test an update colliding with another key's unexpired value fails rather than replacing it"""
+    store = cache_stores.SharedStore(str(tmp_path / 'cache'), 2, 4096, ways=2)
+    store.update('ratelimit', ('running', 'expensive'), lambda leases: {'lease': 1}, ttl=60)
+    store.update('ratelimit', 'bucket', lambda bucket: 5, ttl=60)
+
+    with pytest.raises(cache_stores.StoreError):
+        store.update('ratelimit', 'other', lambda bucket: 5, ttl=60)
+    assert store.get('ratelimit', ('running', 'expensive')) == {'lease': 1}
+    assert store.get('ratelimit', 'bucket') == 5
+
+    # Expired values free their slot, and a cache set may still replace values
+    store.update('ratelimit', 'bucket', lambda bucket: bucket, ttl=-1)
+    assert store.get('ratelimit', 'bucket') is None
+    assert store.update('ratelimit', 'other', lambda bucket: (bucket or 0) + 1, ttl=60) == 1
+    store.set('test', 'a', 1)
+    assert store.get('test', 'a') == 1
+    assert store.stats()['evictions'] == 1
+    store.close()
+
+def test_redis_store(resp_server):
+    """Test values round trip through the RESP client and namespaces are cleared separately"""
+    host, port = resp_server.server_address
+    store = cache_stores.RedisStore('redis://%s:%s/1' % (host, port), timeout=1)
+    store.set('records', 'a', {'title': 'A'})
+    store.set('sets', 'a', ['SET'])
+
+    assert store.get('records', 'a') == {'title': 'A'}
+    store.clear('records')
+    assert store.get('records', 'a') is None
+    assert store.get('sets', 'a') == ['SET']
+    assert store.stats()['hits'] == 2
+    assert store.stats()['misses'] == 1
+    store.close()
+
+def test_unreachable_store_is_a_miss(mocker, resp_server):
+    """Test the cache still answers by fetching when its store can't be reached"""
+    host, port = resp_server.server_address
+    store = cache_stores.RedisStore('redis://%s:%s/0' % (host, port), timeout=1)
+    resp_server.shutdown()
+    resp_server.server_close()
+    swr = cache.StaleWhileRevalidateCache('test', 10, 60, 0, store=store)
+    fetch = mocker.Mock(return_value='page')
+
+    assert swr.get('key', fetch) == 'page'
+    assert swr.get('key', fetch) == 'page'
+
+    assert fetch.call_count == 2
+    assert swr.stats()['store_errors'] == 4
+
+@pytest.mark.parametrize('backend', ['local', 'shared', 'redis'])
+def test_clearing_partitions(backend, tmp_path, resp_server):
+    """Test clearing a partition keeps the others, and clearing a name clears all its partitions"""
+    host, port = resp_server.server_address
+    store = cache_stores.create_store(
+        backend, 10, str(tmp_path / 'cache'), 1024, 4096, 'redis://%s:%s/0' % (host, port), 1)
+    for namespace in ['pages/set[1]', 'pages/set2', 'pages', 'records']:
+        store.set(namespace, 'key', namespace)
+
+    store.clear('pages/set[1]')
+    assert store.get('pages/set[1]', 'key') is None
+    assert store.get('pages/set2', 'key') == 'pages/set2'
+
+    store.clear('pages')
+    assert [store.get(namespace, 'key') for namespace in ['pages/set2', 'pages', 'records']] == [
+        None, None, 'records']
+    store.close()
+
+def test_redis_store_clears_a_partition_from_its_index(mocker, resp_server):
+    """Test clearing a partition deletes its indexed keys without scanning the keyspace"""
+    host, port = resp_server.server_address
+    store = cache_stores.RedisStore('redis://%s:%s/0' % (host, port), timeout=1)
+    store.set('records/a', 'key', 'a')
+    store.update('records/a', 'other', lambda value: 'updated')
+    store.set('records/b', 'key', 'b')
+    run = mocker.spy(resp_server, 'run')
+
+    store.clear('records/a')
+    assert b'SCAN' not in [args[0] for (args,), _ in run.call_args_list]
+    assert [store.get('records/a', key) for key in ['key', 'other']] == [None, None]
+    assert store.get('records/b', 'key') == 'b'
+
+    store.clear('records')
+    assert store.get('records/b', 'key') is None
+    assert resp_server.data == {}
+    store.close()
+
+@pytest.mark.parametrize('backend', ['local', 'shared', 'redis'])
+def test_update_is_atomic(backend, tmp_path, resp_server):
+    """Test concurrent updates of a key each see the value the previous one left"""
+    host, port = resp_server.server_address
+    store = cache_stores.create_store(
+        backend, 16, str(tmp_path / 'cache'), 16, 4096, 'redis://%s:%s/0' % (host, port), 1)
+
+    def increment():
+        for _ in range(25):
+            store.update('test', 'counter', lambda value: (value or 0) + 1, ttl=60)
+
+    threads = [threading.Thread(target=increment) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert store.update('test', 'counter', lambda value: value) == 100
+    store.close()
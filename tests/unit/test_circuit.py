@@ -0,0 +1,50 @@
+"""Unit tests for the upstream circuit breaker"""
+
+import pytest
+
+from viringo import circuit
+
+def test_opens_after_consecutive_failures(mocker):
+    """Test calls fail fast once the failure threshold is reached"""
+    mocker.patch('viringo.config.CIRCUIT_FAILURE_THRESHOLD', 2)
+    mocker.patch('viringo.config.CIRCUIT_RESET_SECONDS', 30)
+    breaker = circuit.CircuitBreaker('test')
+    failing = mocker.Mock(side_effect=IOError('down'))
+
+    for _ in range(2):
+        with pytest.raises(IOError):
+            breaker.call(failing)
+
+    with pytest.raises(circuit.CircuitOpenError) as err:
+        breaker.call(failing)
+
+    assert failing.call_count == 2
+    assert err.value.retry_after == 30
+    assert breaker.stats()['state'] == circuit.OPEN
+    assert breaker.stats()['rejected'] == 1
+
+def test_failing_results_and_slow_calls(mocker):
+    """Test results judged as failures and slow calls count towards opening"""
+    mocker.patch('viringo.config.CIRCUIT_FAILURE_THRESHOLD', 2)
+    mocker.patch('viringo.config.CIRCUIT_SLOW_CALL_SECONDS', 0)
+    breaker = circuit.CircuitBreaker('test')
+
+    assert breaker.call(lambda: 503, is_failure=lambda status: status >= 500) == 503
+    breaker.call(lambda: 200)
+
+    assert breaker.stats()['failures'] == 1
+    assert breaker.stats()['slow_calls'] == 1
+    assert breaker.stats()['state'] == circuit.OPEN
+
+def test_trial_call_closes_circuit(mocker):
+    """Test a successful trial call after the reset period closes the circuit"""
+    mocker.patch('viringo.config.CIRCUIT_FAILURE_THRESHOLD', 1)
+    mocker.patch('viringo.config.CIRCUIT_RESET_SECONDS', 0)
+    breaker = circuit.CircuitBreaker('test')
+
+    with pytest.raises(IOError):
+        breaker.call(mocker.Mock(side_effect=IOError('down')))
+    assert breaker.stats()['state'] == circuit.OPEN
+
+    assert breaker.call(lambda: 'ok') == 'ok'
+    assert breaker.stats()['state'] == circuit.CLOSED
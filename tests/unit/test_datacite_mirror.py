@@ -0,0 +1,131 @@
+"""Unit tests for the local DataCite mirror"""
+
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+from viringo.services import datacite_mirror
+
+@pytest.fixture
+def mirror(mocker, tmp_path):
+    """A mirror synced from the fixture page of 25 DOIs"""
+    path = str(tmp_path / 'mirror.sqlite')
+    mocker.patch('viringo.config.DATACITE_MIRROR_PATH', path)
+    mocker.patch('viringo.config.DATACITE_MIRROR_INDEX_LAG', 0)
+    with open('tests/integration/fixtures/datacite_api_dois.json') as json_file:
+        page = json.load(json_file)
+    fetch_page = mocker.patch('viringo.services.datacite_mirror.fetch_page', return_value=(page, 0))
+
+    assert datacite_mirror.sync(path) == 25
+    return path, page, fetch_page
+
+def test_sync_carries_on_from_last_sync(mirror):
+    """Test a later sync only asks for the DOIs updated since the previous one"""
+    path, _, fetch_page = mirror
+    assert 'query' not in fetch_page.call_args[0][0]
+
+    datacite_mirror.sync(path)
+
+    assert fetch_page.call_args[0][0]['query'].startswith('updated:[')
+    assert datacite_mirror.available()
+
+def test_failed_page_leaves_the_last_sync_in_place(mocker, tmp_path):
+    """Test a page the API refuses ends the sync without recording it as done"""
+    path = str(tmp_path / 'mirror.sqlite')
+    with open('tests/integration/fixtures/datacite_api_dois.json') as json_file:
+        page = json.load(json_file)
+    mocker.patch('viringo.services.datacite.api_call_get', side_effect=[
+        mocker.Mock(status_code=200, json=mocker.Mock(return_value=page)), mocker.Mock(status_code=429)])
+
+    with pytest.raises(datacite_mirror.SyncError):
+        datacite_mirror.sync(path)
+
+    con = datacite_mirror.connect_for_sync(path)
+    assert con.execute('SELECT count(*) FROM dois').fetchone()[0] == 25
+    assert datacite_mirror.synced_until(con) is None
+    con.close()
+
+def test_full_sync_drops_dois_no_longer_listed(mirror, mocker):
+    """Test a full sync, on request or once reconciling is due, drops the DOIs the API left out"""
+    path, page, fetch_page = mirror
+    fetch_page.return_value = (dict(page, data=page['data'][1:]), 0)
+    con = datacite_mirror.connect_for_sync(path)
+
+    datacite_mirror.sync(path)
+    assert con.execute('SELECT count(*) FROM dois').fetchone()[0] == 25
+
+    mocker.patch('viringo.config.DATACITE_MIRROR_RECONCILE_SECONDS', 1)
+    con.execute("UPDATE sync_state SET value = '0' WHERE key = 'reconciled_at'")
+    con.commit()
+    datacite_mirror.sync(path)
+    assert 'query' not in fetch_page.call_args[0][0]
+    assert con.execute('SELECT count(*) FROM dois').fetchone()[0] == 24
+    assert con.execute('SELECT id FROM dois WHERE id = ?', [page['data'][0]['id'].lower()]).fetchone() is None
+    con.close()
+
+def test_keyset_paging_returns_every_record_once(mirror, mocker):
+    """Test paging through the mirror by (updated, id) returns each mirrored DOI once, in order"""
+    _, page, _ = mirror
+    mocker.patch('viringo.config.RESULT_SET_SIZE', 10)
+
+    # Everything is updated before the sync, so a window ending at it needs no API call
+    until = max(datacite_mirror.datestamps.to_utc(entry['attributes']['updated']) for entry in page['data'])
+    seen = []
+    cursor = None
+    while True:
+        results, total, cursor = datacite_mirror.get_metadata_list(until_datetime=until, cursor=cursor)
+        seen.extend((result.updated_datetime, result.identifier.lower()) for result in results)
+        assert total == 25
+        if not cursor:
+            break
+
+    assert len(seen) == 25
+    assert seen == sorted(seen)
+
+def test_changes_since_sync_come_from_the_api(mirror, mocker):
+    """Test a window running past the last sync goes on to the API from where the mirror ends"""
+    mocker.patch('viringo.config.RESULT_SET_SIZE', 20)
+    live = mocker.patch('viringo.services.datacite.get_metadata_list', return_value=(['live'], 2, 0))
+
+    _, total, cursor = datacite_mirror.get_metadata_list(client_id='datacite.datacite', cursor=None)
+    assert total == 25 and not live.called
+    _, total, cursor = datacite_mirror.get_metadata_list(client_id='datacite.datacite', cursor=cursor)
+    assert not live.called
+    results, total, cursor = datacite_mirror.get_metadata_list(client_id='datacite.datacite', cursor=cursor)
+
+    assert results == ['live']
+    assert total == 27
+    assert cursor is None
+    assert live.call_args[1]['client_id'] == 'datacite.datacite'
+    assert live.call_args[1]['from_datetime'] > datetime.utcnow() - timedelta(minutes=1)
+
+def test_api_goes_on_after_the_second_the_mirror_ends(mirror, mocker):
+    """Test the API is asked for the changes after the split, as the mirror listed those up to and in it"""
+    live = mocker.patch('viringo.services.datacite.get_metadata_list', return_value=([], 0, None))
+    split = 1577836800
+
+    datacite_mirror.get_metadata_list(cursor=json.dumps(['live', split, 1, 25]))
+
+    assert live.call_args[1]['from_datetime'] == datetime(2020, 1, 1, 0, 0, 1)
+
+@pytest.mark.parametrize('cursor', [
+    '["mirror', '["mirror", 1]', '["mirror", "1", 1, "a"]', '["mirror", 1, "1", "a"]',
+    '["live", 1, 1, -1]', '["live", 1, null, 1]', '["dump", 1, 1, 1]'
+])
+def test_malformed_cursor_is_refused(cursor):
+    """Test a cursor a client edited out of shape is refused before it is used"""
+    with pytest.raises(ValueError):
+        datacite_mirror.parse_cursor(cursor)
+
+def test_batch_lookup_asks_the_api_for_unmirrored_dois(mirror, mocker):
+    """Test a batch is answered from the mirror, with only the DOIs it lacks looked up in the API"""
+    _, page, _ = mirror
+    get_metadata = mocker.patch('viringo.services.datacite.get_metadata', return_value=None)
+    dois = [page['data'][0]['id'].upper(), '10.5072/unknown', page['data'][1]['id']]
+
+    results = datacite_mirror.get_metadata_batch(dois)
+
+    assert sorted(results) == sorted([dois[0], dois[2]])
+    assert results[dois[2]].identifier == page['data'][1]['id']
+    get_metadata.assert_called_once_with('10.5072/unknown')
@@ -0,0 +1,42 @@
+"""Unit tests for datestamp parsing"""
+
+import dateutil.parser
+import dateutil.tz
+import pytest
+
+from viringo import datestamps
+
+DATESTAMPS = [
+    '2019-03-18',
+    '2019-03-18T10:30:37Z',
+    '2019-03-18T10:30:37.000Z',
+    '2019-03-18T10:30:37.123456+02:00',
+    '2019-03-18T10:30:37.1Z',
+    '2019-03-18 10:30:37',
+    '2019-03-18T10:30:37-05:00',
+    ' 2019-03-18 ',
+    '2019',
+    '2019-03',
+    'March 18, 2019',
+    '18/03/2019',
+]
+
+@pytest.mark.parametrize('value', DATESTAMPS)
+def test_parse_matches_dateutil(value):
+    """Test datestamps parse the same as with dateutil"""
+    assert datestamps.parse(value) == dateutil.parser.parse(value)
+
+@pytest.mark.parametrize('value', DATESTAMPS)
+def test_to_utc_matches_dateutil(value):
+    """Test the UTC conversion matches converting the dateutil result"""
+    expected = dateutil.parser.parse(value).astimezone(dateutil.tz.UTC).replace(tzinfo=None)
+
+    result = datestamps.to_utc(value)
+
+    assert result == expected
+    assert result.tzinfo is None
+
+def test_unparseable_datestamp():
+    """Test values dateutil can't parse raise the same error"""
+    with pytest.raises(ValueError):
+        datestamps.parse('not a date')
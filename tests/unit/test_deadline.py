@@ -0,0 +1,102 @@
+"""Unit tests for the request deadline budget"""
+
+import threading
+import time
+
+import pytest
+
+from viringo import circuit
+from viringo import deadline
+from viringo.singleflight import SingleFlight
+
+def test_timeout_is_capped_by_remaining_budget():
+    """Test backend timeouts shrink to what the current request has left"""
+    assert deadline.timeout(30) == 30
+
+    with deadline.activate(deadline.Deadline(5)):
+        assert 4 < deadline.timeout(30) <= 5
+        assert deadline.timeout(1) == 1
+
+    assert deadline.current() is None
+
+def test_expired_deadline_raises():
+    """Test an expired deadline stops further work with a 503 error"""
+    with deadline.activate(deadline.Deadline(0)):
+        with pytest.raises(deadline.DeadlineExceeded):
+            deadline.check()
+        with pytest.raises(circuit.BackendUnavailable):
+            deadline.timeout(30)
+
+def test_abandoned_call_is_not_a_backend_failure(mocker):
+    """Test a call given up on by its caller neither opens nor closes the circuit"""
+    mocker.patch('viringo.config.CIRCUIT_FAILURE_THRESHOLD', 1)
+    mocker.patch('viringo.config.CIRCUIT_RESET_SECONDS', 0)
+    breaker = circuit.CircuitBreaker('test')
+    with pytest.raises(IOError):
+        breaker.call(mocker.Mock(side_effect=IOError('down')))
+
+    with pytest.raises(deadline.DeadlineExceeded):
+        breaker.call(mocker.Mock(side_effect=deadline.DeadlineExceeded('out of time')))
+
+    assert breaker.stats()['state'] == circuit.OPEN
+    assert breaker.stats()['failures'] == 1
+    # The next call is let through as the trial again
+    assert breaker.call(lambda: 'ok') == 'ok'
+
+def test_coalesced_caller_stops_waiting_at_its_deadline():
+    """Test a caller waiting on another's fetch gives up when its own deadline runs out"""
+    group = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow_fetch():
+        started.set()
+        release.wait()
+        return 'result'
+
+    leader = threading.Thread(target=group.do, args=('fetch', 'key', slow_fetch))
+    leader.start()
+    started.wait()
+    try:
+        with deadline.activate(deadline.Deadline(0.05)):
+            with pytest.raises(deadline.DeadlineExceeded):
+                group.do('fetch', 'key', slow_fetch)
+    finally:
+        release.set()
+        leader.join()
+
+def test_coalesced_caller_fetches_again_when_the_leader_runs_out_of_time():
+    """Test a caller with time left isn't failed by the deadline of the call it waited on"""
+    group = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    errors = []
+
+    def leader_fetch():
+        started.set()
+        release.wait()
+        raise deadline.DeadlineExceeded('leader out of time')
+
+    def lead():
+        try:
+            group.do('fetch', 'key', leader_fetch)
+        except deadline.DeadlineExceeded as err:
+            errors.append(err)
+
+    leader = threading.Thread(target=lead)
+    leader.start()
+    started.wait()
+
+    follower_results = []
+    follower = threading.Thread(target=lambda: follower_results.append(
+        group.do('fetch', 'key', lambda: 'result')))
+    follower.start()
+    while group.stats()['fetch']['coalesced'] < 1:
+        time.sleep(0.001)
+    release.set()
+    leader.join()
+    follower.join()
+
+    assert len(errors) == 1
+    assert follower_results == ['result']
+    assert group.stats()['fetch'] == {'calls': 2, 'fetches': 2, 'coalesced': 1}
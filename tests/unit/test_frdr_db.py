@@ -0,0 +1,317 @@
+"""Unit tests for the FRDR prepared statements"""
+
+import json
+import threading
+from datetime import datetime
+from types import SimpleNamespace
+
+import psycopg2.extensions
+import pytest
+
+from viringo import circuit
+from viringo import config
+from viringo import deadline
+from viringo.services import frdr
+from viringo.services import frdr_db
+from viringo.services.frdr_db import Statement
+
+class FakeConnection:
+    """A psycopg2 connection stand in recording the statements run on it"""
+    closed = 0
+    autocommit = True
+    info = SimpleNamespace(transaction_status=psycopg2.extensions.TRANSACTION_STATUS_IDLE)
+
+    def __init__(self):
+        self.statements = []
+        self.statement_timeout = None
+        # Rows fetched by each query, in turn
+        self.results = []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def close(self):
+        self.closed = 1
+
+class FakeCursor:
+    """Records what is executed on its connection"""
+
+    def __init__(self, con):
+        self.con = con
+        self.connection = con
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, sql, params=None):
+        self.con.statements.append((sql, params))
+
+    def fetchall(self):
+        return self.con.results.pop(0)
+
+class FakePool(frdr_db.WaitingConnectionPool):
+    """A waiting pool handing out fake connections, kept open when returned"""
+
+    def _connect(self, key=None):
+        con = FakeConnection()
+        if key is not None:
+            self._used[key] = con
+            self._rused[id(con)] = key
+        else:
+            self._pool.append(con)
+        return con
+
+@pytest.fixture
+def pool(mocker):
+    """A pool of one fake connection, used for every FRDR database"""
+    fake_pool = FakePool(1, 1, '')
+    mocker.patch('viringo.services.frdr_db.get_pool', return_value=fake_pool)
+    return fake_pool
+
+def test_statement_prepare_sql():
+    """Test placeholders are numbered in the PREPARE statement"""
+
+    statement = Statement('frdr_test', "SELECT a FROM t WHERE b = %s AND c < %s")
+
+    assert statement.parameter_count == 2
+    assert statement.prepare_sql() == "PREPARE frdr_test AS SELECT a FROM t WHERE b = $1 AND c < $2"
+    assert statement.execute_sql() == "EXECUTE frdr_test (%s, %s)"
+
+def test_statement_without_parameters():
+    """Test a statement without parameters is executed without an argument list"""
+
+    assert frdr.SETS_SQL.execute_sql() == "EXECUTE frdr_sets"
+
+def test_records_list_query_binds_values():
+    """Test filter values are bound rather than written into the query"""
+
+    statement, params = frdr.records_list_query(
+        set="ed'ora", from_datetime=datetime(2019, 1, 1), cursor='50')
+
+    assert statement.name == 'frdr_records_list_set_from'
+    assert "ed'ora" not in statement.sql
+    assert statement.parameter_count == len(params)
+    assert params[0] == "ed'ora"
+    assert params[-1] == 50
+
+def test_records_list_query_shapes():
+    """Test each combination of filters is a separately prepared statement"""
+
+    names = set([
+        frdr.records_list_query()[0].name,
+        frdr.records_list_query(set='openaire_data')[0].name,
+        frdr.records_list_query(until_datetime=datetime(2019, 1, 1))[0].name,
+        frdr.records_list_query(set='a', until_datetime=datetime(2019, 1, 1))[0].name,
+    ])
+
+    assert names == set(['frdr_records_list', 'frdr_records_list_until', 'frdr_records_list_set_until'])
+
+def test_records_list_query_limits_to_valid_records():
+    """Test invalid records are filtered and a page is limited in the query"""
+
+    statement, params = frdr.records_list_query(cursor='100')
+
+    assert frdr.VALID_RECORD_SQL in statement.sql
+    assert statement.sql.endswith('LIMIT %s OFFSET %s')
+    assert params == [config.RESULT_SET_SIZE, 100]
+
+def test_records_stream_query():
+    """Test the streaming query has the page filters without a window count or limit"""
+
+    statement, params = frdr.records_stream_query(set='repo1', until_datetime=datetime(2019, 1, 1))
+
+    assert statement.name == 'frdr_records_stream_set_until'
+    assert frdr.VALID_RECORD_SQL in statement.sql
+    assert 'OVER()' not in statement.sql
+    assert 'LIMIT' not in statement.sql
+    assert params[0] == 'repo1'
+    assert statement.parameter_count == len(params)
+
+def test_records_stream_query_resumes_after_record():
+    """Test the streaming query continues after a record_uuid keyset position"""
+
+    statement, params = frdr.records_stream_query(after='00000000-0000-0000-0000-000000000001')
+
+    assert statement.name == 'frdr_records_stream_after'
+    assert statement.sql.endswith('AND recs.record_uuid > %s\n        ORDER BY recs.record_uuid')
+    assert params == ['00000000-0000-0000-0000-000000000001']
+
+def test_batch_statements_look_up_many_records():
+    """Test each child lookup has a batch form selecting the record it belongs to"""
+
+    for _, statement in frdr.CHILD_TABLE_BATCH_SQL + [(None, frdr.GEOBBOX_BATCH_SQL)]:
+        assert statement.name.endswith('_batch')
+        assert statement.sql.startswith('SELECT ')
+        assert ' AS batch_uuid, ' in statement.sql
+        assert 'record_uuid = ANY(%s::uuid[])' in statement.sql
+        assert statement.parameter_count == 1
+
+    assert frdr.uuid_array(['a-1', 'b-2']) == '{a-1,b-2}'
+
+def test_children_statement_is_one_query():
+    """Test the child lookups of a record are subqueries of one statement, each bound to the record"""
+
+    assert frdr.CHILDREN_SQL.sql.startswith('SELECT (SELECT')
+    assert frdr.CHILDREN_SQL.parameter_count == len(frdr.CHILD_LOOKUP_SQL)
+    assert 'order by records_x_creators_id asc' in frdr.CHILDREN_SQL.sql
+
+    row = ['[{"westlon": 1.50}]', '[]', '[]'] + ['[{"creator": "Ada"}]'] * len(frdr.CHILD_TABLE_SQL)
+    rows = frdr.children_rows(row)
+    # Numbers are written out as Postgres sent them
+    assert str(rows['frdr_geobbox'][0]['westlon']) == '1.50'
+    assert rows['frdr_creators'] == [['Ada']]
+
+def test_assemble_records_matches_assemble_record():
+    """Test records assembled in a batch get the child values of one by one assembly"""
+
+    children = {
+        ('u1', 'frdr_creators'): [['Ada']],
+        ('u1', 'frdr_geopoint'): [{'lat': 1, 'lon': 2}],
+        ('u2', 'frdr_creators'): [['Bo'], ['Cy']],
+        ('u2', 'frdr_access'): [['Public']],
+    }
+
+    class Row(list):
+        """A DictRow stand in, read by index and by name"""
+        def __init__(self, values, names):
+            super(Row, self).__init__(values)
+            self.names = names
+
+        def __getitem__(self, key):
+            if isinstance(key, str):
+                return list.__getitem__(self, self.names.index(key))
+            return list.__getitem__(self, key)
+
+    def to_row(uuid, value, batch):
+        names = list(value.keys()) if isinstance(value, dict) else ['value']
+        values = list(value.values()) if isinstance(value, dict) else list(value)
+        if batch:
+            return Row([uuid] + values, ['batch_uuid'] + names)
+        return Row(values, names)
+
+    class Cursor:
+        """Answers the single and batch child lookups from children"""
+        connection = None
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            pass
+
+        def execute(self, sql, params):
+            if sql == frdr.CHILDREN_SQL.sql:
+                # Every lookup as a json array of row objects
+                self.rows = [[json.dumps([value if isinstance(value, dict) else {'value': value[0]}
+                                          for value in children.get((params[0], statement.name), [])])
+                              for statement in frdr.CHILD_LOOKUP_SQL]]
+                return
+            name = next(statement.name for statement in all_statements if statement.sql == sql)
+            if name.endswith('_batch'):
+                name = name[:-len('_batch')]
+                uuids = params[0].strip('{}').split(',')
+                self.rows = [to_row(uuid, value, True)
+                             for uuid in uuids for value in children.get((uuid, name), [])]
+            else:
+                self.rows = [to_row(params[0], value, False) for value in children.get((params[0], name), [])]
+
+        def fetchall(self):
+            return self.rows
+
+        def fetchone(self):
+            return self.rows[0]
+
+    class Connection:
+        def cursor(self, cursor_factory=None):
+            return Cursor()
+
+    all_statements = [frdr.GEOBBOX_SQL, frdr.GEOPOINT_SQL, frdr.GEOPLACE_SQL,
+                      frdr.GEOBBOX_BATCH_SQL, frdr.GEOPOINT_BATCH_SQL, frdr.GEOPLACE_BATCH_SQL]
+    all_statements += [statement for _, statement in frdr.CHILD_TABLE_SQL + frdr.CHILD_TABLE_BATCH_SQL]
+
+    one_by_one = [frdr.assemble_record({'record_uuid': uuid}, Connection()) for uuid in ['u1', 'u2']]
+    batched = frdr.assemble_records([{'record_uuid': 'u1'}, {'record_uuid': 'u2'}], Connection())
+
+    assert batched == one_by_one
+    assert batched[1]['dc:contributor.author'] == ['Bo', 'Cy']
+    assert batched[0]['datacite_geoLocation'] == {
+        'geoLocationPoint': [{'pointLatitude': 1, 'pointLongitude': 2}]}
+
+def test_connection_waits_for_a_free_connection(pool, mocker):
+    """Test a borrower waits for a connection to be returned rather than failing"""
+    mocker.patch('viringo.config.POSTGRES_POOL_TIMEOUT_SECONDS', 5)
+    borrowed = pool.getconn()
+    threading.Timer(0.05, pool.putconn, [borrowed]).start()
+
+    with frdr_db.connection('db', 'user', 'password', 'server', 5432) as con:
+        assert con is borrowed
+
+def test_connection_unavailable_when_pool_stays_exhausted(pool, mocker):
+    """Test a borrower gives up with a 503 once nothing was returned in time"""
+    mocker.patch('viringo.config.POSTGRES_POOL_TIMEOUT_SECONDS', 0.05)
+    pool.getconn()
+
+    with pytest.raises(circuit.BackendUnavailable) as err:
+        with frdr_db.connection('db', 'user', 'password', 'server', 5432):
+            pass
+    assert err.value.retry_after == 1
+
+    # Waiting is bounded by the request's deadline too
+    mocker.patch('viringo.config.POSTGRES_POOL_TIMEOUT_SECONDS', 60)
+    with deadline.activate(deadline.Deadline(0.05)):
+        with pytest.raises(deadline.DeadlineExceeded):
+            with frdr_db.connection('db', 'user', 'password', 'server', 5432):
+                pass
+
+def test_statement_timeout_set_once_per_borrow(pool):
+    """Test a borrow sets the deadline's statement_timeout without resetting it afterwards"""
+    with deadline.activate(deadline.Deadline(10)):
+        with frdr_db.connection('db', 'user', 'password', 'server', 5432) as con:
+            assert [sql for sql, _ in con.statements] == ['SET statement_timeout = %s']
+            assert 9000 < con.statements[0][1][0] <= 10000
+    assert len(con.statements) == 1
+
+    # Borrows without a deadline restore the default, once
+    for _ in range(2):
+        with frdr_db.connection('db', 'user', 'password', 'server', 5432) as con:
+            pass
+    assert [sql for sql, _ in con.statements[1:]] == ['SET statement_timeout TO DEFAULT']
+
+def test_iter_metadata_list_borrows_a_connection_per_chunk(pool, mocker):
+    """Test streamed records are read a chunk at a time, resuming after the last record of the previous one"""
+    mocker.patch('viringo.services.frdr.assemble_records', side_effect=lambda records, con: records)
+    mocker.patch('viringo.services.frdr.build_metadata', side_effect=lambda record: record['local_identifier'])
+    con = pool.getconn()
+    pool.putconn(con)
+    uuids = ['00000000-0000-0000-0000-00000000000%d' % number for number in range(5)]
+    con.results = [[(uuid,) + (None,) * 7 + (uuid[-1],) for uuid in chunk]
+                   for chunk in [uuids[:2], uuids[2:4], uuids[4:]]]
+
+    records = []
+    for uuid, metadata in frdr.iter_metadata_list('server', 'db', 'user', 'password', 5432,
+                                                  set='repo1', itersize=2, keyed=True):
+        # No connection is held while the caller handles a record
+        assert not pool._used
+        records.append((uuid, metadata))
+
+    assert records == [(uuid, uuid[-1]) for uuid in uuids]
+    assert [params for _, params in con.statements] == [['repo1', 2], ['repo1', uuids[1], 2], ['repo1', uuids[3], 2]]
+
+def test_get_metadata_list_assembles_the_page_in_one_batch(pool, mocker):
+    """Test a page's child values are looked up for all its records at once rather than a record at a time"""
+    assemble_records = mocker.patch('viringo.services.frdr.assemble_records',
+                                    side_effect=lambda records, con: records)
+    assemble_record = mocker.patch('viringo.services.frdr.assemble_record')
+    mocker.patch('viringo.services.frdr.build_metadata', side_effect=lambda record: record['local_identifier'])
+    con = pool.getconn()
+    pool.putconn(con)
+    con.results = [[('u%d' % number,) + (None,) * 7 + ('id%d' % number, 3) for number in range(3)]]
+
+    results = frdr.get_metadata_list('server', 'db', 'user', 'password', 5432, set='repo1', cursor='0')
+
+    assert results == (['id0', 'id1', 'id2'], 3, 3)
+    assert assemble_records.call_count == 1
+    assert not assemble_record.called
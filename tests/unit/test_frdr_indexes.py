@@ -0,0 +1,41 @@
+"""Unit tests for the FRDR index advisor"""
+
+from viringo.services import frdr_indexes
+
+def test_missing_indexes():
+    """Test indexes are matched on their leading columns"""
+
+    indexes = {
+        'records': [['record_uuid'], ['repository_id', 'record_uuid', 'deleted']],
+        'records_x_creators': [['records_x_creators_id'], ['record_uuid', 'is_contributor']],
+        'geobbox': [['geobbox_id']],
+    }
+
+    missing = [(spec.table, spec.columns) for spec in frdr_indexes.missing_indexes(indexes)]
+
+    assert ('records', ['record_uuid']) not in missing
+    assert ('records', ['repository_id', 'record_uuid']) not in missing
+    assert ('records_x_creators', ['record_uuid']) not in missing
+    assert ('records', ['upstream_modified_timestamp']) in missing
+    assert ('geobbox', ['record_uuid']) in missing
+
+def test_migration_ddl():
+    """Test the migration creates missing indexes concurrently"""
+
+    spec = frdr_indexes.IndexSpec('geobbox', ['record_uuid'], 'geoLocationBox lookup')
+    ddl = frdr_indexes.migration_ddl([spec])
+
+    assert 'CREATE INDEX CONCURRENTLY IF NOT EXISTS viringo_geobbox_record_uuid_idx ON geobbox (record_uuid);' in ddl
+
+def test_sequential_scans():
+    """Test sequential scans are found anywhere in a plan"""
+
+    plan = {
+        'Node Type': 'Nested Loop',
+        'Plans': [
+            {'Node Type': 'Index Scan', 'Relation Name': 'records', 'Index Name': 'records_pkey'},
+            {'Node Type': 'Hash', 'Plans': [{'Node Type': 'Seq Scan', 'Relation Name': 'geobbox'}]},
+        ]
+    }
+
+    assert frdr_indexes.sequential_scans(plan) == ['geobbox']
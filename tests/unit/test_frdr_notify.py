@@ -0,0 +1,94 @@
+"""Unit tests for the FRDR change notification cache invalidation"""
+
+import json
+
+import pytest
+
+from viringo import cache
+from viringo import cache_stores
+from viringo import incremental
+from viringo.services import frdr_notify
+
+@pytest.fixture
+def cached_frdr(mocker):
+    """Cache records of two sets, pages of both and all sets, and the sets"""
+    mocker.patch('viringo.config.CACHE_FRESH_SECONDS', 3600)
+    records = cache.get_cache('frdr.get_metadata')
+    pages = cache.get_cache('frdr.get_metadata_list')
+    sets = cache.get_cache('frdr.get_sets')
+    for identifier in ['oai:repo1:a', 'oai:repo1:b', 'oai:repo2:c']:
+        records.get(identifier, lambda: 'record', identifier)
+    for set_name in ['repo1', 'repo2', 'openaire_data']:
+        pages.get(set_name, lambda: 'page', set_name)
+    sets.get('sets', lambda: 'sets')
+    return records, pages, sets
+
+def record_change(set_name, local_identifier):
+    """Payload the records trigger sends"""
+    return json.dumps({'table': 'records', 'set': set_name, 'local_identifier': local_identifier})
+
+def test_record_change_drops_only_affected_entries(cached_frdr, mocker):
+    """Test a changed record drops itself and the pages of its set and of all sets"""
+    records, pages, sets = cached_frdr
+    mocker.patch('viringo.config.INCREMENTAL_WATERMARK_TTL', 60)
+    incremental.WATERMARKS.latest(('FRDR', 'repo1'), lambda: None)
+    incremental.WATERMARKS.latest(('FRDR', 'repo2'), lambda: None)
+
+    frdr_notify.invalidate([record_change('repo1', 'a'), record_change('repo1', 'a')])
+
+    assert records.stats()['entries'] == 2
+    assert records.get('oai:repo1:a', lambda: 'refetched', 'oai:repo1:a') == 'refetched'
+    assert records.get('oai:repo1:b', lambda: 'refetched', 'oai:repo1:b') == 'record'
+    assert pages.get('repo1', lambda: 'refetched', 'repo1') == 'refetched'
+    assert pages.get('openaire_data', lambda: 'refetched', 'openaire_data') == 'refetched'
+    assert pages.get('repo2', lambda: 'refetched', 'repo2') == 'page'
+    assert sets.get('sets', lambda: 'refetched') == 'sets'
+    assert incremental.WATERMARKS.latest(('FRDR', 'repo1'), lambda: 'refetched') == 'refetched'
+    assert incremental.WATERMARKS.latest(('FRDR', 'repo2'), lambda: 'refetched') is None
+    incremental.WATERMARKS.clear()
+
+def test_shared_value_change_drops_everything(cached_frdr):
+    """Test a change to a value shared between records drops every FRDR entry"""
+    records, pages, sets = cached_frdr
+
+    frdr_notify.invalidate([json.dumps({'table': 'subjects'})])
+
+    assert records.stats()['entries'] == pages.stats()['entries'] == sets.stats()['entries'] == 0
+
+def test_listener_applies_notifications_in_batches(cached_frdr, mocker):
+    """Test pending notifications are applied together and then discarded"""
+    records, _, sets = cached_frdr
+    listener = frdr_notify.Listener('db', 'user', 'password', 'server', '5432')
+    con = mocker.Mock()
+    con.notifies = [mocker.Mock(payload=record_change('repo2', 'c')),
+                    mocker.Mock(payload=json.dumps({'table': 'repositories', 'set': 'repo2'}))]
+
+    listener.apply(con)
+
+    assert con.notifies == []
+    assert listener.counters['notifications'] == 2
+    assert records.stats()['entries'] == sets.stats()['entries'] == 0
+
+def test_listener_reconnects_when_the_store_fails(mocker):
+    """Test the listener keeps running, and reconnects, when invalidating fails"""
+    listener = frdr_notify.Listener('db', 'user', 'password', 'server', '5432', retry_seconds=0)
+    con = mocker.MagicMock(notifies=[mocker.Mock(payload=record_change('repo1', 'a'))])
+    mocker.patch('psycopg2.connect', return_value=con)
+    mocker.patch('select.select', return_value=([con], [], []))
+    clear = mocker.patch('viringo.cache.invalidate', side_effect=[
+        None, None, None, cache_stores.StoreError('down'), None, None, None])
+    con.poll.side_effect = lambda: listener.stop() if clear.call_count > 3 else None
+
+    listener.run()
+
+    assert listener.counters['connects'] == 2
+    assert con.close.call_count == 2
+    incremental.WATERMARKS.clear()
+
+def test_trigger_ddl():
+    """Test every table the FRDR queries read from gets a trigger on the channel"""
+    ddl = frdr_notify.trigger_ddl("frdr_changes")
+
+    assert "pg_notify('frdr_changes'" in ddl
+    for table in ['records', 'repositories'] + frdr_notify.RECORD_CHILD_TABLES + frdr_notify.SHARED_VALUE_TABLES:
+        assert 'ON %s;' % table in ddl
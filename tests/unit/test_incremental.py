@@ -0,0 +1,64 @@
+"""Unit tests for incremental harvest support"""
+
+from datetime import datetime
+
+from viringo import cache
+from viringo import incremental
+
+def test_high_water_mark(mocker):
+    """Test open ended windows close at the next granularity boundary"""
+    mocker.patch('viringo.config.INCREMENTAL_GRANULARITY', 60)
+
+    assert incremental.high_water_mark(datetime(2019, 5, 1, 10, 30, 15)) == datetime(2019, 5, 1, 10, 31)
+    assert incremental.high_water_mark(datetime(2019, 5, 1, 10, 30, 59, 500)) == datetime(2019, 5, 1, 10, 31)
+    assert incremental.high_water_mark(datetime(2019, 5, 1, 10, 31)) == datetime(2019, 5, 1, 10, 31)
+
+def test_freeze_window():
+    """Test only open ended from windows are closed"""
+    from_ = datetime(2019, 5, 1)
+    until = datetime(2019, 5, 2)
+
+    assert incremental.freeze_window({'from_': from_})['until'] >= datetime.utcnow()
+    assert incremental.freeze_window({'from_': from_, 'until': until})['until'] == until
+    assert 'until' not in incremental.freeze_window({'metadataPrefix': 'oai_dc'})
+
+def test_to_timestamp():
+    """Test datetimes are taken to be UTC whatever the local timezone"""
+    assert incremental.to_timestamp(datetime(1970, 1, 2)) == 86400
+
+def test_nothing_changed(mocker):
+    """Test the watermark answers incremental first pages and is remembered"""
+    mocker.patch('viringo.config.INCREMENTAL_WATERMARK_TTL', 60)
+    incremental.WATERMARKS.clear()
+    latest_change = mocker.Mock(return_value=datetime(2019, 5, 1))
+
+    assert incremental.nothing_changed('set', datetime(2019, 5, 2), None, latest_change)
+    assert not incremental.nothing_changed('set', datetime(2019, 4, 30), None, latest_change)
+    assert latest_change.call_count == 1
+
+    # Later pages and full harvests are never answered from the watermark
+    assert not incremental.nothing_changed('set', datetime(2019, 5, 2), '50', latest_change)
+    assert not incremental.nothing_changed('set', None, None, latest_change)
+
+def test_nothing_changed_disabled(mocker):
+    """Test the watermark is not looked up without a TTL"""
+    mocker.patch('viringo.config.INCREMENTAL_WATERMARK_TTL', 0)
+    latest_change = mocker.Mock(return_value=None)
+
+    assert not incremental.nothing_changed('set', datetime(2019, 5, 2), None, latest_change)
+    assert not latest_change.called
+
+def test_watermarks_are_shared_between_workers(mocker, tmp_path):
+    """Test a watermark forgotten by the change listener's process is forgotten for every worker"""
+    mocker.patch('viringo.config.INCREMENTAL_WATERMARK_TTL', 60)
+    mocker.patch('viringo.config.CACHE_BACKEND', 'shared')
+    mocker.patch('viringo.config.CACHE_SHARED_PATH', str(tmp_path / 'cache'))
+    worker, listener = incremental.Watermarks(), incremental.Watermarks()
+    try:
+        assert worker.latest('set', lambda: datetime(2019, 5, 1)) == datetime(2019, 5, 1)
+        assert listener.latest('set', lambda: datetime(2019, 5, 2)) == datetime(2019, 5, 1)
+
+        listener.forget('set')
+        assert worker.latest('set', lambda: datetime(2019, 5, 2)) == datetime(2019, 5, 2)
+    finally:
+        cache.reset()
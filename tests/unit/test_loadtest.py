@@ -0,0 +1,47 @@
+"""Unit tests for the load testing stand-in DataCite API"""
+
+from datetime import datetime
+from loadtest import datacite_stub
+
+def test_synthetic_catalog_filters():
+    """Test counts and pages of the synthetic catalogue agree with each other"""
+
+    catalog = datacite_stub.SyntheticCatalog(1000, providers=2, clients_per_provider=3)
+
+    residues = catalog.residues(client_id='stub1.repo4')
+    low, high = catalog.number_range()
+    numbers = catalog.page(residues, low, high, -1, 1000)
+    assert catalog.count(residues, low, high) == len(numbers)
+    assert all(catalog.doi_json(number)['relationships']['client']['data']['id'] == 'stub1.repo4'
+               for number in numbers)
+
+    residues = catalog.residues(provider_id='STUB0')
+    low, high = catalog.number_range(catalog.updated(100), catalog.updated(199))
+    numbers = catalog.page(residues, low, high, -1, 1000)
+    assert catalog.count(residues, low, high) == len(numbers) == 50
+    assert numbers[0] == 102 and numbers[-1] == 199
+
+def test_list_dois_cursor_paging():
+    """Test walking /dois with cursors returns every record once"""
+
+    catalog = datacite_stub.SyntheticCatalog(95)
+    client = datacite_stub.create_stub_app(catalog).test_client()
+
+    seen = []
+    url = '/dois?detail=true&page[size]=20&page[cursor]=1'
+    while url:
+        json = client.get(url).get_json()
+        assert json['meta']['total'] == 95
+        seen.extend(entry['id'] for entry in json['data'])
+        url = json['links'].get('next')
+
+    assert seen == [catalog.doi(number) for number in range(95)]
+
+def test_parse_updated_query():
+    """Test the updated window viringo sends is understood"""
+
+    from_datetime, until_datetime = datacite_stub.parse_updated_query(
+        'updated:[2019-01-01T00:00:00 TO 2019-02-01T00:00:00]'
+    )
+    assert from_datetime == datetime(2019, 1, 1)
+    assert until_datetime == datetime(2019, 2, 1)
@@ -0,0 +1,47 @@
+"""Unit tests for the page sizes of list harvests"""
+
+from viringo import pagesize
+
+def test_most_specific_size_applies(mocker):
+    """Test the configured entry matching the most parts sets the size, RESULT_SET_SIZE otherwise"""
+    mocker.patch('viringo.config.RESULT_SET_SIZE', 50)
+    mocker.patch('viringo.config.PAGE_SIZES',
+                 'ListIdentifiers=500, ListRecords:datacite=25, ListRecords:*:frdr=40, ListRecords:datacite:frdr=20')
+
+    assert pagesize.static_size('ListIdentifiers', 'oai_dc', 'datacite') == 500
+    assert pagesize.static_size('ListRecords', 'datacite', 'datacite') == 25
+    assert pagesize.static_size('ListRecords', 'oai_dc', 'frdr') == 40
+    assert pagesize.static_size('ListRecords', 'datacite', 'frdr') == 20
+    assert pagesize.static_size('ListRecords', 'oai_dc', 'datacite') == 50
+
+def test_malformed_sizes_are_ignored(mocker):
+    """Test malformed entries leave their pages at the next best size rather than failing every list request"""
+    mocker.patch('viringo.config.RESULT_SET_SIZE', 50)
+    mocker.patch('viringo.config.PAGE_SIZES',
+                 'ListIdentifiers=many, ListRecords=0, ListRecords:a:b:c=5, ListRecords, ListRecords:datacite=25')
+
+    assert pagesize.static_size('ListIdentifiers', 'oai_dc', 'datacite') == 50
+    assert pagesize.static_size('ListRecords', 'oai_dc', 'datacite') == 50
+    assert pagesize.static_size('ListRecords', 'datacite', 'datacite') == 25
+
+def test_adaptive_size_fits_the_targets(mocker):
+    """Test new harvests are sized from the learnt cost of a record, within the bounds"""
+    mocker.patch('viringo.config.PAGE_SIZES', '')
+    mocker.patch('viringo.config.RESULT_SET_SIZE', 50)
+    mocker.patch('viringo.config.PAGE_SIZE_ADAPTIVE', True)
+    mocker.patch('viringo.config.PAGE_TARGET_BYTES', 100000)
+    mocker.patch('viringo.config.PAGE_TARGET_SECONDS', 2)
+    mocker.patch('viringo.config.PAGE_SIZE_MAX', 1000)
+
+    # Not trusted until a few pages were seen
+    pagesize.observe('ListRecords', 'oai_dc', 50, 50 * 1000, 0.5)
+    assert pagesize.choose('ListRecords', 'oai_dc') == 50
+    for _ in range(pagesize.MIN_PAGES):
+        pagesize.observe('ListRecords', 'oai_dc', 50, 50 * 1000, 0.5)
+    # 1000 bytes a record fits 100 in the bytes target, 0.01s a record 200 in the time target
+    assert pagesize.choose('ListRecords', 'oai_dc') == 100
+
+    for _ in range(pagesize.MIN_PAGES):
+        pagesize.observe('ListIdentifiers', 'oai_dc', 50, 50 * 10, 0.001)
+    assert pagesize.choose('ListIdentifiers', 'oai_dc') == 1000
+    assert pagesize.stats()['ListIdentifiers:oai_dc:datacite']['page_size'] == 1000
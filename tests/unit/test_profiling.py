@@ -0,0 +1,37 @@
+"""Unit tests for on-demand request profiling"""
+
+import os
+from viringo import config
+from viringo import profiling
+
+def test_profiling_requested(monkeypatch):
+    """Test profiling is only enabled with the right secret or the env flag"""
+
+    monkeypatch.setattr(config, 'PROFILE_SECRET', '')
+    monkeypatch.setattr(config, 'PROFILE_ALL_REQUESTS', False)
+    assert not profiling.profiling_requested({profiling.PROFILE_HEADER: ''})
+
+    monkeypatch.setattr(config, 'PROFILE_SECRET', 'sekret')
+    assert not profiling.profiling_requested({})
+    assert not profiling.profiling_requested({profiling.PROFILE_HEADER: 'wrong'})
+    assert not profiling.profiling_requested({profiling.PROFILE_HEADER: 'sékret'})
+    assert profiling.profiling_requested({profiling.PROFILE_HEADER: 'sekret'})
+
+    monkeypatch.setattr(config, 'PROFILE_SECRET', '')
+    monkeypatch.setattr(config, 'PROFILE_ALL_REQUESTS', True)
+    assert profiling.profiling_requested({})
+
+def test_request_profile_saves_report(tmpdir):
+    """Test a profile run returns the result and writes the profile files"""
+
+    profile = profiling.RequestProfile({'verb': 'Identify'}, output_dir=str(tmpdir))
+    result = profile.run(sorted, [3, 1, 2])
+
+    assert result == [1, 2, 3]
+    assert os.path.exists(os.path.join(str(tmpdir), profile.profile_id + '.prof'))
+
+    with open(os.path.join(str(tmpdir), profile.profile_id + '.txt')) as report_file:
+        report = report_file.read()
+
+    assert 'Top functions by cumulative time' in report
+    assert 'Identify' in report
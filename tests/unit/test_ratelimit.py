@@ -0,0 +1,87 @@
+"""Unit tests for the per-client rate limits"""
+
+import pytest
+
+from viringo import cache_stores
+from viringo import ratelimit
+
+def test_token_bucket_refills_at_the_rate(mocker):
+    """Test a client gets its burst at once and then tokens at the configured rate"""
+    mocker.patch('viringo.config.RATE_LIMIT_EXPENSIVE_RATE', 0.5)
+    mocker.patch('viringo.config.RATE_LIMIT_EXPENSIVE_BURST', 2)
+    store = cache_stores.LocalStore(16)
+
+    assert ratelimit.take_token(store, 'a', ratelimit.EXPENSIVE, now=100) == 0
+    assert ratelimit.take_token(store, 'a', ratelimit.EXPENSIVE, now=100) == 0
+    assert ratelimit.take_token(store, 'a', ratelimit.EXPENSIVE, now=100) == 2
+    # Other clients and lanes have their own buckets
+    assert ratelimit.take_token(store, 'b', ratelimit.EXPENSIVE, now=100) == 0
+    assert ratelimit.take_token(store, 'a', ratelimit.CHEAP, now=100) == 0
+
+    assert ratelimit.take_token(store, 'a', ratelimit.EXPENSIVE, now=101) == 1
+    assert ratelimit.take_token(store, 'a', ratelimit.EXPENSIVE, now=102) == 0
+
+def test_places_are_all_or_nothing_and_expire(mocker):
+    """Test a request only holds places when it got all of them, and leases of dead workers expire"""
+    mocker.patch('viringo.config.RATE_LIMIT_LEASE_SECONDS', 60)
+    store = cache_stores.LocalStore(16)
+    places = [('client', 2), ('lane', 1)]
+
+    assert ratelimit.acquire_places(store, places, 'first', now=100)
+    assert not ratelimit.acquire_places(store, places, 'second', now=100)
+    assert store.get('ratelimit', 'client') == {'first': 160}
+
+    assert ratelimit.acquire_places(store, places, 'third', now=161)
+    ratelimit.Lease(store, ['client', 'lane'], 'third').release()
+    assert store.get('ratelimit', 'lane') == {}
+
+def test_client_is_a_known_token_or_the_address(mocker):
+    """Test only tokens given out tell clients apart, others and user agents don't"""
+    mocker.patch('viringo.config.RATE_LIMIT_TOKENS', 'first, second')
+
+    assert ratelimit.client_of({'X-Harvester-Token': 'second'}, '10.0.0.1') == 'token:second'
+    assert ratelimit.client_of({'X-Harvester-Token': 'made up'}, '10.0.0.1') == 'address:10.0.0.1'
+    assert ratelimit.client_of({'X-Harvester-Token': 'sécond'}, '10.0.0.1') == 'address:10.0.0.1'
+    assert ratelimit.client_of({'User-Agent': 'harvester 2'}, '10.0.0.1') == 'address:10.0.0.1'
+
+def test_admit_raises_with_retry_after(mocker):
+    """Test requests over a limit are refused with a Retry-After and leases free places again"""
+    mocker.patch('viringo.config.RATE_LIMIT_CHEAP_RATE', 0)
+    mocker.patch('viringo.config.RATE_LIMIT_EXPENSIVE_RATE', 0)
+    mocker.patch('viringo.config.RATE_LIMIT_CLIENT_CONCURRENCY', 1)
+    mocker.patch('viringo.config.RATE_LIMIT_TOKENS', 'other')
+    headers = {'User-Agent': 'harvester'}
+
+    lease = ratelimit.admit('ListRecords', headers, '10.0.0.1')
+    with pytest.raises(ratelimit.RateLimited) as raised:
+        ratelimit.admit('ListRecords', headers, '10.0.0.1')
+    assert raised.value.retry_after == ratelimit.BUSY_RETRY_AFTER
+
+    # Cheap requests and other clients have their own places
+    ratelimit.admit('GetRecord', headers, '10.0.0.1').release()
+    ratelimit.admit('ListRecords', {'X-Harvester-Token': 'other'}, '10.0.0.1').release()
+
+    lease.release()
+    ratelimit.admit('ListRecords', headers, '10.0.0.1').release()
+    assert ratelimit.stats()['busy'] == 1
+
+def test_unavailable_store_lets_requests_through(mocker):
+    """Test the limits fail open when their store can't be reached"""
+    store = mocker.Mock()
+    store.update.side_effect = cache_stores.StoreError('down')
+    mocker.patch('viringo.ratelimit.get_store', return_value=store)
+
+    ratelimit.admit('ListRecords', {}, '10.0.0.1').release()
+    assert ratelimit.stats()['store_errors'] == 1
+
+def test_colliding_clients_keep_each_others_buckets(mocker, tmp_path):
+    """Test a client whose slot is taken is let through rather than resetting the other client's bucket"""
+    mocker.patch('viringo.config.RATE_LIMIT_EXPENSIVE_RATE', 0.5)
+    mocker.patch('viringo.config.RATE_LIMIT_EXPENSIVE_BURST', 1)
+    store = cache_stores.SharedStore(str(tmp_path / 'ratelimit'), 1, 4096, ways=1)
+
+    assert ratelimit.take_token(store, 'a', ratelimit.EXPENSIVE) == 0
+    with pytest.raises(cache_stores.StoreError):
+        ratelimit.take_token(store, 'b', ratelimit.EXPENSIVE)
+    assert ratelimit.take_token(store, 'a', ratelimit.EXPENSIVE) > 0
+    store.close()
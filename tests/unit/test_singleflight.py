@@ -0,0 +1,63 @@
+"""Unit tests for coalescing concurrent backend fetches"""
+
+import threading
+import time
+
+import pytest
+
+from viringo import singleflight
+
+def test_concurrent_calls_share_one_fetch():
+    """Test callers with the same key wait for the fetch in flight"""
+    group = singleflight.SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    fetches = []
+
+    def fetch():
+        fetches.append(1)
+        started.set()
+        release.wait(5)
+        return ['page']
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(group.do('get', 'key', fetch)))
+    leader.start()
+    started.wait(5)
+    followers = [
+        threading.Thread(target=lambda: results.append(group.do('get', 'key', fetch)))
+        for _ in range(3)
+    ]
+    for follower in followers:
+        follower.start()
+
+    # Wait for every follower to be counted before the fetch completes
+    while group.stats()['get']['calls'] < 4:
+        time.sleep(0.001)
+    release.set()
+    for thread in [leader] + followers:
+        thread.join(5)
+
+    assert len(fetches) == 1
+    assert results == [['page']] * 4
+    assert group.stats() == {'get': {'calls': 4, 'fetches': 1, 'coalesced': 3}}
+
+def test_errors_are_shared_and_not_remembered():
+    """Test a failed fetch raises for its callers and the next call fetches again"""
+    group = singleflight.SingleFlight()
+
+    def fail():
+        raise ValueError('backend down')
+
+    with pytest.raises(ValueError):
+        group.do('get', 'key', fail)
+
+    assert group.do('get', 'key', lambda: 'ok') == 'ok'
+    assert group.stats()['get']['fetches'] == 2
+
+def test_coalesce_unhashable_arguments(mocker):
+    """Test calls with arguments that can't be keyed are passed straight through"""
+    mocker.patch('viringo.config.SINGLEFLIGHT_ENABLED', True)
+    fetch = singleflight.coalesce(lambda values: len(values))
+
+    assert fetch([1, 2, 3]) == 3
@@ -0,0 +1,49 @@
+"""Tests for answering full harvests from snapshots"""
+
+import os
+
+from viringo import snapshots
+
+
+def write_snapshot(directory, snapshot_id):
+    """Write a snapshot of one page of oai_dc records"""
+    os.makedirs(os.path.join(directory, snapshot_id, 'oai_dc', '_all'))
+    open(os.path.join(directory, snapshot_id, 'oai_dc', '_all', '0.xml.gz'), 'wb').close()
+    snapshots.write_json(os.path.join(directory, snapshot_id, 'manifest.json'), {
+        'snapshot': snapshot_id,
+        'partitions': [{'metadataPrefix': 'oai_dc', 'set': None, 'pages': 1, 'records': 1}]
+    })
+    snapshots.write_json(os.path.join(directory, snapshots.CURRENT), {'snapshot': snapshot_id})
+
+
+def test_page_for_request(mocker, tmp_path):
+    """Test only full harvests and snapshot tokens are answered from the current snapshot"""
+    mocker.patch('viringo.config.SNAPSHOT_DIR', str(tmp_path))
+    write_snapshot(str(tmp_path), '20200101T000000')
+    first_page = os.path.join(str(tmp_path), '20200101T000000/oai_dc/_all/0.xml.gz')
+
+    assert snapshots.page_for_request({'verb': 'ListRecords', 'metadataPrefix': 'oai_dc'}) == first_page
+    assert snapshots.page_for_request(
+        {'verb': 'ListRecords', 'resumptionToken': 'snapshot:20200101T000000/oai_dc/_all/0'}) == first_page
+
+    for request_args in [
+            {'verb': 'ListIdentifiers', 'metadataPrefix': 'oai_dc'},
+            {'verb': 'ListRecords', 'metadataPrefix': 'oai_datacite'},
+            {'verb': 'ListRecords', 'metadataPrefix': 'oai_dc', 'set': 'DATACITE'},
+            {'verb': 'ListRecords', 'metadataPrefix': 'oai_dc', 'from': '2020-01-01'},
+            {'verb': 'ListRecords', 'resumptionToken': 'snapshot:20200101T000000/oai_dc/_all/1'},
+            {'verb': 'ListRecords', 'resumptionToken': 'snapshot:../../etc/passwd'},
+            {'verb': 'ListRecords', 'resumptionToken': 'paging_cursor%3D2'}
+        ]:
+        assert snapshots.page_for_request(request_args) is None
+
+
+def test_prune(mocker, tmp_path):
+    """Test only the newest snapshots are kept"""
+    mocker.patch('viringo.config.SNAPSHOT_KEEP', 2)
+    for snapshot_id in ['20200101T000000', '20200102T000000', '20200103T000000']:
+        write_snapshot(str(tmp_path), snapshot_id)
+
+    snapshots.prune(str(tmp_path))
+
+    assert sorted(os.listdir(str(tmp_path))) == ['20200102T000000', '20200103T000000', snapshots.CURRENT]
@@ -1,16 +1,26 @@
 """OAI-PMH http server repository implementation"""
+import hmac
 import os
-from flask import Flask, Response, redirect, url_for
+from flask import Flask, Response, jsonify, redirect, request, url_for
 import sentry_sdk
 from sentry_sdk.integrations.flask import FlaskIntegration
 
+from . import admission
+from . import cache
+from . import circuit
 from . import config
+from . import pagesize
+from . import ratelimit
+from . import singleflight
 
 sentry_sdk.init(
     dsn=config.SENTRY_DSN,
     integrations=[FlaskIntegration()]
 )
 
+# Header an admin sends STATS_SECRET in to read /stats
+STATS_HEADER = 'X-Viringo-Stats'
+
 class DefaultResponse(Response):
     """Handles default responses for the OAI-PMH responses"""
     default_mimetype = 'application/xml'
@@ -38,6 +48,10 @@ def create_app(test_config=None):
     from viringo import oai
     app.register_blueprint(oai.BP, url_prefix="/oai")
 
+    # Register management commands
+    from viringo import commands
+    commands.register_commands(app)
+
     @app.route('/')
     def index():
         return redirect(url_for('oai.index'))
@@ -51,6 +65,25 @@ def create_app(test_config=None):
                         mimetype="text/plain")
         return resp
 
+    # Register counters of the request handling layers, for admins only
+    @app.route('/stats')
+    def stats():
+        """Counters of this worker process"""
+        if not config.STATS_SECRET:
+            return Response('Not found\n', status=404, mimetype='text/plain')
+        # Constant time comparison as this is an admin secret, of bytes as str only compares ASCII
+        supplied = request.headers.get(STATS_HEADER, '').encode('utf-8')
+        if not hmac.compare_digest(supplied, config.STATS_SECRET.encode('utf-8')):
+            return Response('Forbidden\n', status=403, mimetype='text/plain')
+        return jsonify({
+            'singleflight': singleflight.stats(),
+            'circuits': circuit.stats(),
+            'caches': cache.stats(),
+            'ratelimit': ratelimit.stats(),
+            'admission': admission.stats(),
+            'pagesize': pagesize.stats()
+        })
+
     # We want to use a custom response object for default content types
     app.response_class = DefaultResponse
 
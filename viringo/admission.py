@@ -0,0 +1,193 @@
+"""Admission control, shedding expensive requests early when the service is saturated
+
+Each worker process keeps three load signals:
+
+* requests in flight in the process, against ADMISSION_MAX_IN_FLIGHT;
+* how long requests queued before a worker picked them up, from the
+  X-Request-Start header the proxy in front sets, against
+  ADMISSION_MAX_QUEUE_WAIT_SECONDS;
+* backend call latency, of DataCite API calls and FRDR statements, against
+  ADMISSION_MAX_BACKEND_LATENCY_SECONDS.
+
+Queue wait and latency are moving averages that decay while nothing is
+observed, so shedding stops once the backends are no longer called. The
+pressure is the highest signal relative to its limit. Requests are shed with
+a 503 and Retry-After as it rises: new list harvests from a pressure of 1,
+resumed list pages from 1.5 so harvests under way can finish, and cheap
+verbs only from 2. Harvesters wait and retry rather than every request
+running into gunicorn's timeout.
+"""
+
+import math
+import threading
+import time
+
+from viringo import config
+
+# Pressure from which each kind of request is shed
+NEW_LIST_PRESSURE = 1.0
+RESUMED_LIST_PRESSURE = 1.5
+CHEAP_PRESSURE = 2.0
+LIST_VERBS = ('ListRecords', 'ListIdentifiers')
+# Weight of a new observation in the moving averages
+SMOOTHING = 0.2
+# Seconds over which an average halves while nothing is observed
+HALF_LIFE_SECONDS = 10.0
+
+
+class Overloaded(Exception):
+    """The service is too busy for a request, answered with a 503 and Retry-After"""
+
+    def __init__(self, message, retry_after):
+        super(Overloaded, self).__init__(message)
+        self.retry_after = retry_after
+
+
+class DecayingAverage:
+    """An exponentially weighted moving average that decays towards 0 over time"""
+
+    def __init__(self):
+        self.value = 0.0
+        self.updated = None
+        self._lock = threading.Lock()
+
+    def _decayed(self, now):
+        if self.updated is None:
+            return 0.0
+        return self.value * 0.5 ** (max(0.0, now - self.updated) / HALF_LIFE_SECONDS)
+
+    def observe(self, sample, now=None):
+        """Add an observation"""
+        now = now or time.monotonic()
+        with self._lock:
+            self.value = (1 - SMOOTHING) * self._decayed(now) + SMOOTHING * sample
+            self.updated = now
+
+    def get(self, now=None):
+        """The average as of now"""
+        with self._lock:
+            return self._decayed(now or time.monotonic())
+
+
+_in_flight = 0
+_in_flight_lock = threading.Lock()
+QUEUE_WAIT = DecayingAverage()
+BACKEND_LATENCY = {}
+_latency_lock = threading.Lock()
+COUNTERS = {'admitted': 0, 'shed': 0}
+
+
+def observe_backend(name, seconds):
+    """Record how long a backend call took"""
+    with _latency_lock:
+        average = BACKEND_LATENCY.get(name)
+        if average is None:
+            average = BACKEND_LATENCY[name] = DecayingAverage()
+    average.observe(seconds)
+
+
+def queue_wait(headers, now=None):
+    """Seconds the request waited since the proxy received it, None without X-Request-Start
+
+    The header is t= followed by seconds, milliseconds or microseconds since
+    the epoch, as nginx and the common hosting routers send it.
+    """
+    value = headers.get('X-Request-Start')
+    if not value:
+        return None
+    try:
+        started = float(value.strip().lstrip('t='))
+    except ValueError:
+        return None
+    if started > 1e14:
+        started /= 1e6
+    elif started > 1e11:
+        started /= 1e3
+    return max(0.0, (now or time.time()) - started)
+
+
+def pressure():
+    """The highest load signal relative to its limit, under 1 while there is capacity"""
+    signals = []
+    if config.ADMISSION_MAX_IN_FLIGHT > 0:
+        signals.append(_in_flight / config.ADMISSION_MAX_IN_FLIGHT)
+    if config.ADMISSION_MAX_QUEUE_WAIT_SECONDS > 0:
+        signals.append(QUEUE_WAIT.get() / config.ADMISSION_MAX_QUEUE_WAIT_SECONDS)
+    if config.ADMISSION_MAX_BACKEND_LATENCY_SECONDS > 0:
+        with _latency_lock:
+            averages = list(BACKEND_LATENCY.values())
+        signals.extend(average.get() / config.ADMISSION_MAX_BACKEND_LATENCY_SECONDS for average in averages)
+    return max(signals or [0.0])
+
+
+def shed_from(verb, resumed):
+    """The pressure from which a request is shed"""
+    if verb is None or verb in LIST_VERBS:
+        return RESUMED_LIST_PRESSURE if resumed else NEW_LIST_PRESSURE
+    return CHEAP_PRESSURE
+
+
+class Ticket:
+    """A request counted in flight until released"""
+
+    def __init__(self):
+        self._released = False
+
+    def release(self):
+        """Stop counting the request, once however often called"""
+        global _in_flight
+        if self._released:
+            return
+        self._released = True
+        with _in_flight_lock:
+            _in_flight = max(0, _in_flight - 1)
+
+
+def admit(verb, resumed, headers):
+    """Admit a request or raise Overloaded, returning the Ticket to release once it is answered
+
+    verb is None for the bulk endpoints, which are shed like new list harvests.
+    """
+    global _in_flight
+    wait = queue_wait(headers)
+    if wait is not None:
+        QUEUE_WAIT.observe(wait)
+
+    current = pressure()
+    if current >= shed_from(verb, resumed):
+        with _in_flight_lock:
+            COUNTERS['shed'] += 1
+        # Busier means longer before a retry is likely to be admitted
+        retry_after = min(6 * config.ADMISSION_RETRY_AFTER_SECONDS,
+                          int(math.ceil(config.ADMISSION_RETRY_AFTER_SECONDS * current)))
+        raise Overloaded('Shedding %s at pressure %.2f' % (verb or 'bulk request', current), max(1, retry_after))
+
+    with _in_flight_lock:
+        _in_flight += 1
+        COUNTERS['admitted'] += 1
+    return Ticket()
+
+
+def stats():
+    """Load signals and counters of this worker process"""
+    with _latency_lock:
+        latencies = {name: round(average.get(), 3) for name, average in BACKEND_LATENCY.items()}
+    with _in_flight_lock:
+        stats = dict(COUNTERS)
+        stats['in_flight'] = _in_flight
+    stats['queue_wait'] = round(QUEUE_WAIT.get(), 3)
+    stats['backend_latency'] = latencies
+    stats['pressure'] = round(pressure(), 3)
+    return stats
+
+
+def reset():
+    """Forget the load signals, e.g. between tests"""
+    global QUEUE_WAIT, _in_flight
+    with _latency_lock:
+        BACKEND_LATENCY.clear()
+    with _in_flight_lock:
+        _in_flight = 0
+        for counter in COUNTERS:
+            COUNTERS[counter] = 0
+    QUEUE_WAIT = DecayingAverage()
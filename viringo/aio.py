@@ -0,0 +1,228 @@
+"""Asynchronous backend I/O for workers running under the ASGI entry point
+
+viringo.asgi serves the Flask application with ASGIAdapter. pyoai and the
+Flask views are synchronous, so requests are still handled in a pool of
+ASGI_THREADS threads, but the backend calls they make are run as coroutines on
+the server's event loop: DataCite calls share one httpx client and FRDR
+queries one asyncpg pool, see viringo.services.datacite_async and
+viringo.services.frdr_async. A thread waiting on the loop holds no connection,
+so one worker serves many concurrent harvesters, and the lookups of a record
+run concurrently.
+
+Functions decorated with delegate do this while the loop runs and
+ASYNC_SERVICES is set, and run as before under WSGI.
+"""
+
+import asyncio
+import functools
+import importlib
+import io
+import logging
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from viringo import config
+from viringo import deadline
+
+# Modules of the asynchronous services, closed on shutdown
+SERVICE_MODULES = ('viringo.services.datacite_async', 'viringo.services.frdr_async')
+
+_loop = None
+_loop_thread = None
+
+
+def start(loop):
+    """Run the delegated backend calls on loop from now on"""
+    global _loop, _loop_thread
+    _loop = loop
+    _loop_thread = threading.get_ident()
+
+
+def running():
+    """Whether backend calls are delegated to the event loop"""
+    return _loop is not None and config.ASYNC_SERVICES
+
+
+async def stop():
+    """Close the asynchronous clients and pools, and stop delegating"""
+    global _loop, _loop_thread
+    _loop = None
+    _loop_thread = None
+    for name in SERVICE_MODULES:
+        # Only the services that were used are loaded
+        module = sys.modules.get(name)
+        if module is not None:
+            await module.close()
+
+
+async def _within(request_deadline, coroutine):
+    """Await the coroutine with the caller's deadline current"""
+    with deadline.activate(request_deadline):
+        return await coroutine
+
+
+def run(coroutine):
+    """Run a coroutine on the event loop and wait for its result, from any thread but the loop's"""
+    if threading.get_ident() == _loop_thread:
+        coroutine.close()
+        raise RuntimeError('Blocking on the event loop from its own thread')
+    future = asyncio.run_coroutine_threadsafe(_within(deadline.current(), coroutine), _loop)
+    return future.result()
+
+
+def delegate(module_name):
+    """Run a function as the coroutine function of the same name in module_name while the loop runs"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not running():
+                return func(*args, **kwargs)
+            module = importlib.import_module(module_name)
+            return run(getattr(module, func.__name__)(*args, **kwargs))
+        return wrapper
+    return decorator
+
+
+def wsgi_environ(scope, body):
+    """The WSGI environ of an ASGI http scope"""
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': scope['client'][0] if scope.get('client') else '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        # The whole body has been read, with or without a Content-Length
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        environ[name] = environ[name] + ',' + value if name in environ else value
+    return environ
+
+
+class ASGIAdapter:
+    """An ASGI application handling requests with a WSGI application in a thread pool
+
+    Response chunks are passed to the event loop a few at a time, so a slow
+    client holds up the thread producing its response rather than filling
+    memory.
+    """
+
+    def __init__(self, wsgi_app, threads=None):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(max_workers=threads or config.ASGI_THREADS,
+                                           thread_name_prefix='viringo-asgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.http(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        """Start and stop delegating with the server"""
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                start(asyncio.get_running_loop())
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await stop()
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def http(self, scope, receive, send):
+        """Answer an http request"""
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+
+        loop = asyncio.get_running_loop()
+        messages = asyncio.Queue(maxsize=8)
+        disconnected = threading.Event()
+
+        def put(message):
+            asyncio.run_coroutine_threadsafe(messages.put(message), loop).result()
+
+        self.executor.submit(self.run_wsgi, wsgi_environ(scope, body), put, disconnected)
+
+        started = False
+        while True:
+            kind, value = await messages.get()
+            if kind == 'done':
+                return
+            if disconnected.is_set():
+                # Let the thread finish without sending anything more
+                continue
+            try:
+                if kind == 'start':
+                    status, headers = value
+                    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+                    started = True
+                elif kind == 'body':
+                    await send({'type': 'http.response.body', 'body': value, 'more_body': True})
+                elif kind == 'end':
+                    await send({'type': 'http.response.body', 'body': b''})
+                elif kind == 'error' and not started:
+                    await send({'type': 'http.response.start', 'status': 500,
+                                'headers': [(b'content-type', b'text/plain')]})
+                    await send({'type': 'http.response.body', 'body': b'Internal Server Error\n'})
+            except OSError:
+                disconnected.set()
+
+    def run_wsgi(self, environ, put, disconnected):
+        """Run the WSGI application in a pool thread, putting its response messages"""
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['start'] = (int(status.split(' ', 1)[0]),
+                                 [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                  for name, value in headers])
+
+            def write(chunk):
+                send_start()
+                put(('body', chunk))
+            return write
+
+        def send_start():
+            if 'start' in response:
+                put(('start', response.pop('start')))
+
+        try:
+            result = self.wsgi_app(environ, start_response)
+            try:
+                for chunk in result:
+                    if disconnected.is_set():
+                        break
+                    send_start()
+                    if chunk:
+                        put(('body', chunk))
+                send_start()
+                put(('end', None))
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        except Exception as err:
+            logging.exception("Error answering a request")
+            put(('error', err))
+        finally:
+            put(('done', None))
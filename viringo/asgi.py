@@ -0,0 +1,6 @@
+"""Script for running the ASGI process, e.g. gunicorn -k uvicorn.workers.UvicornWorker viringo.asgi"""
+
+from viringo import aio
+from viringo.wsgi import application as wsgi_application
+
+application = aio.ASGIAdapter(wsgi_application)
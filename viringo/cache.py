@@ -0,0 +1,238 @@
+"""Stale-while-revalidate caching of backend results
+
+A cached value is served as is while fresh. Once it is older than the fresh
+period but still within the stale period it is served straight away while a
+background thread fetches a replacement. When a fetch fails because the backend
+is unavailable, any cached value however old is served rather than failing.
+
+Values are kept in the store picked by CACHE_BACKEND, see viringo.cache_stores.
+"""
+
+import functools
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from viringo import cache_stores
+from viringo import circuit
+from viringo import config
+
+
+class _Entry:
+    """A cached value and when it was fetched"""
+
+    def __init__(self, value):
+        self.value = value
+        # Wall clock time, as entries in shared stores are read by other processes
+        self.fetched_at = time.time()
+
+    def age(self):
+        """Seconds since the value was fetched"""
+        return time.time() - self.fetched_at
+
+
+class StaleWhileRevalidateCache:
+    """A cache serving stale values while they are refreshed, in a process private LRU unless given a store"""
+
+    def __init__(self, name, max_entries, fresh_seconds, stale_seconds, store=None):
+        self.name = name
+        self.store = store or cache_stores.LocalStore(max_entries)
+        self.fresh_seconds = fresh_seconds
+        self.stale_seconds = stale_seconds
+        self.counters = {'hits': 0, 'stale_hits': 0, 'misses': 0, 'refreshes': 0,
+                         'refresh_failures': 0, 'served_stale_on_error': 0, 'store_errors': 0}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def _count(self, counter):
+        with self._lock:
+            self.counters[counter] += 1
+
+    def namespace(self, partition=None):
+        """The store namespace of a partition of the cache, see viringo.cache_stores"""
+        if partition is None:
+            return self.name
+        return '%s/%s' % (self.name, partition)
+
+    def _lookup(self, key, partition):
+        try:
+            return self.store.get(self.namespace(partition), key)
+        except cache_stores.StoreError:
+            # Without the store every lookup is a miss, but requests are still answered
+            self._count('store_errors')
+            logging.warning("Cache store of %s unavailable", self.name, exc_info=True)
+            return None
+
+    def set(self, key, value, partition=None):
+        """Store a freshly fetched value"""
+        try:
+            self.store.set(self.namespace(partition), key, _Entry(value))
+        except cache_stores.StoreError:
+            self._count('store_errors')
+            logging.warning("Cache store of %s unavailable", self.name, exc_info=True)
+
+    def delete(self, key, partition=None):
+        """Drop the cached value of key"""
+        self.store.delete(self.namespace(partition), key)
+
+    def clear(self, partition=None):
+        """Drop the cached values of a partition, or every cached value"""
+        self.store.clear(self.namespace(partition))
+
+    def _refresh(self, key, fetch, partition):
+        try:
+            self.set(key, fetch(), partition)
+            self._count('refreshes')
+        except Exception:
+            self._count('refresh_failures')
+            logging.warning("Background refresh of %s failed", self.name, exc_info=True)
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def _refresh_in_background(self, key, fetch, partition):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+        get_refresh_executor().submit(self._refresh, key, fetch, partition)
+
+    def get(self, key, fetch, partition=None):
+        """Return the value for key, calling fetch when there is no usable cached value"""
+        entry = self._lookup(key, partition)
+        if entry is not None:
+            age = entry.age()
+            if age < self.fresh_seconds:
+                self._count('hits')
+                return entry.value
+            if age < self.fresh_seconds + self.stale_seconds:
+                self._count('stale_hits')
+                self._refresh_in_background(key, fetch, partition)
+                return entry.value
+
+        self._count('misses')
+        try:
+            value = fetch()
+        except circuit.BackendUnavailable:
+            if entry is None:
+                raise
+            # Out of date is better than nothing while the backend is down
+            self._count('served_stale_on_error')
+            return entry.value
+        self.set(key, value, partition)
+        return value
+
+    def stats(self):
+        """Size and counters of the cache and its store"""
+        with self._lock:
+            stats = dict(self.counters)
+        store_stats = self.store.stats()
+        stats['entries'] = store_stats['entries']
+        stats['evictions'] = store_stats['evictions']
+        stats['backend'] = store_stats['backend']
+        return stats
+
+
+_refresh_executor = None
+_refresh_lock = threading.Lock()
+
+
+def get_refresh_executor():
+    """The threads background refreshes run on"""
+    global _refresh_executor
+    with _refresh_lock:
+        if _refresh_executor is None:
+            _refresh_executor = ThreadPoolExecutor(
+                max_workers=config.CACHE_REFRESH_WORKERS, thread_name_prefix='viringo-refresh')
+        return _refresh_executor
+
+
+_caches = {}
+_shared_store = None
+_caches_lock = threading.Lock()
+
+
+def get_store():
+    """The store every cache shares when CACHE_BACKEND is shared or redis, None for local"""
+    global _shared_store
+    if config.CACHE_BACKEND not in ('shared', 'redis'):
+        return None
+    if _shared_store is None:
+        _shared_store = cache_stores.create_store(
+            config.CACHE_BACKEND,
+            config.CACHE_MAX_ENTRIES,
+            config.CACHE_SHARED_PATH,
+            config.CACHE_SHARED_SLOTS,
+            config.CACHE_SHARED_SLOT_BYTES,
+            config.CACHE_REDIS_URL,
+            config.CACHE_REDIS_TIMEOUT
+        )
+    return _shared_store
+
+
+def get_cache(name):
+    """Return the named cache, creating it with the configured sizes on first use"""
+    with _caches_lock:
+        if name not in _caches:
+            _caches[name] = StaleWhileRevalidateCache(
+                name, config.CACHE_MAX_ENTRIES, config.CACHE_FRESH_SECONDS, config.CACHE_STALE_SECONDS,
+                store=get_store())
+        return _caches[name]
+
+
+def caching_enabled():
+    """Whether CACHE_FRESH_SECONDS or CACHE_STALE_SECONDS turn caching on"""
+    return config.CACHE_FRESH_SECONDS > 0 or config.CACHE_STALE_SECONDS > 0
+
+
+def cached(func=None, partition=None):
+    """Decorate a service function so its results are cached while stale, see the module docs
+
+    partition is called with the function's arguments and returns the
+    partition the result is kept in, so invalidate can drop just that part,
+    e.g. the pages of one set. Caching is off unless caching_enabled().
+    """
+    if func is None:
+        return functools.partial(cached, partition=partition)
+
+    name = '%s.%s' % (func.__module__.rsplit('.', 1)[-1], func.__name__)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not caching_enabled():
+            return func(*args, **kwargs)
+
+        key = (args, tuple(sorted(kwargs.items())))
+        try:
+            hash(key)
+        except TypeError:
+            return func(*args, **kwargs)
+        return get_cache(name).get(
+            key, functools.partial(func, *args, **kwargs),
+            partition(*args, **kwargs) if partition is not None else None)
+
+    return wrapper
+
+
+def invalidate(name, partition=None):
+    """Drop the cached results of a function, e.g. frdr.get_metadata, or of one partition of them"""
+    if caching_enabled():
+        get_cache(name).clear(partition)
+
+
+def stats():
+    """Size and counters of every cache"""
+    with _caches_lock:
+        caches = list(_caches.values())
+    return {cache.name: cache.stats() for cache in caches}
+
+
+def reset():
+    """Forget every cache, and the values of process private caches"""
+    global _shared_store
+    with _caches_lock:
+        _caches.clear()
+        if _shared_store is not None:
+            _shared_store.close()
+        _shared_store = None
@@ -0,0 +1,535 @@
+"""Storage backends for viringo.cache
+
+CACHE_BACKEND picks where cached values live:
+
+local
+    An LRU dict in each process, the default.
+shared
+    A memory mapped file at CACHE_SHARED_PATH that every worker on the host
+    maps, so a value fetched by one gunicorn worker is served by all of them.
+    It is a fixed table of CACHE_SHARED_SLOTS slots of CACHE_SHARED_SLOT_BYTES
+    each. A key hashes to one slot, a value replaces whatever was in its slot,
+    and values too large for a slot are not stored.
+redis
+    A Redis server at CACHE_REDIS_URL, shared by every worker on every host.
+    Size it with maxmemory and an allkeys-lru policy, as keys are stored
+    without an expiry. The keys of each partition are also kept in a set, so
+    clearing a partition deletes just those instead of scanning every key.
+    Should redis evict such a set, values of the partition it listed stay
+    until the whole name is cleared.
+
+Values are stored under a namespace, the cached function's name optionally
+followed by a partition as name/partition, e.g. the set of a page. Clearing a
+name clears all its partitions. Every store counts the same metrics. Stores
+that share values across processes pickle them, so callers get a copy.
+"""
+
+import fcntl
+import hashlib
+import logging
+import mmap
+import os
+import pickle
+import random
+import socket
+import struct
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+
+class StoreError(Exception):
+    """A shared store could not be reached, the cache treats it as a miss"""
+
+
+def key_digest(namespace, key):
+    """A stable digest of a cache key, the same in every process"""
+    return hashlib.sha1(repr((namespace, key)).encode('utf-8')).digest()
+
+
+def in_namespace(stored, namespace):
+    """Whether values stored under stored are cleared with namespace"""
+    return stored == namespace or ('/' not in namespace and stored.startswith(namespace + '/'))
+
+
+def namespace_digests(namespace):
+    """Short digests of the name and the whole namespace, as kept in shared slots"""
+    name = namespace.split('/', 1)[0]
+    return (hashlib.sha1(name.encode('utf-8')).digest()[:8],
+            hashlib.sha1(namespace.encode('utf-8')).digest()[:8])
+
+
+class Store:
+    """Where a cache keeps its values"""
+
+    backend = None
+
+    def __init__(self):
+        self.counters = {'hits': 0, 'misses': 0, 'sets': 0, 'evictions': 0, 'errors': 0, 'too_large': 0}
+        self._counters_lock = threading.Lock()
+
+    def _count(self, counter):
+        with self._counters_lock:
+            self.counters[counter] += 1
+
+    def get(self, namespace, key):
+        """The stored value, or None"""
+        raise NotImplementedError
+
+    def _unpickle(self, data):
+        try:
+            value = pickle.loads(data)
+        except Exception:
+            # e.g. stored by an older release whose classes have changed since
+            self._count('errors')
+            return None
+        self._count('hits')
+        return value
+
+    def set(self, namespace, key, value):
+        """Store a value"""
+        raise NotImplementedError
+
+    def update(self, namespace, key, func, ttl=None):
+        """Replace the stored value, or None, with func(value) atomically and return the new value
+
+        func may be called more than once. ttl is how many seconds the value
+        needs to be kept, stores that keep values without bound ignore it.
+        """
+        raise NotImplementedError
+
+    def delete(self, namespace, key):
+        """Drop a value if stored"""
+        raise NotImplementedError
+
+    def clear(self, namespace):
+        """Drop every value stored under a namespace, or under every partition of a name"""
+        raise NotImplementedError
+
+    def size(self):
+        """Number of stored values, or None when the store can't tell cheaply"""
+        return None
+
+    def close(self):
+        """Release the files or connections of the store"""
+
+    def stats(self):
+        """Counters of the store"""
+        with self._counters_lock:
+            stats = dict(self.counters)
+        stats['backend'] = self.backend
+        stats['entries'] = self.size()
+        return stats
+
+
+class LocalStore(Store):
+    """A bounded LRU dict private to the process"""
+
+    backend = 'local'
+
+    def __init__(self, max_entries):
+        super(LocalStore, self).__init__()
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, namespace, key):
+        with self._lock:
+            value = self._entries.get((namespace, key))
+            if value is not None:
+                self._entries.move_to_end((namespace, key))
+        self._count('hits' if value is not None else 'misses')
+        return value
+
+    def set(self, namespace, key, value):
+        evicted = 0
+        with self._lock:
+            self._entries[(namespace, key)] = value
+            self._entries.move_to_end((namespace, key))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                evicted += 1
+        self._count('sets')
+        for _ in range(evicted):
+            self._count('evictions')
+
+    def update(self, namespace, key, func, ttl=None):
+        with self._lock:
+            value = func(self._entries.get((namespace, key)))
+            self._entries[(namespace, key)] = value
+            self._entries.move_to_end((namespace, key))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+    def delete(self, namespace, key):
+        with self._lock:
+            self._entries.pop((namespace, key), None)
+
+    def clear(self, namespace):
+        with self._lock:
+            for stored in [stored for stored in self._entries if in_namespace(stored[0], namespace)]:
+                del self._entries[stored]
+
+    def size(self):
+        with self._lock:
+            return len(self._entries)
+
+
+# key digest, name digest, namespace digest, expiry as epoch seconds or 0, pickled length
+SLOT_HEADER = struct.Struct('<20s8s8sdI')
+EMPTY_DIGEST = b'\0' * 20
+EMPTY_HEADER = (EMPTY_DIGEST, b'\0' * 8, b'\0' * 8, 0.0, 0)
+
+
+class SharedStore(Store):
+    """A fixed table of slots in a memory mapped file shared by the processes of a host
+
+    A key hashes to a group of ways consecutive slots and is kept in any of
+    them. set replaces the first slot of the group when none is free, as a
+    cache may forget values. update never replaces a value that hasn't
+    expired, and raises StoreError when every slot of the group holds one.
+
+    Groups are locked with fcntl record locks between processes and a thread
+    lock within one, as record locks don't exclude threads of the same process.
+    """
+
+    backend = 'shared'
+
+    def __init__(self, path, slots, slot_bytes, ways=1):
+        super(SharedStore, self).__init__()
+        self.path = path
+        self.ways = max(1, min(ways, slots))
+        self.slots = slots - slots % self.ways
+        self.slot_bytes = slot_bytes
+        self._lock = threading.Lock()
+
+        size = slots * slot_bytes
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.lockf(self._fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self._fd).st_size < size:
+                # Sparse, so slots only take memory once used
+                os.ftruncate(self._fd, size)
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN)
+        self._map = mmap.mmap(self._fd, size)
+
+    def _group(self, digest):
+        """The first slot of the group a key is kept in"""
+        return int.from_bytes(digest[:8], 'little') % (self.slots // self.ways) * self.ways
+
+    @contextmanager
+    def _locked(self, first, exclusive, count=None):
+        length = (count or self.ways) * self.slot_bytes
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH,
+                        length, first * self.slot_bytes)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, length, first * self.slot_bytes)
+
+    def _find(self, first, digest):
+        """The slot of the group holding the key and a free one, each None when there is none
+
+        The caller holds the group locked.
+        """
+        now = time.time()
+        found = free = None
+        for slot in range(first, first + self.ways):
+            stored_digest, _, _, expires, _ = SLOT_HEADER.unpack_from(self._map, slot * self.slot_bytes)
+            expired = stored_digest == EMPTY_DIGEST or 0 < expires <= now
+            if stored_digest == digest and not expired:
+                found = slot
+            elif expired and free is None:
+                free = slot
+        return found, free
+
+    def _read(self, slot):
+        """The pickled value of a slot, which the caller holds locked"""
+        offset = slot * self.slot_bytes
+        length = SLOT_HEADER.unpack_from(self._map, offset)[4]
+        start = offset + SLOT_HEADER.size
+        return self._map[start:start + length]
+
+    def get(self, namespace, key):
+        digest = key_digest(namespace, key)
+        first = self._group(digest)
+        with self._locked(first, exclusive=False):
+            slot, _ = self._find(first, digest)
+            data = self._read(slot) if slot is not None else None
+        if data is None:
+            self._count('misses')
+            return None
+        return self._unpickle(data)
+
+    def set(self, namespace, key, value):
+        digest = key_digest(namespace, key)
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if SLOT_HEADER.size + len(data) > self.slot_bytes:
+            self._count('too_large')
+            return
+        first = self._group(digest)
+        with self._locked(first, exclusive=True):
+            found, free = self._find(first, digest)
+            if found is None:
+                found = free if free is not None else first
+            self._write(found, namespace, digest, data)
+
+    def _write(self, slot, namespace, digest, data, expires=0.0):
+        """Write a pickled value into a slot, which the caller holds locked"""
+        offset = slot * self.slot_bytes
+        name_digest, namespace_digest = namespace_digests(namespace)
+        stored_digest, _, _, stored_expires, _ = SLOT_HEADER.unpack_from(self._map, offset)
+        evicted = stored_digest not in (EMPTY_DIGEST, digest) and not 0 < stored_expires <= time.time()
+        start = offset + SLOT_HEADER.size
+        self._map[start:start + len(data)] = data
+        SLOT_HEADER.pack_into(self._map, offset, digest, name_digest, namespace_digest, expires, len(data))
+        self._count('sets')
+        if evicted:
+            self._count('evictions')
+
+    def update(self, namespace, key, func, ttl=None):
+        digest = key_digest(namespace, key)
+        first = self._group(digest)
+        with self._locked(first, exclusive=True):
+            found, free = self._find(first, digest)
+            if found is None and free is None:
+                # Another key's value may be all that keeps a limit, see viringo.ratelimit
+                self._count('errors')
+                raise StoreError('No free shared slot for %s, every slot of its group is taken' % namespace)
+            value = func(self._unpickle(self._read(found)) if found is not None else None)
+            data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            if SLOT_HEADER.size + len(data) > self.slot_bytes:
+                self._count('too_large')
+                raise StoreError('Value of %s too large for a shared slot' % namespace)
+            expires = time.time() + ttl if ttl else 0.0
+            self._write(found if found is not None else free, namespace, digest, data, expires)
+        return value
+
+    def delete(self, namespace, key):
+        digest = key_digest(namespace, key)
+        first = self._group(digest)
+        with self._locked(first, exclusive=True):
+            slot, _ = self._find(first, digest)
+            if slot is not None:
+                SLOT_HEADER.pack_into(self._map, slot * self.slot_bytes, *EMPTY_HEADER)
+
+    def clear(self, namespace):
+        name_digest, namespace_digest = namespace_digests(namespace)
+        # A name clears all its partitions, a partition only its own values
+        field = 2 if '/' in namespace else 1
+        match = namespace_digest if '/' in namespace else name_digest
+        for slot in range(self.slots):
+            offset = slot * self.slot_bytes
+            with self._locked(slot, exclusive=True, count=1):
+                if SLOT_HEADER.unpack_from(self._map, offset)[field] == match:
+                    SLOT_HEADER.pack_into(self._map, offset, *EMPTY_HEADER)
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
+
+
+# Times a redis update is retried when other clients keep changing the key
+UPDATE_ATTEMPTS = 10
+
+
+class RedisStore(Store):
+    """A Redis server spoken to over RESP, one connection per thread"""
+
+    backend = 'redis'
+
+    def __init__(self, url, timeout, prefix='viringo:'):
+        super(RedisStore, self).__init__()
+        parsed = urlparse(url)
+        self.host = parsed.hostname or 'localhost'
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int(parsed.path.lstrip('/') or 0)
+        self.timeout = timeout
+        self.prefix = prefix
+        self._local = threading.local()
+
+    def _key(self, namespace, key):
+        return '%s%s:%s' % (self.prefix, namespace, key_digest(namespace, key).hex())
+
+    def _index_key(self, namespace):
+        """The set of the keys stored in a partition, None for a whole name"""
+        if '/' not in namespace:
+            return None
+        return '%s%s:keys' % (self.prefix, namespace)
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        # A connection inherited from the parent process is not ours to use
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        conn = (sock, sock.makefile('rb'))
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        if self.password:
+            self._command('AUTH', self.password)
+        if self.db:
+            self._command('SELECT', str(self.db))
+        return conn
+
+    def _disconnect(self):
+        conn = getattr(self._local, 'conn', None)
+        self._local.conn = None
+        if conn is not None:
+            try:
+                conn[1].close()
+                conn[0].close()
+            except OSError:
+                pass
+
+    def _read_reply(self, reader):
+        line = reader.readline()
+        if not line.endswith(b'\r\n'):
+            raise StoreError('Connection to redis closed')
+        kind, rest = line[:1], line[1:-2]
+        if kind == b'+':
+            return rest
+        if kind == b'-':
+            raise StoreError('Redis error: %s' % rest.decode('utf-8', 'replace'))
+        if kind == b':':
+            return int(rest)
+        if kind == b'$':
+            length = int(rest)
+            if length < 0:
+                return None
+            data = reader.read(length + 2)
+            return data[:-2]
+        if kind == b'*':
+            length = int(rest)
+            if length < 0:
+                return None
+            return [self._read_reply(reader) for _ in range(length)]
+        raise StoreError('Unexpected reply from redis: %r' % line)
+
+    def _command(self, *args):
+        """Send a command and return its reply, raising StoreError when redis can't be used"""
+        return self._pipeline(args)[0]
+
+    def _pipeline(self, *commands):
+        """Send commands in one round trip and return their replies, like _command"""
+        try:
+            sock, reader = self._connection()
+            parts = []
+            for args in commands:
+                parts.append(b'*%d\r\n' % len(args))
+                for arg in args:
+                    if isinstance(arg, str):
+                        arg = arg.encode('utf-8')
+                    parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+            sock.sendall(b''.join(parts))
+            return [self._read_reply(reader) for _ in commands]
+        except (OSError, ValueError) as err:
+            self._disconnect()
+            raise StoreError('Redis at %s:%s unavailable: %s' % (self.host, self.port, err))
+        except StoreError:
+            self._disconnect()
+            raise
+
+    def get(self, namespace, key):
+        try:
+            data = self._command('GET', self._key(namespace, key))
+        except StoreError:
+            self._count('errors')
+            raise
+        if data is None:
+            self._count('misses')
+            return None
+        return self._unpickle(data)
+
+    def set(self, namespace, key, value):
+        redis_key = self._key(namespace, key)
+        index_key = self._index_key(namespace)
+        try:
+            if index_key is None:
+                self._command('SET', redis_key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+            else:
+                # Stored and indexed together, so a clear of the partition can't miss it
+                self._pipeline(('MULTI',), ('SET', redis_key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)),
+                               ('SADD', index_key, redis_key), ('EXEC',))
+        except StoreError:
+            self._count('errors')
+            raise
+        self._count('sets')
+
+    def update(self, namespace, key, func, ttl=None):
+        redis_key = self._key(namespace, key)
+        # Optimistic: the transaction fails when another client changed the key after WATCH
+        for attempt in range(UPDATE_ATTEMPTS):
+            if attempt:
+                # Back off a random while so contending clients take turns
+                time.sleep(random.uniform(0, 0.001 * 2 ** attempt))
+            try:
+                self._command('WATCH', redis_key)
+                data = self._command('GET', redis_key)
+                value = func(self._unpickle(data) if data is not None else None)
+                self._command('MULTI')
+                args = ['SET', redis_key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)]
+                if ttl:
+                    args.extend(['PX', str(int(ttl * 1000))])
+                self._command(*args)
+                if self._index_key(namespace) is not None:
+                    self._command('SADD', self._index_key(namespace), redis_key)
+                if self._command('EXEC') is not None:
+                    self._count('sets')
+                    return value
+            except StoreError:
+                self._count('errors')
+                raise
+        self._count('errors')
+        raise StoreError('Gave up updating %s after %d conflicts' % (redis_key, UPDATE_ATTEMPTS))
+
+    def delete(self, namespace, key):
+        self._command('DEL', self._key(namespace, key))
+
+    def clear(self, namespace):
+        index_key = self._index_key(namespace)
+        if index_key is not None:
+            # A partition deletes the keys of its index rather than scanning the keyspace.
+            # Popped in batches, so keys indexed meanwhile are left for the next clear
+            while True:
+                keys = self._command('SPOP', index_key, '1000')
+                if not keys:
+                    return
+                self._command('DEL', *keys)
+        # A whole name scans, its partitions' values and indexes match name/*
+        patterns = [self.prefix + glob_escape(namespace) + ':' + '?' * 40,
+                    self.prefix + glob_escape(namespace) + '/*']
+        for pattern in patterns:
+            cursor = b'0'
+            while True:
+                cursor, keys = self._command('SCAN', cursor, 'MATCH', pattern, 'COUNT', '1000')
+                if keys:
+                    self._command('DEL', *keys)
+                if cursor == b'0':
+                    break
+
+    def close(self):
+        self._disconnect()
+
+
+def glob_escape(value):
+    """Escape the glob characters redis SCAN MATCH patterns understand"""
+    return ''.join('\\' + char if char in '*?[]\\' else char for char in value)
+
+
+def create_store(backend, max_entries, shared_path, shared_slots, shared_slot_bytes, redis_url, redis_timeout):
+    """Create the store of a backend, see the module docs"""
+    if backend == 'local':
+        return LocalStore(max_entries)
+    if backend == 'shared':
+        return SharedStore(shared_path, shared_slots, shared_slot_bytes)
+    if backend == 'redis':
+        return RedisStore(redis_url, redis_timeout)
+    logging.warning("Unknown cache backend %s, caching in each process", backend)
+    return LocalStore(max_entries)
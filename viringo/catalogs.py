@@ -7,11 +7,15 @@ pyoai library.
 import base64
 import binascii
 import logging
+import uuid
 from datetime import datetime
 from oaipmh import common, error
 
 from viringo import config
+from viringo import incremental
+from viringo import render
 from .services import datacite
+from .services import datacite_mirror
 from .services import frdr
 
 
@@ -81,7 +85,7 @@ class DataCiteOAIServer():
         # We just want the DOI out of the OAI identifier.
         _, doi = identifier.split(':', 1)
 
-        result = datacite.get_metadata(doi)
+        result = datacite_backend().get_metadata(doi)
         if not result:
             raise error.IdDoesNotExistError(
                 "\"%s\" is unknown or illegal in this repository" % identifier
@@ -106,25 +110,42 @@ class DataCiteOAIServer():
         from_=None,
         until=None,
         set=None,
-        paging_cursor=None
+        paging_cursor=None,
+        page_size=None
     ):
         #pylint: disable=no-self-use,invalid-name
-        """Returns pyoai data tuple for list of records"""
+        """Returns pyoai data tuple for list of records, pages of page_size records or RESULT_SET_SIZE"""
 
         # If available get the search query from the set param
         search_query = set_to_search_query(set)
 
         # Get both a provider and client_id from the set
         provider_id, client_id = set_to_provider_client(set)
-        results, total_records, paging_cursor = datacite.get_metadata_list(
+
+        # An incremental harvest starting after the set last changed has nothing to list
+        if not search_query and incremental.nothing_changed(
+                ('DataCite', provider_id, client_id), from_, paging_cursor,
+                lambda: datacite.get_latest_change(provider_id, client_id)):
+            return [], 0, None
+
+        # Large pages are built and rendered on the render pool, see viringo.render
+        pooled = render.get_pool() is not None
+        results, total_records, paging_cursor = datacite_backend(search_query, paging_cursor).get_metadata_list(
             query=search_query,
             provider_id=provider_id,
             client_id=client_id,
             from_datetime=from_,
             until_datetime=until,
-            cursor=paging_cursor
+            cursor=paging_cursor,
+            build=not pooled,
+            page_size=page_size
         )
 
+        if pooled:
+            records = render.render_records(
+                DataCiteOAIServer, datacite.build_metadata, 'ListRecords', metadataPrefix, results)
+            return records, total_records, paging_cursor
+
         records = []
         if results:
             for result in results:
@@ -146,28 +167,93 @@ class DataCiteOAIServer():
         # But this is okay as we have a custom server to handle it.
         return records, total_records, paging_cursor
 
+    def get_records(self, identifiers):
+        """Returns the results of many OAI identifiers by identifier, leaving out unknown ones"""
+
+        # We just want the DOIs out of the OAI identifiers.
+        dois = {}
+        for identifier in identifiers:
+            if ':' in identifier:
+                dois[identifier.split(':', 1)[1]] = identifier
+
+        results = datacite_backend().get_metadata_batch(list(dois))
+        return {dois[doi]: result for doi, result in results.items()}
+
+    @staticmethod
+    def parse_export_position(position):
+        """An export position from a client's token, raising ValueError when it can't be one"""
+        paging_cursor, skip = position
+        if not isinstance(paging_cursor, (str, int, type(None))) or not isinstance(skip, int) or skip < 0:
+            raise ValueError('Bad export position %r' % (position,))
+        if datacite_mirror.is_mirror_cursor(paging_cursor):
+            datacite_mirror.parse_cursor(paging_cursor)
+        return [paging_cursor, skip]
+
+    def export_records(self, set=None, from_=None, until=None, position=None):
+        """Yield (result, position) for every record, position resuming after the record
+
+        The position is the paging cursor of the record's page and how many of
+        its records have been yielded, as the cursors of the API and the mirror
+        only lead to whole pages.
+        """
+        search_query = set_to_search_query(set)
+        provider_id, client_id = set_to_provider_client(set)
+        paging_cursor, skip = position or (None, 0)
+        backend = datacite_backend(search_query, paging_cursor)
+        while True:
+            results, _, next_cursor = backend.get_metadata_list(
+                query=search_query,
+                provider_id=provider_id,
+                client_id=client_id,
+                from_datetime=from_,
+                until_datetime=until,
+                cursor=paging_cursor
+            )
+            results = results or []
+            for index in range(skip, len(results)):
+                yield results[index], [paging_cursor, index + 1]
+            if not next_cursor:
+                return
+            paging_cursor, skip = next_cursor, 0
+
     def listIdentifiers(
         self,
         metadataPrefix=None,
         from_=None,
         until=None,
         set=None,
-        paging_cursor=None
+        paging_cursor=None,
+        page_size=None
     ):
         #pylint: disable=no-self-use,invalid-name
-        """Returns pyoai data tuple for list of identifiers"""
+        """Returns pyoai data tuple for list of identifiers, pages of page_size headers or RESULT_SET_SIZE"""
 
         # Get both a provider and client_id from the set
         provider_id, client_id = set_to_provider_client(set)
 
-        results, total_records, paging_cursor = datacite.get_metadata_list(
+        # An incremental harvest starting after the set last changed has nothing to list
+        if incremental.nothing_changed(
+                ('DataCite', provider_id, client_id), from_, paging_cursor,
+                lambda: datacite.get_latest_change(provider_id, client_id)):
+            return [], 0, None
+
+        # Large pages are built and rendered on the render pool, see viringo.render
+        pooled = render.get_pool() is not None
+        results, total_records, paging_cursor = datacite_backend(None, paging_cursor).get_metadata_list(
             provider_id=provider_id,
             client_id=client_id,
             from_datetime=from_,
             until_datetime=until,
-            cursor=paging_cursor
+            cursor=paging_cursor,
+            build=not pooled,
+            page_size=page_size
         )
 
+        if pooled:
+            records = render.render_records(
+                DataCiteOAIServer, datacite.build_metadata, 'ListIdentifiers', metadataPrefix, results)
+            return records, total_records, paging_cursor
+
         records = []
         if results:
             for result in results:
@@ -375,15 +461,26 @@ class FRDROAIServer():
             from_=None,
             until=None,
             set=None,
-            paging_cursor=None
+            paging_cursor=None,
+            page_size=None
         ):
 
         #pylint: disable=no-self-use,invalid-name
-        """Returns pyoai data tuple for list of records"""
+        """Returns pyoai data tuple for list of records, pages of page_size records or RESULT_SET_SIZE"""
 
         # If available get the search query from the set param
         search_query = set_to_search_query(set)
 
+        # An incremental harvest starting after the set last changed has nothing to list
+        if incremental.nothing_changed(
+                ('FRDR', set), from_, paging_cursor,
+                lambda: frdr.get_latest_change(
+                    db=config.POSTGRES_DB, user=config.POSTGRES_USER, password=config.POSTGRES_PASSWORD,
+                    server=config.POSTGRES_SERVER, port=config.POSTGRES_PORT, set=set)):
+            return [], 0, None
+
+        # Large pages are built and rendered on the render pool, see viringo.render
+        pooled = render.get_pool() is not None
         results, total_records, paging_cursor = frdr.get_metadata_list(
             server=config.POSTGRES_SERVER,
             db=config.POSTGRES_DB,
@@ -394,12 +491,19 @@ class FRDROAIServer():
             set=set,
             from_datetime=from_,
             until_datetime=until,
-            cursor=paging_cursor
+            cursor=paging_cursor,
+            build=not pooled,
+            page_size=page_size
         )
 
         if paging_cursor >= total_records:
             paging_cursor = None
 
+        if pooled:
+            records = render.render_records(
+                FRDROAIServer, frdr.build_metadata, 'ListRecords', metadataPrefix, results)
+            return records, total_records, paging_cursor
+
         records = []
         if results:
             for result in results:
@@ -427,14 +531,25 @@ class FRDROAIServer():
             from_=None,
             until=None,
             set=None,
-            paging_cursor=None
+            paging_cursor=None,
+            page_size=None
         ):
         #pylint: disable=no-self-use,invalid-name
-        """Returns pyoai data tuple for list of identifiers"""
+        """Returns pyoai data tuple for list of identifiers, pages of page_size headers or RESULT_SET_SIZE"""
 
         # If available get the search query from the set param
         search_query = set_to_search_query(set)
 
+        # An incremental harvest starting after the set last changed has nothing to list
+        if incremental.nothing_changed(
+                ('FRDR', set), from_, paging_cursor,
+                lambda: frdr.get_latest_change(
+                    db=config.POSTGRES_DB, user=config.POSTGRES_USER, password=config.POSTGRES_PASSWORD,
+                    server=config.POSTGRES_SERVER, port=config.POSTGRES_PORT, set=set)):
+            return [], 0, None
+
+        # Large pages are built and rendered on the render pool, see viringo.render
+        pooled = render.get_pool() is not None
         results, total_records, paging_cursor = frdr.get_metadata_list(
             server=config.POSTGRES_SERVER,
             db=config.POSTGRES_DB,
@@ -445,12 +560,19 @@ class FRDROAIServer():
             set=set,
             from_datetime=from_,
             until_datetime=until,
-            cursor=paging_cursor
+            cursor=paging_cursor,
+            build=not pooled,
+            page_size=page_size
         )
 
         if paging_cursor >= total_records:
             paging_cursor = None
 
+        if pooled:
+            records = render.render_records(
+                FRDROAIServer, frdr.build_metadata, 'ListIdentifiers', metadataPrefix, results)
+            return records, total_records, paging_cursor
+
         records = []
         if results:
             for result in results:
@@ -462,6 +584,37 @@ class FRDROAIServer():
         # But this is okay as we have a custom server to handle it.
         return records, total_records, paging_cursor
 
+    def get_records(self, identifiers):
+        """Returns the results of many OAI identifiers by identifier, leaving out unknown ones"""
+
+        results = frdr.get_metadata_batch(identifiers, db=config.POSTGRES_DB, user=config.POSTGRES_USER, password=config.POSTGRES_PASSWORD, server=config.POSTGRES_SERVER, port=config.POSTGRES_PORT)
+        return {identifier: result for identifier, result in results.items() if result}
+
+    @staticmethod
+    def parse_export_position(position):
+        """An export position from a client's token, raising ValueError unless it is a record_uuid"""
+        return str(uuid.UUID(position))
+
+    def export_records(self, set=None, from_=None, until=None, position=None):
+        """Yield (result, position) for every record, position resuming after the record
+
+        The position is the record_uuid the records are ordered by.
+        """
+        for record_uuid, result in frdr.iter_metadata_list(
+                server=config.POSTGRES_SERVER,
+                db=config.POSTGRES_DB,
+                user=config.POSTGRES_USER,
+                password=config.POSTGRES_PASSWORD,
+                port=config.POSTGRES_PORT,
+                set=set,
+                from_datetime=from_,
+                until_datetime=until,
+                after=position,
+                keyed=True
+            ):
+            if result is not None:
+                yield result, record_uuid
+
     def listSets(
             self,
             paging_cursor=0
@@ -547,6 +700,21 @@ class FRDROAIServer():
         return metadata
 
 
+def datacite_backend(search_query=None, paging_cursor=None):
+    """The service answering a DataCite request, the local mirror when it can, see viringo.services.datacite_mirror"""
+    if search_query:
+        return datacite
+    # A harvest carries on with the service it started on
+    if paging_cursor:
+        if not datacite_mirror.is_mirror_cursor(paging_cursor):
+            return datacite
+        try:
+            datacite_mirror.parse_cursor(paging_cursor)
+        except ValueError:
+            raise error.BadResumptionTokenError('The paging cursor of the resumption token is invalid')
+        return datacite_mirror
+    return datacite_mirror if datacite_mirror.available() else datacite
+
 def set_to_search_query(unparsed_set):
     """Take a oai set and extract any base64url encoded search query"""
 
@@ -0,0 +1,172 @@
+"""Circuit breaker for upstream backends
+
+After CIRCUIT_FAILURE_THRESHOLD consecutive failed or slow calls the circuit
+opens and calls fail fast with BackendUnavailable for CIRCUIT_RESET_SECONDS,
+instead of every request tying up a worker until the upstream times out. A
+single trial call is then let through: success closes the circuit again and
+failure keeps it open for another period.
+"""
+
+import threading
+import time
+
+from viringo import admission
+from viringo import config
+
+
+class BackendUnavailable(Exception):
+    """An upstream backend can't be used, answered with a 503 and Retry-After"""
+
+    def __init__(self, message, retry_after=None):
+        super(BackendUnavailable, self).__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitOpenError(BackendUnavailable):
+    """Raised instead of calling a backend whose circuit is open"""
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitBreaker:
+    """Tracks consecutive failures of a backend and fails fast while it is down"""
+
+    def __init__(self, name):
+        self.name = name
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.counters = {'calls': 0, 'failures': 0, 'slow_calls': 0, 'rejected': 0, 'opened': 0}
+        self._lock = threading.Lock()
+
+    def retry_after(self):
+        """Seconds until a trial call will be let through"""
+        if self.opened_at is None:
+            return 0
+        remaining = config.CIRCUIT_RESET_SECONDS - (time.monotonic() - self.opened_at)
+        return max(1, int(remaining + 0.999))
+
+    def before_call(self):
+        """Check a call may go ahead, raising CircuitOpenError when it may not"""
+        with self._lock:
+            self.counters['calls'] += 1
+            if self.state == CLOSED:
+                return
+            if self.state == OPEN and time.monotonic() - self.opened_at >= config.CIRCUIT_RESET_SECONDS:
+                # Let this call through as the trial
+                self.state = HALF_OPEN
+                return
+            self.counters['rejected'] += 1
+            retry_after = self.retry_after()
+        raise CircuitOpenError('%s is unavailable' % self.name, retry_after=retry_after)
+
+    def record_success(self):
+        """Close the circuit after a successful call"""
+        with self._lock:
+            self.failures = 0
+            self.state = CLOSED
+            self.opened_at = None
+
+    def record_failure(self, slow=False):
+        """Count a failed or slow call, opening the circuit at the threshold"""
+        with self._lock:
+            self.counters['slow_calls' if slow else 'failures'] += 1
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= config.CIRCUIT_FAILURE_THRESHOLD:
+                if self.state != OPEN:
+                    self.counters['opened'] += 1
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+
+    def record_abandoned(self):
+        """Forget a call that ended without an outcome, so a trial call can be made again"""
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self.state = OPEN
+
+    def record_outcome(self, result, started, is_failure=None):
+        """Count a call that returned result as a failure, a slow call or a success"""
+        if is_failure is not None and is_failure(result):
+            self.record_failure()
+        elif time.monotonic() - started > config.CIRCUIT_SLOW_CALL_SECONDS:
+            self.record_failure(slow=True)
+        else:
+            self.record_success()
+
+    def call(self, func, *args, is_failure=None, **kwargs):
+        """Call func through the breaker
+
+        Exceptions count as failures and are raised, as do results for which
+        is_failure returns True, and calls slower than CIRCUIT_SLOW_CALL_SECONDS.
+        BackendUnavailable raised by func is passed on without counting.
+        """
+        self.before_call()
+        started = time.monotonic()
+        try:
+            result = func(*args, **kwargs)
+        except BackendUnavailable:
+            # The caller gave up, e.g. its deadline ran out, which says nothing about the backend
+            self.record_abandoned()
+            raise
+        except Exception:
+            self.record_failure()
+            raise
+        finally:
+            # A load signal for admission control
+            admission.observe_backend(self.name, time.monotonic() - started)
+
+        self.record_outcome(result, started, is_failure)
+        return result
+
+    async def call_async(self, func, *args, is_failure=None, **kwargs):
+        """Await the coroutine function func through the breaker, like call"""
+        self.before_call()
+        started = time.monotonic()
+        try:
+            result = await func(*args, **kwargs)
+        except BackendUnavailable:
+            self.record_abandoned()
+            raise
+        except Exception:
+            self.record_failure()
+            raise
+        finally:
+            admission.observe_backend(self.name, time.monotonic() - started)
+
+        self.record_outcome(result, started, is_failure)
+        return result
+
+    def stats(self):
+        """State and counters of the breaker"""
+        with self._lock:
+            stats = dict(self.counters)
+            stats['state'] = self.state
+            return stats
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(name):
+    """Return the circuit breaker of a backend, creating it on first use"""
+    with _breakers_lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(name)
+        return _breakers[name]
+
+
+def stats():
+    """State and counters of every breaker"""
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    return {breaker.name: breaker.stats() for breaker in breakers}
+
+
+def reset():
+    """Forget every breaker, closing all circuits"""
+    with _breakers_lock:
+        _breakers.clear()
@@ -0,0 +1,141 @@
+"""Management commands, run with `FLASK_APP=viringo flask <command>`"""
+
+import sys
+import time
+
+import click
+
+from viringo import circuit
+from viringo import config
+from viringo import snapshots
+from .services import datacite_mirror
+from .services import frdr_indexes
+from .services import frdr_notify
+
+
+def register_commands(app):
+    """Register the management commands with the application cli"""
+    app.cli.add_command(frdr_indexes_command)
+    app.cli.add_command(frdr_cache_listener_command)
+    app.cli.add_command(datacite_mirror_sync_command)
+    app.cli.add_command(snapshot_export_command)
+
+
+@click.command('frdr-indexes')
+@click.option('--explain/--no-explain', default=True,
+              help='Show EXPLAIN (ANALYZE, BUFFERS) for every generated query.')
+@click.option('--ddl-file', type=click.Path(dir_okay=False, writable=True),
+              help='Write the migration DDL for missing indexes to this file.')
+def frdr_indexes_command(explain, ddl_file):
+    """Check the FRDR database has the columns and indexes viringo needs."""
+    con = frdr_indexes.connect(
+        config.POSTGRES_DB, config.POSTGRES_USER, config.POSTGRES_PASSWORD,
+        config.POSTGRES_SERVER, config.POSTGRES_PORT
+    )
+
+    columns = frdr_indexes.missing_columns(con)
+    for table, column in columns:
+        click.echo('Missing column %s.%s' % (table, column))
+
+    missing = frdr_indexes.missing_indexes(frdr_indexes.existing_indexes(con))
+    for spec in missing:
+        click.echo('Missing index on %s (%s) for %s' % (spec.table, ', '.join(spec.columns), spec.reason))
+    if not columns and not missing:
+        click.echo('Schema has every column and index the FRDR queries need')
+
+    if missing:
+        ddl = frdr_indexes.migration_ddl(missing)
+        if ddl_file:
+            with open(ddl_file, 'w') as output:
+                output.write(ddl)
+            click.echo('Migration DDL written to %s' % ddl_file)
+        else:
+            click.echo('')
+            click.echo(ddl)
+
+    # Explaining needs every column to be present
+    if explain and not columns:
+        sample = frdr_indexes.sample_values(con)
+        if sample is None:
+            click.echo('No records to explain the queries with')
+        else:
+            click.echo(frdr_indexes.explain_report(con, sample))
+
+    con.close()
+
+    if columns or missing:
+        sys.exit(1)
+
+
+@click.command('frdr-cache-listener')
+@click.option('--ddl', is_flag=True, help='Print the trigger DDL that feeds the listener and exit.')
+def frdr_cache_listener_command(ddl):
+    """Invalidate cached FRDR results as the database changes, once for every worker of a host."""
+    if ddl:
+        click.echo(frdr_notify.trigger_ddl())
+        return
+
+    if config.CACHE_BACKEND == 'local':
+        click.echo('The local cache backend is private to each worker, run listeners in the workers '
+                   'with OAIPMH_FRDR_CACHE_LISTEN=true instead', err=True)
+        sys.exit(1)
+
+    listener = frdr_notify.Listener(
+        config.POSTGRES_DB, config.POSTGRES_USER, config.POSTGRES_PASSWORD,
+        config.POSTGRES_SERVER, config.POSTGRES_PORT
+    )
+    click.echo('Listening on %s' % listener.channel)
+    try:
+        listener.run()
+    except KeyboardInterrupt:
+        listener.stop()
+
+
+@click.command('datacite-mirror-sync')
+@click.option('--full', is_flag=True, help='Pull every DOI rather than those changed since the last sync.')
+@click.option('--interval', type=int, default=0,
+              help='Keep syncing, waiting this many seconds between syncs.')
+def datacite_mirror_sync_command(full, interval):
+    """Pull the DOIs changed since the last sync into the local DataCite mirror."""
+    if not config.DATACITE_MIRROR_PATH:
+        click.echo('Set OAIPMH_DATACITE_MIRROR_PATH to the mirror file', err=True)
+        sys.exit(1)
+
+    while True:
+        started = time.perf_counter()
+        try:
+            stored = datacite_mirror.sync(config.DATACITE_MIRROR_PATH, full=full)
+        except (circuit.BackendUnavailable, datacite_mirror.SyncError) as err:
+            if not interval:
+                raise
+            # What was stored is kept and the next sync carries on from the last completed one
+            click.echo('Sync failed: %s' % err, err=True)
+        else:
+            click.echo('Synced %d DOIs in %.1fs' % (stored, time.perf_counter() - started))
+            full = False
+        if not interval:
+            break
+        time.sleep(interval)
+
+
+@click.command('snapshot-export')
+@click.option('--prefix', 'prefixes', multiple=True, help='Metadata prefix to export, all when not given.')
+@click.option('--set', 'sets', multiple=True, help='Set to export besides all records, can be repeated.')
+@click.option('--all-sets', is_flag=True, help='Export every set of the catalogue besides all records.')
+@click.option('--workers', type=int, default=None,
+              help='Processes exporting in parallel, 0 exports in this process.')
+def snapshot_export_command(prefixes, sets, all_sets, workers):
+    """Export pre-rendered ListRecords pages full harvests are answered from."""
+    if not config.SNAPSHOT_DIR:
+        click.echo('Set OAIPMH_SNAPSHOT_DIR to the snapshot directory', err=True)
+        sys.exit(1)
+
+    sets = list(sets)
+    if all_sets:
+        sets = snapshots.catalog_sets()
+    started = time.perf_counter()
+    manifest = snapshots.export(
+        metadata_prefixes=list(prefixes), sets=[None] + sets, workers=workers)
+    records = sum(partition['records'] for partition in manifest['partitions'])
+    click.echo('Exported snapshot %s of %d records in %d partitions in %.1fs' % (
+        manifest['snapshot'], records, len(manifest['partitions']), time.perf_counter() - started))
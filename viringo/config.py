@@ -6,6 +6,16 @@ import os
 SENTRY_DSN = os.getenv('SENTRY_DSN', None)
 # URL used for the DataCite REST API
 DATACITE_API_URL = os.getenv('DATACITE_API_URL', 'https://api.datacite.org')
+# Seconds to wait for the DataCite REST API to respond
+DATACITE_API_TIMEOUT = float(os.getenv('DATACITE_API_TIMEOUT', '30'))
+# DOIs looked up at the same time for a batch GetRecord request
+DATACITE_BATCH_CONCURRENCY = int(os.getenv('OAIPMH_DATACITE_BATCH_CONCURRENCY', '8'))
+# SQLite mirror of the DataCite DOIs that OAI requests are answered from, empty to proxy every request
+DATACITE_MIRROR_PATH = os.getenv('OAIPMH_DATACITE_MIRROR_PATH', '')
+# Seconds the API may take to show a change, a sync only vouches for the DOIs updated before it started less this
+DATACITE_MIRROR_INDEX_LAG = int(os.getenv('OAIPMH_DATACITE_MIRROR_INDEX_LAG', '120'))
+# Seconds between full syncs that also drop DOIs deleted or no longer findable, 0 to only do them on request
+DATACITE_MIRROR_RECONCILE_SECONDS = int(os.getenv('OAIPMH_DATACITE_MIRROR_RECONCILE_SECONDS', '604800'))
 # Admin credentials for the API
 DATACITE_API_ADMIN_USERNAME = os.getenv('DATACITE_API_ADMIN_USERNAME', 'admin')
 DATACITE_API_ADMIN_PASSWORD = os.getenv('DATACITE_API_ADMIN_PASSWORD')
@@ -20,6 +30,8 @@ OAIPMH_ADMIN_EMAIL = os.getenv('OAIPMH_ADMIN_EMAIL', 'support@datacite.org')
 OAIPMH_IDENTIFIER = os.getenv('OAIPMH_IDENTIFIER', 'oai.datacite.org')
 # Page size of results shown for result listings
 RESULT_SET_SIZE = int(os.getenv('RESULT_SET_SIZE', '50'))
+# Seconds an OAI request has to be answered in, keep below the gunicorn worker timeout, 0 disables
+REQUEST_DEADLINE_SECONDS = float(os.getenv('OAIPMH_REQUEST_DEADLINE_SECONDS', '25'))
 # Source metadata catalog (DataCite or FRDR)
 CATALOG_SET = os.getenv('OAIPMH_CATALOG', 'DataCite')
 # FRDR Postgres server
@@ -31,4 +43,145 @@ POSTGRES_USER = os.getenv('OAIPMH_POSTGRES_USER', '')
 # FRDR Postgres password
 POSTGRES_PASSWORD = os.getenv('OAIPMH_POSTGRES_PASSWORD', '')
 # FRDR Postgres port
-POSTGRES_PORT = os.getenv('OAIPMH_POSTGRES_PORT', '5432')
\ No newline at end of file
+POSTGRES_PORT = os.getenv('OAIPMH_POSTGRES_PORT', '5432')
+# Connections kept open per worker in the FRDR Postgres pool
+POSTGRES_POOL_MIN = int(os.getenv('OAIPMH_POSTGRES_POOL_MIN', '1'))
+# Maximum connections per worker in the FRDR Postgres pool
+POSTGRES_POOL_MAX = int(os.getenv('OAIPMH_POSTGRES_POOL_MAX', '4'))
+# Seconds to wait for a free FRDR Postgres connection before answering with a 503
+POSTGRES_POOL_TIMEOUT_SECONDS = float(os.getenv('OAIPMH_POSTGRES_POOL_TIMEOUT_SECONDS', '5'))
+# Records read per query, on a connection borrowed for it, when streaming FRDR records for bulk harvests
+POSTGRES_ITERSIZE = int(os.getenv('OAIPMH_POSTGRES_ITERSIZE', '2000'))
+# Use server-side prepared statements for the FRDR queries, disable behind pgbouncer transaction pooling
+POSTGRES_PREPARED_STATEMENTS = os.getenv('OAIPMH_POSTGRES_PREPARED_STATEMENTS', 'true').lower() == 'true'
+
+# Shared secret an admin sends in the X-Viringo-Stats header to read /stats, which is off without one
+STATS_SECRET = os.getenv('OAIPMH_STATS_SECRET', '')
+# Shared secret an admin sends in the X-Viringo-Profile header to profile a single request
+PROFILE_SECRET = os.getenv('OAIPMH_PROFILE_SECRET', '')
+# Profile every request, only intended for local debugging
+PROFILE_ALL_REQUESTS = os.getenv('OAIPMH_PROFILE_ALL_REQUESTS', 'false').lower() == 'true'
+# Directory that request profiles are written to
+PROFILE_DIR = os.getenv('OAIPMH_PROFILE_DIR', '/tmp/viringo-profiles')
+# Number of hot functions and allocation sites listed in a profile report
+PROFILE_TOP_N = int(os.getenv('OAIPMH_PROFILE_TOP_N', '30'))
+
+# Worker processes that build and render the records of a page in parallel, 0 renders in the request process
+RENDER_POOL_WORKERS = int(os.getenv('OAIPMH_RENDER_POOL_WORKERS', '0'))
+# Smallest page handed to the render pool, smaller pages are rendered in the request process
+RENDER_POOL_MIN_RECORDS = int(os.getenv('OAIPMH_RENDER_POOL_MIN_RECORDS', '100'))
+
+# Seconds open ended from windows are rounded up to when closed at a high-water mark
+INCREMENTAL_GRANULARITY = int(os.getenv('OAIPMH_INCREMENTAL_GRANULARITY', '60'))
+# Seconds the latest change of a set is remembered to answer empty incremental harvests, 0 disables
+INCREMENTAL_WATERMARK_TTL = int(os.getenv('OAIPMH_INCREMENTAL_WATERMARK_TTL', '0'))
+
+# Share one backend fetch between identical concurrent requests
+SINGLEFLIGHT_ENABLED = os.getenv('OAIPMH_SINGLEFLIGHT_ENABLED', 'true').lower() == 'true'
+
+# Consecutive failed or slow upstream calls after which calls fail fast
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('OAIPMH_CIRCUIT_FAILURE_THRESHOLD', '5'))
+# Seconds calls fail fast for before a trial call is let through, also sent as Retry-After
+CIRCUIT_RESET_SECONDS = int(os.getenv('OAIPMH_CIRCUIT_RESET_SECONDS', '30'))
+# Upstream calls slower than this many seconds count as failures
+CIRCUIT_SLOW_CALL_SECONDS = float(os.getenv('OAIPMH_CIRCUIT_SLOW_CALL_SECONDS', '10'))
+
+# Seconds a cached DataCite record or page is served without refreshing, see viringo.cache
+CACHE_FRESH_SECONDS = int(os.getenv('OAIPMH_CACHE_FRESH_SECONDS', '0'))
+# Further seconds a cached value is served while refreshed in the background
+CACHE_STALE_SECONDS = int(os.getenv('OAIPMH_CACHE_STALE_SECONDS', '0'))
+# Values kept per cached function
+CACHE_MAX_ENTRIES = int(os.getenv('OAIPMH_CACHE_MAX_ENTRIES', '1000'))
+# Threads running background refreshes
+CACHE_REFRESH_WORKERS = int(os.getenv('OAIPMH_CACHE_REFRESH_WORKERS', '2'))
+# Where cached values are kept: local (each process), shared (mmap file for the host) or redis
+CACHE_BACKEND = os.getenv('OAIPMH_CACHE_BACKEND', 'local')
+# File the shared cache backend maps
+CACHE_SHARED_PATH = os.getenv('OAIPMH_CACHE_SHARED_PATH', '/tmp/viringo-cache')
+# Slots in the shared cache, each holding one value
+CACHE_SHARED_SLOTS = int(os.getenv('OAIPMH_CACHE_SHARED_SLOTS', '1024'))
+# Bytes per shared cache slot, larger values are not cached
+CACHE_SHARED_SLOT_BYTES = int(os.getenv('OAIPMH_CACHE_SHARED_SLOT_BYTES', '262144'))
+# Redis server of the redis cache backend
+CACHE_REDIS_URL = os.getenv('OAIPMH_CACHE_REDIS_URL', 'redis://localhost:6379/0')
+# Seconds to wait for the redis server before treating a lookup as a miss
+CACHE_REDIS_TIMEOUT = float(os.getenv('OAIPMH_CACHE_REDIS_TIMEOUT', '0.5'))
+# Listen for FRDR change notifications in each worker to invalidate cached records, pages and sets
+FRDR_CACHE_LISTEN = os.getenv('OAIPMH_FRDR_CACHE_LISTEN', 'false').lower() == 'true'
+# Postgres channel the FRDR change triggers notify on
+FRDR_NOTIFY_CHANNEL = os.getenv('OAIPMH_FRDR_NOTIFY_CHANNEL', 'viringo_frdr')
+
+# Directory of pre-rendered ListRecords snapshots full harvests are answered from, empty disables
+SNAPSHOT_DIR = os.getenv('OAIPMH_SNAPSHOT_DIR', '')
+# Processes exporting the partitions of a snapshot in parallel
+SNAPSHOT_WORKERS = int(os.getenv('OAIPMH_SNAPSHOT_WORKERS', '2'))
+# Snapshots kept, so harvests started on an older one can finish
+SNAPSHOT_KEEP = int(os.getenv('OAIPMH_SNAPSHOT_KEEP', '2'))
+
+# Serve the JSON Lines bulk export and batch GetRecord endpoints, see viringo.export
+EXPORT_ENABLED = os.getenv('OAIPMH_EXPORT_ENABLED', 'false').lower() == 'true'
+# Most records sent in one export response before a continuation token
+EXPORT_MAX_RECORDS = int(os.getenv('OAIPMH_EXPORT_MAX_RECORDS', '10000'))
+# Most identifiers one batch GetRecord request at /oai/records.jsonl may ask for
+BATCH_MAX_IDENTIFIERS = int(os.getenv('OAIPMH_BATCH_MAX_IDENTIFIERS', '1000'))
+
+# Limit the requests of each client, see viringo.ratelimit
+RATE_LIMIT_ENABLED = os.getenv('OAIPMH_RATE_LIMIT_ENABLED', 'false').lower() == 'true'
+# Where the limits are kept: local (each process), shared (mmap file for the host) or redis (at CACHE_REDIS_URL)
+RATE_LIMIT_BACKEND = os.getenv('OAIPMH_RATE_LIMIT_BACKEND', 'local')
+# File the shared rate limit backend maps
+RATE_LIMIT_SHARED_PATH = os.getenv('OAIPMH_RATE_LIMIT_SHARED_PATH', '/tmp/viringo-ratelimit')
+# Clients whose limits the local and shared backends keep at once, the slots of the shared backend's file
+RATE_LIMIT_SLOTS = int(os.getenv('OAIPMH_RATE_LIMIT_SLOTS', '4096'))
+# Header harvesters identify themselves with, otherwise their address is used
+RATE_LIMIT_TOKEN_HEADER = os.getenv('OAIPMH_RATE_LIMIT_TOKEN_HEADER', 'X-Harvester-Token')
+# Comma separated tokens given out to harvesters, others sent in RATE_LIMIT_TOKEN_HEADER are ignored
+RATE_LIMIT_TOKENS = os.getenv('OAIPMH_RATE_LIMIT_TOKENS', '')
+# Take client addresses from X-Forwarded-For, only behind a proxy that sets it
+RATE_LIMIT_TRUST_FORWARDED = os.getenv('OAIPMH_RATE_LIMIT_TRUST_FORWARDED', 'false').lower() == 'true'
+# GetRecord, Identify, ListSets and ListMetadataFormats requests a second per client, 0 for no limit
+RATE_LIMIT_CHEAP_RATE = float(os.getenv('OAIPMH_RATE_LIMIT_CHEAP_RATE', '10'))
+# Cheap requests a client may make in a burst
+RATE_LIMIT_CHEAP_BURST = int(os.getenv('OAIPMH_RATE_LIMIT_CHEAP_BURST', '50'))
+# Cheap requests running at once in total, 0 for no limit
+RATE_LIMIT_CHEAP_CONCURRENCY = int(os.getenv('OAIPMH_RATE_LIMIT_CHEAP_CONCURRENCY', '0'))
+# ListRecords, ListIdentifiers and bulk requests a second per client, 0 for no limit
+RATE_LIMIT_EXPENSIVE_RATE = float(os.getenv('OAIPMH_RATE_LIMIT_EXPENSIVE_RATE', '1'))
+# Expensive requests a client may make in a burst
+RATE_LIMIT_EXPENSIVE_BURST = int(os.getenv('OAIPMH_RATE_LIMIT_EXPENSIVE_BURST', '5'))
+# Expensive requests running at once in total, keep below the workers so cheap requests get through, 0 for no limit
+RATE_LIMIT_EXPENSIVE_CONCURRENCY = int(os.getenv('OAIPMH_RATE_LIMIT_EXPENSIVE_CONCURRENCY', '0'))
+# Requests of one lane a client may have running at once, 0 for no limit
+RATE_LIMIT_CLIENT_CONCURRENCY = int(os.getenv('OAIPMH_RATE_LIMIT_CLIENT_CONCURRENCY', '2'))
+# Seconds after which a running request's place is given back even if its worker died
+RATE_LIMIT_LEASE_SECONDS = int(os.getenv('OAIPMH_RATE_LIMIT_LEASE_SECONDS', '300'))
+
+# Shed expensive requests when the service is saturated, see viringo.admission
+ADMISSION_ENABLED = os.getenv('OAIPMH_ADMISSION_ENABLED', 'false').lower() == 'true'
+# Requests a worker process runs at once before it is saturated, only useful with threaded workers, 0 for no limit
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv('OAIPMH_ADMISSION_MAX_IN_FLIGHT', '0'))
+# Average seconds requests wait in the proxy's queue, from X-Request-Start, before it is saturated, 0 for no limit
+ADMISSION_MAX_QUEUE_WAIT_SECONDS = float(os.getenv('OAIPMH_ADMISSION_MAX_QUEUE_WAIT_SECONDS', '2'))
+# Average seconds of a backend call before it is saturated, 0 for no limit
+ADMISSION_MAX_BACKEND_LATENCY_SECONDS = float(os.getenv('OAIPMH_ADMISSION_MAX_BACKEND_LATENCY_SECONDS', '5'))
+# Seconds shed harvesters are asked to wait at a pressure of 1, growing with the pressure up to 6 times that
+ADMISSION_RETRY_AFTER_SECONDS = int(os.getenv('OAIPMH_ADMISSION_RETRY_AFTER_SECONDS', '10'))
+
+# Run backend calls on the event loop with httpx and asyncpg under the ASGI entry point, see viringo.aio
+ASYNC_SERVICES = os.getenv('OAIPMH_ASYNC_SERVICES', 'true').lower() == 'true'
+# Threads of an ASGI worker handling requests, each waits on the event loop for its backend calls
+ASGI_THREADS = int(os.getenv('OAIPMH_ASGI_THREADS', '32'))
+# Connections to the DataCite API an ASGI worker keeps at most
+ASYNC_DATACITE_CONNECTIONS = int(os.getenv('OAIPMH_ASYNC_DATACITE_CONNECTIONS', '20'))
+
+# Page sizes by verb[:metadataPrefix[:backend]], e.g. ListIdentifiers=500,ListRecords:datacite=25, see viringo.pagesize
+PAGE_SIZES = os.getenv('OAIPMH_PAGE_SIZES', 'ListIdentifiers=200')
+# Size new harvests from the bytes and seconds records took in earlier pages
+PAGE_SIZE_ADAPTIVE = os.getenv('OAIPMH_PAGE_SIZE_ADAPTIVE', 'false').lower() == 'true'
+# Bytes an adaptively sized page should come close to, 0 for no target
+PAGE_TARGET_BYTES = int(os.getenv('OAIPMH_PAGE_TARGET_BYTES', '2000000'))
+# Seconds an adaptively sized page should take, keep well below the request deadline, 0 for no target
+PAGE_TARGET_SECONDS = float(os.getenv('OAIPMH_PAGE_TARGET_SECONDS', '5'))
+# Smallest and largest adaptively sized pages, the DataCite API pages up to 1000
+PAGE_SIZE_MIN = int(os.getenv('OAIPMH_PAGE_SIZE_MIN', '10'))
+PAGE_SIZE_MAX = int(os.getenv('OAIPMH_PAGE_SIZE_MAX', '1000'))
@@ -0,0 +1,45 @@
+"""Fast parsing of the datestamps found in backend data
+
+Nearly every datestamp the backends return is ISO 8601, which
+datetime.fromisoformat parses far faster than dateutil's general parser.
+Anything else falls back to dateutil, so results are the same either way.
+Values are memoized as the FRDR publication dates repeat heavily.
+"""
+
+import functools
+import re
+from datetime import datetime
+
+import dateutil.parser
+import dateutil.tz
+
+# Trailing Z for UTC, which datetime.fromisoformat only accepts from Python 3.11
+ZULU = re.compile(r'[zZ]$')
+
+# Fractional seconds that are not 3 or 6 digits, which older fromisoformat rejects
+ODD_FRACTION = re.compile(r'\.(\d{1,2}|\d{4,5}|\d{7,})(?=$|[+-])')
+
+# Number of distinct datestamps remembered
+CACHE_SIZE = 8192
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def parse(value):
+    """Parse a datestamp the way dateutil.parser.parse does"""
+    iso_value = ZULU.sub('+00:00', value.strip())
+    # A bare year or year-month is filled in from today's date by dateutil
+    if len(iso_value) >= 10 and not ODD_FRACTION.search(iso_value):
+        try:
+            return datetime.fromisoformat(iso_value)
+        except ValueError:
+            pass
+    return dateutil.parser.parse(value)
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def to_utc(value):
+    """Parse a datestamp and convert it to a naive UTC datetime, as OAI always works in UTC
+
+    Naive datestamps are taken to be in local time, as datetime.astimezone does.
+    """
+    return parse(value).astimezone(dateutil.tz.UTC).replace(tzinfo=None)
@@ -0,0 +1,88 @@
+"""Request-scoped deadline budget
+
+oai.index gives each request REQUEST_DEADLINE_SECONDS to answer in, and
+Resumption.handleVerb makes that deadline current while the verb runs. Backend
+calls made on the request's behalf take their HTTP timeouts and Postgres
+statement_timeout from what is left of it, and check it between steps, so a
+request that has run out of time stops working instead of finishing an answer
+the harvester has already given up on.
+
+Background work such as cache refreshes runs outside any request and has no
+deadline.
+"""
+
+import contextvars
+import time
+from contextlib import contextmanager
+
+from viringo import circuit
+
+
+class DeadlineExceeded(circuit.BackendUnavailable):
+    """The request ran out of time, answered with a 503 like an unavailable backend"""
+
+
+class Deadline:
+    """A point in time a request has to be answered by"""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self):
+        """Seconds left, never negative"""
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        """Whether the budget is used up"""
+        return self.remaining() <= 0
+
+    def check(self):
+        """Raise DeadlineExceeded once the budget is used up"""
+        if self.expired():
+            raise DeadlineExceeded('Request exceeded its %ss deadline' % self.seconds)
+
+
+_current = contextvars.ContextVar('viringo_deadline', default=None)
+
+
+def current():
+    """The deadline of the request being handled, or None"""
+    return _current.get()
+
+
+@contextmanager
+def activate(deadline):
+    """Make deadline current for the calls made inside the block"""
+    token = _current.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current.reset(token)
+
+
+def check():
+    """Raise DeadlineExceeded when the current deadline is used up"""
+    deadline = current()
+    if deadline is not None:
+        deadline.check()
+
+
+def remaining():
+    """Seconds left of the current deadline, or None without one"""
+    deadline = current()
+    if deadline is None:
+        return None
+    return deadline.remaining()
+
+
+def timeout(ceiling):
+    """Timeout for a backend call: the remaining budget, at most ceiling
+
+    Raises DeadlineExceeded instead of returning a timeout of zero.
+    """
+    deadline = current()
+    if deadline is None:
+        return ceiling
+    deadline.check()
+    return min(ceiling, deadline.remaining())
@@ -0,0 +1,202 @@
+"""Bulk export of records as JSON Lines for internal consumers
+
+GET /oai/export.jsonl streams the metadata map each catalog builds for OAI
+metadata writers, one record per line, without the XML envelopes harvesters
+need:
+
+    {"identifier": ..., "datestamp": ..., "sets": [...], "deleted": false, "metadata": {...}}
+
+set, from and until filter the records like the OAI arguments, and limit
+caps the records of a response at EXPORT_MAX_RECORDS. The last line is
+{"continuation": token}, where the token resumes after the last record sent.
+It is null once every record has been sent. A response without this line was
+cut short and is resumed from the previous token. The token is a keyset
+position, the record_uuid for FRDR and the paging cursor of the mirror or the
+API for DataCite, and it carries the filters.
+
+/oai/records.jsonl resolves many OAI identifiers at once, given as
+identifier arguments or one per line in a POST body. It sends a line per
+identifier in the order asked, either a record line or
+{"identifier": ..., "error": "idDoesNotExist"}. FRDR records are looked up
+BATCH_CHUNK at a time with one query per table, and DataCite DOIs from the
+mirror or concurrently from the API.
+
+Responses are gzipped for clients that accept it.
+"""
+
+import base64
+import binascii
+import itertools
+import json
+import logging
+import zlib
+from datetime import datetime
+
+import oaipmh.datestamp
+import oaipmh.error
+from flask import Response, jsonify
+
+from viringo import config
+
+
+# Identifiers resolved together in a batch GetRecord request
+BATCH_CHUNK = 100
+
+
+class ExportError(ValueError):
+    """The export arguments can't be understood"""
+
+
+def encode_token(filters, position):
+    """The continuation token resuming after position"""
+    value = dict(filters, position=position)
+    return base64.urlsafe_b64encode(json.dumps(value, separators=(',', ':')).encode('utf-8')).decode('ascii')
+
+
+def decode_token(token, parse_position=None):
+    """The filters and position of a continuation token
+
+    parse_position checks the position is one the catalog hands out, raising
+    ValueError when it is not, and returns it as export_records takes it.
+    """
+    try:
+        value = json.loads(base64.urlsafe_b64decode(token.encode('ascii')).decode('utf-8'))
+        position = value.pop('position')
+        if parse_position is not None:
+            position = parse_position(position)
+    except (ValueError, KeyError, AttributeError, TypeError, binascii.Error) as err:
+        raise ExportError('Bad continuation token') from err
+    return value, position
+
+
+def parse_filters(request_args, parse_position=None):
+    """The set, from and until of a request as the token keeps them, and the catalog arguments"""
+    if request_args.get('token'):
+        filters, position = decode_token(request_args['token'], parse_position)
+    else:
+        filters = {name: request_args[name] for name in ['set', 'from', 'until'] if request_args.get(name)}
+        position = None
+
+    try:
+        kwargs = {
+            'set': filters.get('set'),
+            'from_': oaipmh.datestamp.datestamp_to_datetime(filters['from']) if filters.get('from') else None,
+            'until': oaipmh.datestamp.datestamp_to_datetime(filters['until'], inclusive=True)
+                     if filters.get('until') else None,
+            'position': position
+        }
+    except oaipmh.error.DatestampError as err:
+        raise ExportError('Bad from or until datestamp') from err
+    return filters, kwargs
+
+
+def to_json(value):
+    """json.dumps default for the values metadata maps hold"""
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    if isinstance(value, datetime):
+        return value.isoformat() + 'Z'
+    return str(value)
+
+
+def record_line(catalog, result):
+    """A result as a line of json"""
+    header = catalog.build_header(result)
+    line = {
+        'identifier': header.identifier(),
+        'datestamp': header.datestamp().isoformat() + 'Z',
+        'sets': header.setSpec(),
+        'deleted': header.isDeleted(),
+        'metadata': catalog.build_metadata_map(result)
+    }
+    return json.dumps(line, default=to_json, ensure_ascii=False) + '\n'
+
+
+def export_lines(catalog, records, filters, limit):
+    """The lines of a response, records being an iterator of (result, position) pairs"""
+    position = None
+    sent = 0
+    finished = True
+    for result, position in records:
+        yield record_line(catalog, result)
+        sent += 1
+        if sent >= limit:
+            finished = False
+            break
+    token = None if finished else encode_token(filters, position)
+    yield json.dumps({'continuation': token}) + '\n'
+
+
+def gzipped(lines):
+    """Compress lines into gzip chunks as they are generated"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for line in lines:
+        chunk = compressor.compress(line.encode('utf-8'))
+        if chunk:
+            yield chunk
+    yield compressor.flush()
+
+
+def response(catalog, request_args, accept_encoding=''):
+    """A streamed JSON Lines response for the export arguments"""
+    try:
+        filters, kwargs = parse_filters(request_args, catalog.parse_export_position)
+        limit = min(int(request_args.get('limit', config.EXPORT_MAX_RECORDS)), config.EXPORT_MAX_RECORDS)
+    except (ExportError, ValueError) as err:
+        return jsonify({'error': str(err)}), 400
+    if limit < 1:
+        return jsonify({'error': 'limit must be positive'}), 400
+
+    records = catalog.export_records(**kwargs)
+    # Fetch the first page now, so unavailable backends and bad sets are answered with a status
+    try:
+        first = next(records)
+    except StopIteration:
+        records = iter([])
+    else:
+        records = itertools.chain([first], records)
+
+    return stream(export_lines(catalog, records, filters, limit), accept_encoding)
+
+
+def logged(lines):
+    """Log an error that cuts a stream short, as the status has already been sent"""
+    try:
+        yield from lines
+    except Exception:
+        logging.exception("Export cut short")
+
+
+def stream(lines, accept_encoding=''):
+    """A streamed JSON Lines response, gzipped when the client accepts it"""
+    if 'gzip' in accept_encoding:
+        streamed = Response(logged(gzipped(lines)), mimetype='application/jsonl')
+        streamed.headers['Content-Encoding'] = 'gzip'
+    else:
+        streamed = Response(logged(line.encode('utf-8') for line in lines), mimetype='application/jsonl')
+    streamed.headers['Vary'] = 'Accept-Encoding'
+    return streamed
+
+
+def batch_lines(catalog, identifiers, first_results):
+    """The lines of a batch response, resolving the identifiers after the first chunk as they are sent"""
+    for start in range(0, len(identifiers), BATCH_CHUNK):
+        chunk = identifiers[start:start + BATCH_CHUNK]
+        results = first_results if start == 0 else catalog.get_records(chunk)
+        for identifier in chunk:
+            if identifier in results:
+                yield record_line(catalog, results[identifier])
+            else:
+                yield json.dumps({'identifier': identifier, 'error': 'idDoesNotExist'}) + '\n'
+
+
+def batch_response(catalog, identifiers, accept_encoding=''):
+    """A streamed JSON Lines response of the records of many OAI identifiers"""
+    if not identifiers:
+        return jsonify({'error': 'No identifier given'}), 400
+    if len(identifiers) > config.BATCH_MAX_IDENTIFIERS:
+        return jsonify({'error': 'At most %d identifiers' % config.BATCH_MAX_IDENTIFIERS}), 400
+
+    # Resolve the first chunk now, so unavailable backends are answered with a status
+    first_results = catalog.get_records(identifiers[:BATCH_CHUNK])
+    return stream(batch_lines(catalog, identifiers, first_results), accept_encoding)
@@ -0,0 +1,107 @@
+"""Incremental harvest support for from/until requests
+
+Open ended windows (from without until) are closed at a high-water mark: the
+next INCREMENTAL_GRANULARITY boundary after the request. Concurrent
+incremental harvests then send the backends identical queries, and the mark is
+frozen into the resumption token so later pages see the same window.
+
+The latest change of each set can also be remembered as a watermark for
+INCREMENTAL_WATERMARK_TTL seconds, so an incremental harvest starting after
+the set last changed is answered with noRecordsMatch without asking the
+backend for a page. A change made after the watermark was looked up is not seen
+until it expires, so harvesters should overlap their windows by the TTL.
+Watermarks are kept in the cache store, so with a shared or redis backend a
+change listener forgets them for every worker, see viringo.cache_stores.
+"""
+
+import calendar
+import logging
+import time
+from datetime import datetime
+
+from viringo import cache
+from viringo import cache_stores
+from viringo import config
+
+
+def high_water_mark(now=None):
+    """The until an open ended window is closed at, the next granularity boundary after now
+
+    Rounding up keeps the mark at or after the responseDate, which harvesters
+    use as the from of their next harvest, so no change falls between the two.
+    """
+    now = now or datetime.utcnow()
+    granularity = max(1, config.INCREMENTAL_GRANULARITY)
+    seconds = calendar.timegm(now.utctimetuple())
+    if now.microsecond:
+        seconds += 1
+    return datetime.utcfromtimestamp(-(-seconds // granularity) * granularity)
+
+
+def freeze_window(kw):
+    """Close an open ended from window at the high-water mark"""
+    if kw.get('from_') is not None and kw.get('until') is None:
+        kw['until'] = high_water_mark()
+    return kw
+
+
+def to_timestamp(value):
+    """Seconds since the epoch of a naive UTC datetime"""
+    return calendar.timegm(value.utctimetuple())
+
+
+class Watermarks:
+    """The latest change of each set, remembered for a limited time"""
+
+    namespace = 'incremental.watermarks'
+
+    def __init__(self):
+        self._local = cache_stores.LocalStore(config.CACHE_MAX_ENTRIES)
+
+    @property
+    def store(self):
+        """The cache store shared between workers, or a store private to this process"""
+        return cache.get_store() or self._local
+
+    def latest(self, key, latest_change):
+        """Return the remembered latest change for key, calling latest_change when it has expired"""
+        # Wall clock time, as watermarks in shared stores are read by other processes
+        now = time.time()
+        try:
+            cached = self.store.get(self.namespace, key)
+        except cache_stores.StoreError:
+            logging.warning("Couldn't read watermark %s from the cache store", key, exc_info=True)
+            cached = None
+        if cached is not None and now - cached[0] < config.INCREMENTAL_WATERMARK_TTL:
+            return cached[1]
+
+        latest = latest_change()
+        try:
+            self.store.set(self.namespace, key, (now, latest))
+        except cache_stores.StoreError:
+            logging.warning("Couldn't store watermark %s in the cache store", key, exc_info=True)
+        return latest
+
+    def forget(self, key):
+        """Forget the watermark of key, e.g. once its set is known to have changed"""
+        self.store.delete(self.namespace, key)
+
+    def clear(self):
+        """Forget every watermark"""
+        self.store.clear(self.namespace)
+
+
+WATERMARKS = Watermarks()
+
+
+def nothing_changed(key, from_, paging_cursor, latest_change):
+    """Whether the first page of an incremental harvest is known to be empty
+
+    latest_change is called to look up the latest change of the set as a naive
+    UTC datetime, or None when the set has no records, when no watermark is remembered.
+    """
+    if from_ is None or paging_cursor or config.INCREMENTAL_WATERMARK_TTL <= 0:
+        return False
+
+    latest = WATERMARKS.latest(key, latest_change)
+    return latest is None or latest < from_
@@ -3,6 +3,7 @@
 import re
 import ftfy
 from lxml import etree
+import oaipmh.metadata
 
 NS_OAIPMH = 'http://www.openarchives.org/OAI/2.0/'
 NS_XSI = 'http://www.w3.org/2001/XMLSchema-instance'
@@ -97,3 +98,11 @@ def oai_datacite_writer(element: etree.Element, metadata):
     e_payload = etree.SubElement(e_oai_datacite, 'payload')
 
     e_payload.append(xml_resource_element)
+
+def metadata_registry():
+    """Registry with the writers of every metadata format served"""
+    registry = oaipmh.metadata.MetadataRegistry()
+    registry.registerWriter('oai_dc', oai_dc_writer)
+    registry.registerWriter('oai_datacite', oai_datacite_writer)
+    registry.registerWriter('datacite', datacite_writer)
+    return registry
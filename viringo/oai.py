@@ -1,10 +1,11 @@
 """OAI-PMH main request handling"""
 
-from xml.dom import minidom
+import time
+from lxml import etree
 from lxml.etree import ElementTree, Element, SubElement
 
 from flask import (
-    Blueprint, g, request, current_app
+    Blueprint, Response, g, request, current_app
 )
 import oaipmh.common
 import oaipmh.metadata
@@ -14,7 +15,18 @@ import oaipmh.datestamp
 from .catalogs import DataCiteOAIServer
 from .catalogs import FRDROAIServer
 from . import metadata
+from . import admission
+from . import circuit
 from . import config
+from . import deadline
+from . import export
+from . import incremental
+from . import pagesize
+from . import profiling
+from . import ratelimit
+from . import render
+from . import snapshots
+from .services import frdr_notify
 
 import sys
 
@@ -26,6 +38,56 @@ class XMLTreeServer(oaipmh.server.XMLTreeServer):
             server,
             metadata_registry,
             nsmap)
+        # Fragments rendered on the render pool for the response being built
+        self.fragments = []
+
+    def serialize(self, tree):
+        """The response tree as XML, with the fragments of the render pool spliced in"""
+        xml = etree.tostring(tree.getroot(), encoding='UTF-8', xml_declaration=True, pretty_print=True)
+        fragments, self.fragments = self.fragments, []
+        return render.splice(xml, fragments)
+
+    def listIdentifiers(self, **kw):
+        envelope, e_list_identifiers = self._outputEnvelope(
+            verb='ListIdentifiers', **kw)
+        def output_func(element, headers, token_kw):
+            for header in headers:
+                # Headers rendered on the render pool are spliced in as they are
+                if isinstance(header, render.Fragment):
+                    element.append(render.placeholder(self.fragments, header))
+                else:
+                    self._outputHeader(element, header)
+        self._outputResuming(
+            e_list_identifiers,
+            self._server.listIdentifiers,
+            output_func,
+            kw)
+        return envelope
+
+    def listRecords(self, **kw):
+        envelope, e_list_records = self._outputEnvelope(
+            verb='ListRecords', **kw)
+        def output_func(element, records, token_kw):
+            self.outputRecords(element, records, token_kw['metadataPrefix'])
+        self._outputResuming(
+            e_list_records,
+            self._server.listRecords,
+            output_func,
+            kw)
+        return envelope
+
+    def outputRecords(self, element, records, metadata_prefix):
+        """Append the records of a ListRecords page to its element"""
+        for record in records:
+            # Records rendered on the render pool are spliced in as they are
+            if isinstance(record, render.Fragment):
+                element.append(render.placeholder(self.fragments, record))
+                continue
+            header, metadata_record, _ = record
+            e_record = SubElement(element, '{%s}%s' % (metadata.NS_OAIPMH, 'record'))
+            self._outputHeader(e_record, header)
+            if not header.isDeleted():
+                self._outputMetadata(e_record, metadata_prefix, metadata_record)
 
     def _outputResuming(self, element, input_func, output_func, kw):
         if 'resumptionToken' in kw:
@@ -48,36 +110,65 @@ class XMLTreeServer(oaipmh.server.XMLTreeServer):
 
 class Server(oaipmh.server.ServerBase):
     """Expects to be initialized with a IOAI server implementation."""
-    def __init__(self, server, metadata_registry=None, nsmap=None):
-        resumption_server = Resumption(server)
+    def __init__(self, server, metadata_registry=None, nsmap=None, request_deadline=None):
+        resumption_server = Resumption(server, request_deadline)
         super(Server, self).__init__(
             resumption_server,
             metadata_registry,
             nsmap)
         # Override the XML tree writing server for some custom output
         self._tree_server = XMLTreeServer(resumption_server, metadata_registry, nsmap)
+        self.resumption_server = resumption_server
+
+    def handleVerb(self, verb, kw):
+        method = oaipmh.common.getMethodForVerb(self._tree_server, verb)
+        return self._tree_server.serialize(method(**kw))
 
 class Resumption(oaipmh.common.ResumptionOAIPMH):
     """ A custom resumption server based on the pyoai implementation
     This class exists because we have to handle resumption tokens ourselves to support
     arbitrary cursors that might be passed around i.e. custom cursor from an api.
     We handle this by allowing a paging_cursor to be specified as an additional kw arg.
+    The page_size of a harvest, see viringo.pagesize, is kept in its tokens the same way.
+    Verbs run with the request's deadline current, see viringo.deadline.
     """
-    def __init__(self, server):
+    def __init__(self, server, request_deadline=None):
         self._server = server
+        self._deadline = request_deadline
+        # The verb, metadata prefix and number of records of the last page listed
+        self.last_page = None
 
     def handleVerb(self, verb, kw):
+        with deadline.activate(self._deadline):
+            return self._handle_verb(verb, kw)
+
+    def _handle_verb(self, verb, kw):
         # Get the method that matches the verb we want to call.
         method = oaipmh.common.getMethodForVerb(self._server, verb)
 
         if 'resumptionToken' in kw:
             # Handling a resumption token, so work out arguments for next method
             kw, _ = oaipmh.server.decodeResumptionToken(kw['resumptionToken'])
+            if verb not in ['ListIdentifiers', 'ListRecords']:
+                kw.pop('page_size', None)
+            elif 'page_size' in kw:
+                try:
+                    kw['page_size'] = pagesize.from_token(kw['page_size'])
+                except ValueError:
+                    raise oaipmh.error.BadResumptionTokenError('The page size of the resumption token is invalid')
+        else:
+            # Close an open ended from window at a high-water mark, which the
+            # resumption token then keeps for every later page
+            incremental.freeze_window(kw)
+            if verb in ['ListIdentifiers', 'ListRecords']:
+                kw['page_size'] = pagesize.choose(verb, kw.get('metadataPrefix'))
 
         if verb in ['ListSets', 'ListIdentifiers', 'ListRecords']:
             # Call underlying method to get results
             result, total_records, resume_cursor = method(**kw)
             kw['paging_cursor'] = resume_cursor
+            if verb != 'ListSets':
+                self.last_page = (verb, kw.get('metadataPrefix'), len(result))
 
             # When a cursor exists more results can be resumed, otherwise it's the end.
             if resume_cursor:
@@ -94,19 +185,73 @@ class Resumption(oaipmh.common.ResumptionOAIPMH):
             result = method(**kw)
             return result
 
-def get_oai_server():
+@BP.errorhandler(circuit.BackendUnavailable)
+def backend_unavailable(err):
+    """Ask harvesters to come back later while a backend is unavailable"""
+    current_app.logger.warning("Backend unavailable: %s", err)
+    response = Response(
+        'The repository backend is temporarily unavailable, please retry later.\n',
+        status=503, mimetype='text/plain')
+    if err.retry_after:
+        response.headers['Retry-After'] = str(err.retry_after)
+    return response
+
+def retry_later(message, retry_after):
+    """A 503 asking the client to come back after retry_after seconds"""
+    response = Response(message, status=503, mimetype='text/plain')
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+@BP.errorhandler(ratelimit.RateLimited)
+def rate_limited(err):
+    """Ask a harvester over its limits to come back later"""
+    current_app.logger.info("Rate limited: %s", err)
+    return retry_later('Too many requests, please retry after %d seconds.\n' % err.retry_after, err.retry_after)
+
+@BP.errorhandler(admission.Overloaded)
+def overloaded(err):
+    """Ask a harvester to come back once the service is less busy"""
+    current_app.logger.info("Overloaded: %s", err)
+    return retry_later('The repository is busy, please retry after %d seconds.\n' % err.retry_after,
+                       err.retry_after)
+
+@BP.before_request
+def admit_request():
+    """Shed requests under overload and apply the client's rate limits, see viringo.admission and viringo.ratelimit"""
+    # The bulk endpoints have no verb and are treated as list harvests
+    verb = request.values.get('verb', 'Identify') if request.endpoint == 'oai.index' else None
+    g.releases = []
+    if config.ADMISSION_ENABLED:
+        g.releases.append(admission.admit(verb, 'resumptionToken' in request.values, request.headers))
+    if config.RATE_LIMIT_ENABLED:
+        g.releases.append(ratelimit.admit(verb, request.headers, request.remote_addr))
+
+@BP.after_request
+def release_on_close(response):
+    """Hold the request's tickets and leases until a streamed response has been sent"""
+    for held in g.pop('releases', []):
+        response.call_on_close(held.release)
+    return response
+
+@BP.teardown_request
+def release_on_error(exc):
+    """Give back the tickets and leases of a request that failed without a response"""
+    for held in g.pop('releases', []):
+        held.release()
+
+def get_catalog_server():
+    """The catalog the OAI requests are answered from"""
+    if config.CATALOG_SET == 'FRDR':
+        if config.FRDR_CACHE_LISTEN:
+            # Started lazily so each forked worker gets its own, see viringo.services.frdr_notify
+            frdr_notify.start_listener()
+        return FRDROAIServer()
+    return DataCiteOAIServer()
+
+def get_oai_server(request_deadline=None):
     """Returns a pyoai server object that can process and return OAI requests"""
     if 'oai' not in g:
-        if config.CATALOG_SET == 'FRDR':
-            catalog_server = FRDROAIServer()
-        else:
-            catalog_server = DataCiteOAIServer()
-
-        metadata_registry = oaipmh.metadata.MetadataRegistry()
-        metadata_registry.registerWriter('oai_dc', metadata.oai_dc_writer)
-        metadata_registry.registerWriter('oai_datacite', metadata.oai_datacite_writer)
-        metadata_registry.registerWriter('datacite', metadata.datacite_writer)
-        oai = Server(catalog_server, metadata_registry)
+        oai = Server(get_catalog_server(), metadata.metadata_registry(), request_deadline=request_deadline)
 
         g.oai = oai
 
@@ -140,20 +285,72 @@ def index():
 
     current_app.logger.info("OAI request %s", oai_request_args['verb'], extra=oai_request_args)
 
+    # Full harvests are answered from pre-rendered pages when exported, see viringo.snapshots
+    snapshot_page = snapshots.page_for_request(oai_request_args)
+    if snapshot_page is not None:
+        return snapshots.send_page(snapshot_page)
+
+    # The time budget backend calls made for this request share, profiled or not
+    request_deadline = None
+    if config.REQUEST_DEADLINE_SECONDS > 0:
+        request_deadline = deadline.Deadline(config.REQUEST_DEADLINE_SECONDS)
+
+    # Opt-in profiling of just this request, see viringo.profiling
+    if profiling.profiling_requested(request.headers):
+        profile = profiling.RequestProfile(oai_request_args)
+        xml = profile.run(handle_oai_request, oai_request_args, request_deadline)
+        current_app.logger.info("Profiled OAI request %s", profile.profile_id)
+
+        if profiling.report_requested(request.headers):
+            response = Response(profile.report(), mimetype='text/plain')
+        else:
+            response = current_app.response_class(xml)
+        response.headers[profiling.PROFILE_ID_HEADER] = profile.profile_id
+        return response
+
+    return handle_oai_request(oai_request_args, request_deadline)
+
+@BP.route('/export.jsonl')
+def export_jsonl():
+    """Stream records as JSON Lines for internal consumers, see viringo.export"""
+    if not config.EXPORT_ENABLED:
+        return Response('Not found\n', status=404, mimetype='text/plain')
+    return export.response(get_catalog_server(), request.args, request.headers.get('Accept-Encoding', ''))
+
+@BP.route('/records.jsonl', methods=['GET', 'POST'])
+def records_jsonl():
+    """Resolve many identifiers at once as JSON Lines, a batch GetRecord, see viringo.export"""
+    if not config.EXPORT_ENABLED:
+        return Response('Not found\n', status=404, mimetype='text/plain')
+    identifiers = request.values.getlist('identifier')
+    if not identifiers and request.method == 'POST' and not request.form:
+        identifiers = request.get_data(as_text=True).split()
+    return export.batch_response(get_catalog_server(), identifiers, request.headers.get('Accept-Encoding', ''))
+
+def handle_oai_request(oai_request_args, request_deadline=None):
+    """Process the OAI request arguments and return the response xml"""
+
     # Obtain a OAI-PMH server interface to handle requests
-    oai = get_oai_server()
+    oai = get_oai_server(request_deadline)
 
     # Handle a request for a specific verb
-    xml = oai.handleRequest(oai_request_args)
-
-    # This isn't the prettiest way but we need to add the xsl stylesheet
-    dom = minidom.parseString(xml)
-    process_instruction = dom.createProcessingInstruction(
-        'xml-stylesheet',
-        'type="text/xsl" href="/viringo/static/oaitohtml.xsl"'
-    )
-    root = dom.firstChild
-    dom.insertBefore(process_instruction, root)
-    xml = dom.toxml()
+    started = time.monotonic()
+    xml = add_stylesheet(oai.handleRequest(oai_request_args))
+
+    # What list pages cost sizes later harvests, see viringo.pagesize. The
+    # response is UTF-8 encoded bytes, so its length is what is sent
+    if oai.resumption_server.last_page is not None:
+        verb, metadata_prefix, records = oai.resumption_server.last_page
+        pagesize.observe(verb, metadata_prefix, records, len(xml), time.monotonic() - started)
 
     return xml
+
+# Processing instruction of the xsl stylesheet browsers render responses with
+STYLESHEET = b'<?xml-stylesheet type="text/xsl" href="/viringo/static/oaitohtml.xsl"?>'
+
+def add_stylesheet(xml):
+    """Add the processing instruction of the xsl stylesheet browsers render responses with"""
+
+    # Inserted after the XML declaration rather than by parsing the whole response again
+    declaration_end = xml.index(b'?>') + len(b'?>') if xml.startswith(b'<?xml ') else 0
+    return xml[:declaration_end] + b'\n' + STYLESHEET + xml[declaration_end:]
@@ -0,0 +1,156 @@
+"""Page sizes of ListRecords and ListIdentifiers harvests
+
+PAGE_SIZES sets the size of pages by verb, metadata prefix and backend, as
+comma separated verb[:prefix[:backend]]=size entries, e.g.
+
+    ListIdentifiers=500,ListRecords:oai_dc=100,ListRecords:datacite=25,ListRecords:*:frdr=40
+
+'*' matches anything. The entry matching the most parts applies, otherwise
+RESULT_SET_SIZE. A header is much smaller than a record, so ListIdentifiers
+harvests can take far fewer requests.
+
+With PAGE_SIZE_ADAPTIVE each worker keeps moving averages of the bytes and
+seconds a record takes in each kind of page. New harvests are then sized so a
+page comes close to PAGE_TARGET_BYTES and PAGE_TARGET_SECONDS, within
+PAGE_SIZE_MIN and PAGE_SIZE_MAX.
+
+The size a harvest starts with is kept in its resumption token, so all its
+pages have the same size whatever is learnt meanwhile. Clients can edit the
+token, so the size read back is kept within PAGE_SIZE_MIN and PAGE_SIZE_MAX.
+"""
+
+import logging
+import threading
+
+from viringo import config
+
+# Weight of a new page in the moving averages
+SMOOTHING = 0.2
+# Pages of a kind observed before their cost is trusted
+MIN_PAGES = 3
+
+
+def backend_name():
+    """The backend pages are listed from"""
+    return 'frdr' if config.CATALOG_SET == 'FRDR' else 'datacite'
+
+
+def parse_sizes(value):
+    """The (verb, prefix, backend) keys and sizes of a PAGE_SIZES value
+
+    Malformed entries are logged and left out, so their pages keep the size
+    of the next best matching entry, or RESULT_SET_SIZE.
+    """
+    sizes = {}
+    for entry in value.split(','):
+        if not entry.strip():
+            continue
+        try:
+            key, size = entry.split('=')
+            parts = [part.strip() or '*' for part in key.split(':')]
+            size = int(size)
+            if size < 1 or len(parts) > 3:
+                raise ValueError(entry)
+        except ValueError:
+            logging.warning("Ignoring malformed page size %r", entry.strip())
+            continue
+        parts += ['*'] * (3 - len(parts))
+        sizes[tuple(parts)] = size
+    return sizes
+
+
+_configured = {'value': None, 'sizes': {}}
+
+
+def configured_sizes():
+    """The parsed PAGE_SIZES, parsed again when it changes"""
+    if _configured['value'] != config.PAGE_SIZES:
+        _configured['sizes'] = parse_sizes(config.PAGE_SIZES)
+        _configured['value'] = config.PAGE_SIZES
+    return _configured['sizes']
+
+
+def static_size(verb, metadata_prefix, backend=None):
+    """The configured size of a kind of page"""
+    wanted = (verb, metadata_prefix, backend or backend_name())
+    best, best_matched = config.RESULT_SET_SIZE, -1
+    for key, size in configured_sizes().items():
+        if all(part in ('*', value) for part, value in zip(key, wanted)):
+            matched = sum(part != '*' for part in key)
+            if matched > best_matched:
+                best, best_matched = size, matched
+    return best
+
+
+class PageCost:
+    """Moving averages of the bytes and seconds a record takes in a kind of page"""
+
+    def __init__(self):
+        self.pages = 0
+        self.bytes = 0.0
+        self.seconds = 0.0
+
+    def observe(self, records, size, seconds):
+        """Add a page"""
+        weight = 1.0 if self.pages == 0 else SMOOTHING
+        self.bytes = (1 - weight) * self.bytes + weight * size / records
+        self.seconds = (1 - weight) * self.seconds + weight * seconds / records
+        self.pages += 1
+
+
+_costs = {}
+_costs_lock = threading.Lock()
+
+
+def observe(verb, metadata_prefix, records, size, seconds):
+    """Record the size in bytes and time taken of a page of records"""
+    if not config.PAGE_SIZE_ADAPTIVE or not records:
+        return
+    with _costs_lock:
+        cost = _costs.setdefault((verb, metadata_prefix, backend_name()), PageCost())
+        cost.observe(records, size, seconds)
+
+
+def choose(verb, metadata_prefix):
+    """The size of the pages of a new harvest"""
+    size = static_size(verb, metadata_prefix)
+    if not config.PAGE_SIZE_ADAPTIVE:
+        return size
+
+    with _costs_lock:
+        cost = _costs.get((verb, metadata_prefix, backend_name()))
+        if cost is None or cost.pages < MIN_PAGES:
+            return size
+        fits = []
+        if config.PAGE_TARGET_BYTES > 0 and cost.bytes > 0:
+            fits.append(config.PAGE_TARGET_BYTES / cost.bytes)
+        if config.PAGE_TARGET_SECONDS > 0 and cost.seconds > 0:
+            fits.append(config.PAGE_TARGET_SECONDS / cost.seconds)
+    if not fits:
+        return size
+    return int(max(config.PAGE_SIZE_MIN, min(config.PAGE_SIZE_MAX, min(fits))))
+
+
+def from_token(value):
+    """The page size kept in a resumption token, raising ValueError when it is not a number"""
+    return max(config.PAGE_SIZE_MIN, min(config.PAGE_SIZE_MAX, int(value)))
+
+
+def stats():
+    """The learnt costs and the sizes new harvests get, in this worker process"""
+    with _costs_lock:
+        costs = dict(_costs)
+    return {
+        '%s:%s:%s' % key: {
+            'pages': cost.pages,
+            'bytes_per_record': round(cost.bytes),
+            'seconds_per_record': round(cost.seconds, 4),
+            'page_size': choose(key[0], key[1]),
+        } for key, cost in costs.items()
+    }
+
+
+def reset():
+    """Forget the learnt costs, e.g. between tests"""
+    with _costs_lock:
+        _costs.clear()
@@ -0,0 +1,120 @@
+"""On-demand profiling of individual OAI-PMH requests
+
+Profiling is opt-in per request, either by an admin sending the configured
+secret in the X-Viringo-Profile header or by enabling it for every request
+via the environment. When neither applies the only cost is a header lookup.
+"""
+
+import cProfile
+import hmac
+import io
+import json
+import os
+import pstats
+import time
+import tracemalloc
+import uuid
+
+from viringo import config
+
+# Header used by an admin to request a profile of a single request
+PROFILE_HEADER = 'X-Viringo-Profile'
+# Header used to ask for the text report to be returned instead of the OAI response
+PROFILE_RETURN_HEADER = 'X-Viringo-Profile-Return'
+# Response header that carries the id of the saved profile
+PROFILE_ID_HEADER = 'X-Viringo-Profile-Id'
+
+
+def profiling_requested(headers):
+    """Decide whether the request carrying these headers should be profiled"""
+    if config.PROFILE_ALL_REQUESTS:
+        return True
+
+    if not config.PROFILE_SECRET:
+        return False
+
+    supplied = headers.get(PROFILE_HEADER)
+    if not supplied:
+        return False
+
+    # Constant time comparison as this is an admin secret, of bytes as str only compares ASCII
+    return hmac.compare_digest(supplied.encode('utf-8'), config.PROFILE_SECRET.encode('utf-8'))
+
+
+def report_requested(headers):
+    """Whether the caller wants the profile report returned in the response"""
+    return headers.get(PROFILE_RETURN_HEADER, '').lower() in ['1', 'true', 'yes']
+
+
+class RequestProfile:
+    """Runs a function under cProfile and tracemalloc and reports on it"""
+
+    def __init__(self, description=None, top_n=None, output_dir=None):
+        self.profile_id = time.strftime('%Y%m%dT%H%M%S') + '-' + uuid.uuid4().hex[:8]
+        self.description = description or {}
+        self.top_n = top_n or config.PROFILE_TOP_N
+        self.output_dir = config.PROFILE_DIR if output_dir is None else output_dir
+        self.elapsed = None
+        self.peak_memory = None
+        self.stats = None
+        self.allocations = []
+
+    def run(self, func, *args, **kwargs):
+        """Call func with profiling enabled and return its result"""
+        profiler = cProfile.Profile()
+
+        # Only trace allocations if nothing else is already doing so
+        trace_allocations = not tracemalloc.is_tracing()
+        if trace_allocations:
+            tracemalloc.start()
+
+        start = time.perf_counter()
+        try:
+            return profiler.runcall(func, *args, **kwargs)
+        finally:
+            self.elapsed = time.perf_counter() - start
+            if trace_allocations:
+                snapshot = tracemalloc.take_snapshot()
+                _, self.peak_memory = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                self.allocations = snapshot.statistics('lineno')[:self.top_n]
+            self.stats = pstats.Stats(profiler)
+            self.save()
+
+    def report(self):
+        """Return a plain text report of the hot functions and allocations"""
+        out = io.StringIO()
+        out.write("Profile %s\n" % self.profile_id)
+        out.write("Request: %s\n" % json.dumps(self.description, default=str, sort_keys=True))
+        out.write("Wall time: %.4fs\n" % (self.elapsed or 0))
+        if self.peak_memory is not None:
+            out.write("Peak traced memory: %.1f KiB\n" % (self.peak_memory / 1024))
+
+        if self.stats is not None:
+            self.stats.stream = out
+            out.write("\nTop functions by cumulative time\n")
+            self.stats.sort_stats('cumulative').print_stats(self.top_n)
+            out.write("\nTop functions by internal time\n")
+            self.stats.sort_stats('tottime').print_stats(self.top_n)
+
+        if self.allocations:
+            out.write("\nTop allocation sites\n")
+            for stat in self.allocations:
+                out.write("%s\n" % stat)
+
+        return out.getvalue()
+
+    def save(self):
+        """Write the raw profile and the text report to the profile directory"""
+        if not self.output_dir:
+            return None
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        base_path = os.path.join(self.output_dir, self.profile_id)
+
+        # The .prof file can be loaded with pstats, snakeviz etc.
+        self.stats.dump_stats(base_path + '.prof')
+        with open(base_path + '.txt', 'w') as report_file:
+            report_file.write(self.report())
+
+        return base_path
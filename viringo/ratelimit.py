@@ -0,0 +1,242 @@
+"""Per-client rate limits and concurrency lanes
+
+Requests are put in one of two lanes by their verb: cheap ones (GetRecord,
+Identify, ListSets, ListMetadataFormats) and expensive list pages
+(ListRecords, ListIdentifiers and the bulk endpoints). Each lane has:
+
+* a token bucket per client, RATE_LIMIT_<LANE>_RATE requests a second with
+  bursts of up to RATE_LIMIT_<LANE>_BURST;
+* at most RATE_LIMIT_CLIENT_CONCURRENCY requests of a client running at once;
+* at most RATE_LIMIT_<LANE>_CONCURRENCY requests running at once in total, so
+  full harvests can't take every worker and leave GetRecord calls queueing.
+
+A client is the RATE_LIMIT_TOKEN_HEADER it sends when that is one of the
+RATE_LIMIT_TOKENS given out, or else its address, as anything else a client
+sends can be changed with every request. A request over a limit is answered with a 503 and Retry-After, as
+OAI-PMH asks harvesters to honour.
+
+The buckets and running requests are kept in a store of RATE_LIMIT_BACKEND,
+see viringo.cache_stores: local keeps them per process, shared for every
+worker of the host and redis for every host. A running request holds a lease
+until its response has been sent. Leases expire after RATE_LIMIT_LEASE_SECONDS
+in case a worker dies holding them. When the store can't be reached requests
+are let through.
+
+The shared backend keeps a key in any of SHARED_WAYS slots and never replaces
+an unexpired bucket or lease with another key's. A client whose slots are all
+taken by other live keys is let through, as when the store can't be reached.
+"""
+
+import hmac
+import logging
+import math
+import os
+import threading
+import time
+import uuid
+
+from viringo import cache_stores
+from viringo import config
+
+CHEAP = 'cheap'
+EXPENSIVE = 'expensive'
+EXPENSIVE_VERBS = ('ListRecords', 'ListIdentifiers')
+# Seconds a client turned away by a concurrency limit is asked to wait
+BUSY_RETRY_AFTER = 5
+# Slots of the shared backend a key may be kept in
+SHARED_WAYS = 16
+
+COUNTERS = {'admitted': 0, 'rate_limited': 0, 'busy': 0, 'store_errors': 0}
+_counters_lock = threading.Lock()
+
+
+class RateLimited(Exception):
+    """A client is over a limit, answered with a 503 and Retry-After"""
+
+    def __init__(self, message, retry_after):
+        super(RateLimited, self).__init__(message)
+        self.retry_after = retry_after
+
+
+def _count(counter):
+    with _counters_lock:
+        COUNTERS[counter] += 1
+
+
+def stats():
+    """Counters of this worker process"""
+    with _counters_lock:
+        return dict(COUNTERS)
+
+
+def lane_of(verb):
+    """The lane of an OAI verb, or of a bulk endpoint given None"""
+    return EXPENSIVE if verb is None or verb in EXPENSIVE_VERBS else CHEAP
+
+
+def known_token(token):
+    """Whether a token is one of RATE_LIMIT_TOKENS"""
+    token = token.encode('utf-8')
+    # Every token is compared, so the time taken doesn't tell how close a guess came
+    matches = [hmac.compare_digest(token, known.strip().encode('utf-8'))
+               for known in config.RATE_LIMIT_TOKENS.split(',') if known.strip()]
+    return any(matches)
+
+
+def client_of(headers, remote_addr):
+    """The key a client's limits are kept under"""
+    token = headers.get(config.RATE_LIMIT_TOKEN_HEADER)
+    if token and known_token(token):
+        return 'token:' + token
+    address = remote_addr
+    if config.RATE_LIMIT_TRUST_FORWARDED and headers.get('X-Forwarded-For'):
+        # The address the proxy in front of us saw
+        address = headers['X-Forwarded-For'].split(',')[0].strip()
+    return 'address:%s' % address
+
+
+def lane_limits(lane):
+    """Rate, burst and total concurrency of a lane"""
+    if lane == EXPENSIVE:
+        return (config.RATE_LIMIT_EXPENSIVE_RATE, config.RATE_LIMIT_EXPENSIVE_BURST,
+                config.RATE_LIMIT_EXPENSIVE_CONCURRENCY)
+    return config.RATE_LIMIT_CHEAP_RATE, config.RATE_LIMIT_CHEAP_BURST, config.RATE_LIMIT_CHEAP_CONCURRENCY
+
+
+class Lease:
+    """A running request's place in the concurrency limits, released once its response is sent"""
+
+    def __init__(self, store, keys, lease_id):
+        self.store = store
+        self.keys = keys
+        self.lease_id = lease_id
+        self._released = False
+
+    def release(self):
+        """Give the place back, once however often called"""
+        if self._released:
+            return
+        self._released = True
+        for key in self.keys:
+            try:
+                self.store.update('ratelimit', key, lambda leases: _without(leases, self.lease_id),
+                                  ttl=config.RATE_LIMIT_LEASE_SECONDS)
+            except cache_stores.StoreError:
+                _count('store_errors')
+                logging.warning("Rate limit store unavailable releasing a lease", exc_info=True)
+
+
+def _without(leases, lease_id):
+    leases = dict(leases or {})
+    leases.pop(lease_id, None)
+    return leases
+
+
+def take_token(store, client, lane, now=None):
+    """Take a token from a client's bucket, returning 0 or the seconds until one is available"""
+    rate, burst, _ = lane_limits(lane)
+    if rate <= 0:
+        return 0
+    now = now or time.time()
+    outcome = {}
+
+    def take(bucket):
+        tokens, updated = bucket or (float(burst), now)
+        tokens = min(float(burst), tokens + max(0.0, now - updated) * rate)
+        if tokens >= 1:
+            outcome['wait'] = 0
+            return tokens - 1, now
+        outcome['wait'] = (1 - tokens) / rate
+        return tokens, now
+
+    # Kept long enough to refill completely
+    store.update('ratelimit', ('bucket', lane, client), take, ttl=burst / rate + 1)
+    return outcome['wait']
+
+
+def acquire_places(store, places, lease_id, now=None):
+    """Add a lease under every (key, limit) place, all or nothing; returns whether it was added"""
+    now = now or time.time()
+    added = []
+    for key, limit in places:
+        outcome = {}
+
+        def add(leases):
+            # Leases of workers that died holding them have expired
+            leases = {held: expires for held, expires in (leases or {}).items() if expires > now}
+            outcome['added'] = len(leases) < limit
+            if outcome['added']:
+                leases[lease_id] = now + config.RATE_LIMIT_LEASE_SECONDS
+            return leases
+
+        store.update('ratelimit', key, add, ttl=config.RATE_LIMIT_LEASE_SECONDS)
+        if not outcome['added']:
+            Lease(store, added, lease_id).release()
+            return False
+        added.append(key)
+    return True
+
+
+def admit(verb, headers, remote_addr):
+    """Admit a request or raise RateLimited, returning the Lease to release once it is answered"""
+    store = get_store()
+    lane = lane_of(verb)
+    client = client_of(headers, remote_addr)
+    _, _, lane_concurrency = lane_limits(lane)
+    # A limit of 0 is no limit, and needs no lease
+    places = [(key, limit) for key, limit in [
+        (('running', lane, client), config.RATE_LIMIT_CLIENT_CONCURRENCY),
+        (('running', lane), lane_concurrency)
+    ] if limit > 0]
+    lease_id = uuid.uuid4().hex
+
+    try:
+        wait = take_token(store, client, lane)
+        if wait:
+            _count('rate_limited')
+            raise RateLimited('Too many %s requests from this client' % lane, int(math.ceil(wait)))
+        if not acquire_places(store, places, lease_id):
+            _count('busy')
+            raise RateLimited('Too many %s requests running' % lane, BUSY_RETRY_AFTER)
+    except cache_stores.StoreError:
+        # Limits are a protection, not a reason to turn harvesters away
+        _count('store_errors')
+        logging.warning("Rate limit store unavailable, letting the request through", exc_info=True)
+        return Lease(store, [], lease_id)
+
+    _count('admitted')
+    return Lease(store, [key for key, _ in places], lease_id)
+
+
+_store = None
+_store_pid = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """The store of the limits, once per process"""
+    global _store, _store_pid
+    with _store_lock:
+        if _store is None or _store_pid != os.getpid():
+            if config.RATE_LIMIT_BACKEND == 'shared':
+                _store = cache_stores.SharedStore(
+                    config.RATE_LIMIT_SHARED_PATH, config.RATE_LIMIT_SLOTS, 4096, ways=SHARED_WAYS)
+            elif config.RATE_LIMIT_BACKEND == 'redis':
+                _store = cache_stores.RedisStore(
+                    config.CACHE_REDIS_URL, config.CACHE_REDIS_TIMEOUT, prefix='viringo-ratelimit:')
+            else:
+                _store = cache_stores.LocalStore(config.RATE_LIMIT_SLOTS)
+            _store_pid = os.getpid()
+        return _store
+
+
+def reset():
+    """Forget the limits, e.g. between tests"""
+    global _store
+    with _store_lock:
+        if _store is not None:
+            _store.close()
+        _store = None
+    with _counters_lock:
+        for counter in COUNTERS:
+            COUNTERS[counter] = 0
@@ -0,0 +1,146 @@
+"""Build and render the records of a page on a process pool
+
+Turning backend data into metadata objects and writing it out as XML is CPU
+bound and would otherwise run serially in the request's worker. With
+RENDER_POOL_WORKERS set the records of large pages are split into chunks that
+are built and rendered in parallel worker processes, which hand back each
+record as a serialized XML fragment. The response tree only gets a
+placeholder comment for each fragment, and the fragments are spliced into the
+serialized response in place of those, so the request's worker neither parses
+nor serializes them again.
+"""
+
+import atexit
+import multiprocessing
+import os
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+import oaipmh.server
+from lxml import etree
+
+from viringo import config
+from viringo import deadline
+from viringo import metadata
+
+
+# Comment standing in for a fragment in a response tree, see splice
+PLACEHOLDER = 'viringo-fragment-%d'
+PLACEHOLDER_PATTERN = re.compile(br'<!--viringo-fragment-(\d+)-->')
+
+
+class Fragment:
+    """A record or header already rendered to serialized XML"""
+
+    def __init__(self, xml):
+        self.xml = xml
+
+
+def placeholder(fragments, fragment):
+    """Add fragment to those of a response, returning the comment that stands in for it in the tree"""
+    fragments.append(fragment)
+    return etree.Comment(PLACEHOLDER % (len(fragments) - 1))
+
+
+def splice(xml, fragments):
+    """Replace the placeholders of a serialized response with their fragments"""
+    if not fragments:
+        return xml
+    return PLACEHOLDER_PATTERN.sub(lambda match: fragments[int(match.group(1))].xml, xml)
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Return this process's render pool, or None when it is disabled"""
+    global _pool, _pool_pid
+    if config.RENDER_POOL_WORKERS <= 0:
+        return None
+
+    # A pool inherited from a parent process through a fork can't be used
+    if _pool is None or _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool_pid != os.getpid():
+                _pool = ProcessPoolExecutor(
+                    max_workers=config.RENDER_POOL_WORKERS,
+                    mp_context=multiprocessing.get_context('spawn')
+                )
+                _pool_pid = os.getpid()
+    return _pool
+
+
+def shutdown_pool():
+    """Stop the worker processes of the render pool"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.shutdown()
+        _pool = None
+
+atexit.register(shutdown_pool)
+
+
+def render_chunk(catalog_class, build, verb, metadata_prefix, entries):
+    """Build and render backend entries to serialized record or header fragments
+
+    Runs in the pool workers, so everything it is given has to be picklable:
+    the catalog class and build function are passed by reference.
+    """
+    catalog = catalog_class()
+    tree_server = oaipmh.server.XMLTreeServer(None, metadata.metadata_registry())
+    fragments = []
+    for entry in entries:
+        result = build(entry)
+        header = catalog.build_header(result)
+        # Rendered with the namespace prefixes of the response they are spliced into
+        container = etree.Element('container', nsmap=oaipmh.server.NSMAP)
+        if verb == 'ListIdentifiers':
+            tree_server._outputHeader(container, header)
+            element = container[0]
+        else:
+            element = etree.SubElement(container, oaipmh.server.nsoai('record'))
+            tree_server._outputHeader(element, header)
+            if not header.isDeleted():
+                tree_server._outputMetadata(
+                    element, metadata_prefix,
+                    catalog.build_record(catalog.build_metadata_map(result)))
+        fragments.append(etree.tostring(element, encoding='UTF-8'))
+    return fragments
+
+
+def chunks(entries, count):
+    """Split entries into at most count contiguous chunks of near equal size"""
+    size, extra = divmod(len(entries), count)
+    start = 0
+    for number in range(count):
+        end = start + size + (1 if number < extra else 0)
+        if end > start:
+            yield entries[start:end]
+        start = end
+
+
+def render_records(catalog_class, build, verb, metadata_prefix, entries):
+    """Render a page of backend entries to fragments, in parallel for large pages"""
+    pool = get_pool()
+    if pool is None or len(entries) < config.RENDER_POOL_MIN_RECORDS:
+        fragments = render_chunk(catalog_class, build, verb, metadata_prefix, entries)
+    else:
+        fragments = []
+        futures = [
+            pool.submit(render_chunk, catalog_class, build, verb, metadata_prefix, chunk)
+            for chunk in chunks(entries, config.RENDER_POOL_WORKERS)
+        ]
+        try:
+            for future in futures:
+                fragments.extend(future.result(timeout=deadline.remaining()))
+        except FutureTimeoutError:
+            # Out of time, don't leave the workers busy with chunks nobody will read
+            for future in futures:
+                future.cancel()
+            raise deadline.DeadlineExceeded('Request ran out of time rendering a page')
+    return [Fragment(xml) for xml in fragments]
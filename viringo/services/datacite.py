@@ -1,14 +1,21 @@
 """Handles interactions to the DataCite REST Service for retrieving metadata"""
 
 import base64
+import contextvars
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from urllib.parse import urlparse, parse_qs
 from operator import itemgetter
-import dateutil.parser
-import dateutil.tz
 import requests
+from viringo import aio
+from viringo import circuit
 from viringo import config
+from viringo import datestamps
+from viringo import deadline
+from viringo import incremental
+from viringo.cache import cached
+from viringo.singleflight import coalesce
 
 
 class Metadata:
@@ -78,12 +85,8 @@ def build_metadata(data):
 
     # Here we want to parse a ISO date but convert to UTC and then remove the TZinfo entirely
     # This is because OAI always works in UTC.
-    created = dateutil.parser.parse(data['attributes']['created'])
-    result.created_datetime = created.astimezone(
-        dateutil.tz.UTC).replace(tzinfo=None)
-    updated = dateutil.parser.parse(data['attributes']['updated'])
-    result.updated_datetime = updated.astimezone(
-        dateutil.tz.UTC).replace(tzinfo=None)
+    result.created_datetime = datestamps.to_utc(data['attributes']['created'])
+    result.updated_datetime = datestamps.to_utc(data['attributes']['updated'])
 
     result.xml = base64.b64decode(data['attributes']['xml']) \
         if data['attributes']['xml'] is not None else None
@@ -189,14 +192,20 @@ def strip_uri_prefix(identifier):
     return identifier
 
 
+@cached
+@coalesce
+@aio.delegate('viringo.services.datacite_async')
 def get_metadata(doi):
     """Return a parsed metadata result from the DataCite API
 
     Aside from the raw xml, the attributes parsed are best guesses for returning filled data.
     """
 
-    response = api_call_get(config.DATACITE_API_URL + '/dois/' + doi, None)
+    return metadata_from_response(api_call_get(config.DATACITE_API_URL + '/dois/' + doi, None))
 
+
+def metadata_from_response(response):
+    """The parsed metadata result of a /dois/<doi> response, None when there is none"""
     if response.status_code == 200:
         data = response.json()['data']
         return build_metadata(data)
@@ -208,23 +217,57 @@ def get_metadata(doi):
     return None
 
 
+@aio.delegate('viringo.services.datacite_async')
+def get_metadata_batch(dois):
+    """Return the parsed metadata results of many DOIs by DOI, leaving out unknown ones
+
+    The lookups run DATACITE_BATCH_CONCURRENCY at a time, each in a copy of the
+    caller's context so the request's deadline applies to them.
+    """
+    dois = list(dict.fromkeys(dois))
+    if not dois:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(config.DATACITE_BATCH_CONCURRENCY, len(dois))) as executor:
+        futures = [executor.submit(contextvars.copy_context().run, get_metadata, doi) for doi in dois]
+        results = [future.result() for future in futures]
+    return {doi: result for doi, result in zip(dois, results) if result}
+
+
+@cached
+@coalesce
+@aio.delegate('viringo.services.datacite_async')
 def get_metadata_list(
     query=None,
     provider_id=None,
     client_id=None,
     from_datetime=None,
     until_datetime=None,
-    cursor=None
+    cursor=None,
+    build=True,
+    page_size=None
 ):
-    """Returns metadata in parsed metadata result from the DataCite API"""
+    """Returns metadata in parsed metadata result from the DataCite API
+
+    With build False the API json entries are returned unparsed, for building elsewhere.
+    Pages have page_size results, or RESULT_SET_SIZE.
+    """
+
+    params = metadata_list_params(query, provider_id, client_id, from_datetime, until_datetime, cursor, page_size)
+    json, cursor = api_get_cursor(config.DATACITE_API_URL + '/dois', params)
+    return metadata_list_results(json, cursor, build)
+
+
+def metadata_list_params(query, provider_id, client_id, from_datetime, until_datetime, cursor, page_size=None):
+    """The /dois query parameters of a page of metadata results"""
 
     # Trigger cursor navigation with a starting value
     if not cursor:
         cursor = 1
 
-    # Whenever just a from is specified always set the until to latest timestamp.
+    # Whenever just a from is specified close the window at the high-water mark,
+    # so the query is the same for every request until the mark moves on.
     if from_datetime and not until_datetime:
-        until_datetime = datetime.now()
+        until_datetime = incremental.high_water_mark()
 
     # Construct a custom query for datetime filtering.
     # We use the updated date not the created date because users tend to prefer
@@ -237,7 +280,7 @@ def get_metadata_list(
 
     params = {
         'detail': True,
-        'page[size]': config.RESULT_SET_SIZE,
+        'page[size]': page_size or config.RESULT_SET_SIZE,
         'page[cursor]': cursor
     }
 
@@ -257,9 +300,11 @@ def get_metadata_list(
     if query:
         params['query'] = query
 
-    url = config.DATACITE_API_URL + '/dois'
+    return params
+
 
-    json, cursor = api_get_cursor(url, params)
+def metadata_list_results(json, cursor, build=True):
+    """A page of metadata results, its total and next cursor, from a /dois response"""
 
     # handle response that is not dict
     if type(json) is not dict:
@@ -271,6 +316,9 @@ def get_metadata_list(
         total_records = json['meta']['total']
 
     data = json['data']
+    if not build:
+        return data, total_records, cursor
+
     results = []
     for doi_entry in data:
         result = build_metadata(doi_entry)
@@ -279,6 +327,36 @@ def get_metadata_list(
     return results, total_records, cursor
 
 
+@coalesce
+def get_latest_change(provider_id=None, client_id=None):
+    """Returns when the most recently updated DOI was updated, as a naive UTC datetime
+
+    None is returned when there are no DOIs, and datetime.max when the API can't
+    be asked so that nothing is assumed to be unchanged.
+    """
+    params = {
+        'page[size]': 1,
+        'sort': '-updated'
+    }
+    if not client_id:
+        params['provider_id'] = provider_id
+    else:
+        params['client_id'] = client_id
+
+    response = api_call_get(config.DATACITE_API_URL + '/dois', params)
+    if response.status_code != 200:
+        logging.error("Error receiving data from datacite REST API")
+        return datetime.max
+
+    data = response.json().get('data') or []
+    if not data:
+        return None
+    return datestamps.to_utc(data[0]['attributes']['updated'])
+
+
+@cached
+@coalesce
+@aio.delegate('viringo.services.datacite_async')
 def get_sets():
     """Returns sets that can be used for further sub dividing results"""
 
@@ -316,8 +394,11 @@ def get_sets():
 def api_get_cursor(url, params):
     """Call the API expecting to page through with cursors"""
 
-    response = api_call_get(url, params)
+    return cursor_page(api_call_get(url, params))
 
+
+def cursor_page(response):
+    """The json and next cursor of a response paged through with cursors"""
     if response.status_code == 200:
         json = response.json()
 
@@ -343,8 +424,11 @@ def api_get_cursor(url, params):
 def api_get_paging_with_url(url, params):
     """Page results from API via retrieving the next url"""
 
-    response = api_call_get(url, params)
+    return url_page(api_call_get(url, params))
+
 
+def url_page(response):
+    """The json and next url of a response paged through by url"""
     if response.status_code == 200:
         json = response.json()
         if 'links' in json:
@@ -356,22 +440,52 @@ def api_get_paging_with_url(url, params):
         logging.error("Error receiving data from datacite REST API")
 
 
+def timed_get(url, **kwargs):
+    """requests.get, raising DeadlineExceeded when it timed out because the request's deadline ran out"""
+    try:
+        return requests.get(url, **kwargs)
+    except requests.Timeout:
+        deadline.check()
+        raise
+
+
+def payload(params):
+    """The query string of params, leaving out None values"""
+    if not params:
+        return ''
+    # Construct the payload as a string
+    # to avoid direct urlencoding by requests library which messes up some of the params
+    return "&".join("%s=%s" % (k, v) for k, v in params.items() if v is not None)
+
+
+@aio.delegate('viringo.services.datacite_async')
 def api_call_get(url, params=None):
-    """Make authenticated get request to API with params"""
-
-    payload_str = ''
-    if params:
-        # Construct the payload as a string
-        # to avoid direct urlencoding by requests library which messes up some of the params
-        payload_str = "&".join("%s=%s" % (k, v)
-                               for k, v in params.items() if v is not None)
-
-    response = requests.get(
-        url,
-        params=payload_str,
-        auth=requests.auth.HTTPBasicAuth(
-            config.DATACITE_API_ADMIN_USERNAME, config.DATACITE_API_ADMIN_PASSWORD),
-        timeout=30
-    )
+    """Make authenticated get request to API with params
+
+    Connection errors, timeouts and server errors raise circuit.BackendUnavailable.
+    """
+
+    payload_str = payload(params)
+
+    # Calls fail fast while the API is down, see viringo.circuit, and wait no
+    # longer than the request has left, see viringo.deadline
+    try:
+        response = circuit.get_breaker('datacite').call(
+            timed_get,
+            url,
+            params=payload_str,
+            auth=requests.auth.HTTPBasicAuth(
+                config.DATACITE_API_ADMIN_USERNAME, config.DATACITE_API_ADMIN_PASSWORD),
+            timeout=deadline.timeout(config.DATACITE_API_TIMEOUT),
+            is_failure=lambda response: response.status_code >= 500
+        )
+    except requests.RequestException as err:
+        raise circuit.BackendUnavailable(
+            "DataCite REST API request failed: %s" % err, retry_after=config.CIRCUIT_RESET_SECONDS)
+
+    if response.status_code >= 500:
+        raise circuit.BackendUnavailable(
+            "DataCite REST API responded with %s" % response.status_code,
+            retry_after=config.CIRCUIT_RESET_SECONDS)
 
     return response
@@ -0,0 +1,129 @@
+"""Asynchronous DataCite REST API calls, see viringo.aio
+
+The calls share one httpx client, and so its connections, per worker. The
+responses are parsed by the functions of viringo.services.datacite, which
+passes its calls of the functions below here while the event loop runs. Its
+caching and coalescing wrap the delegated call, so results are cached as under
+WSGI, and a batch looks its DOIs up as coroutines instead of in threads.
+"""
+
+import asyncio
+
+from viringo import circuit
+from viringo import config
+from viringo import deadline
+from viringo.services import datacite
+
+_client = None
+
+
+def get_client():
+    """The httpx client of the worker, created on first use"""
+    global _client
+    if _client is None:
+        # Only needed, and so only installed, for the ASGI entry point
+        import httpx
+        _client = httpx.AsyncClient(
+            auth=(config.DATACITE_API_ADMIN_USERNAME, config.DATACITE_API_ADMIN_PASSWORD),
+            limits=httpx.Limits(max_connections=config.ASYNC_DATACITE_CONNECTIONS))
+    return _client
+
+
+async def close():
+    """Close the client's connections"""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def timed_get(url, timeout):
+    """GET url, raising DeadlineExceeded when it timed out because the request's deadline ran out"""
+    import httpx
+    try:
+        return await get_client().get(url, timeout=timeout)
+    except httpx.TimeoutException:
+        deadline.check()
+        raise
+
+
+async def api_call_get(url, params=None):
+    """Make authenticated get request to API with params, like datacite.api_call_get"""
+    import httpx
+    payload_str = datacite.payload(params)
+    if payload_str:
+        # Next links of the API have a query already, which requests.get also appends to
+        url = url + ('&' if '?' in url else '?') + payload_str
+
+    try:
+        response = await circuit.get_breaker('datacite').call_async(
+            timed_get,
+            url,
+            timeout=deadline.timeout(config.DATACITE_API_TIMEOUT),
+            is_failure=lambda response: response.status_code >= 500
+        )
+    except httpx.HTTPError as err:
+        raise circuit.BackendUnavailable(
+            "DataCite REST API request failed: %s" % err, retry_after=config.CIRCUIT_RESET_SECONDS)
+
+    if response.status_code >= 500:
+        raise circuit.BackendUnavailable(
+            "DataCite REST API responded with %s" % response.status_code,
+            retry_after=config.CIRCUIT_RESET_SECONDS)
+
+    return response
+
+
+async def get_metadata(doi):
+    """Return a parsed metadata result from the DataCite API"""
+    return datacite.metadata_from_response(await api_call_get(config.DATACITE_API_URL + '/dois/' + doi))
+
+
+async def get_metadata_batch(dois):
+    """Return the parsed metadata results of many DOIs by DOI, leaving out unknown ones
+
+    The lookups run concurrently, DATACITE_BATCH_CONCURRENCY at a time.
+    """
+    dois = list(dict.fromkeys(dois))
+    semaphore = asyncio.Semaphore(config.DATACITE_BATCH_CONCURRENCY)
+
+    async def lookup(doi):
+        async with semaphore:
+            return await get_metadata(doi)
+
+    results = await asyncio.gather(*[lookup(doi) for doi in dois])
+    return {doi: result for doi, result in zip(dois, results) if result}
+
+
+async def get_metadata_list(
+    query=None,
+    provider_id=None,
+    client_id=None,
+    from_datetime=None,
+    until_datetime=None,
+    cursor=None,
+    build=True,
+    page_size=None
+):
+    """Returns a page of metadata results, its total and next cursor"""
+    params = datacite.metadata_list_params(
+        query, provider_id, client_id, from_datetime, until_datetime, cursor, page_size)
+    json, cursor = datacite.cursor_page(await api_call_get(config.DATACITE_API_URL + '/dois', params))
+    return datacite.metadata_list_results(json, cursor, build)
+
+
+async def get_sets():
+    """Returns sets that can be used for further sub dividing results"""
+    next_url = config.DATACITE_API_URL + '/clients'
+    results = []
+    while next_url:
+        page = datacite.url_page(await api_call_get(next_url, {'include': 'provider', 'page[size]': 1000}))
+        if not page:
+            break
+        json, next_url = page
+        for entry in json['data'] + json['included']:
+            if entry['id'] not in results:
+                results.append((entry['id'], entry['attributes']['name']))
+
+    results.sort(key=lambda result: result[0])
+    return results, len(results)
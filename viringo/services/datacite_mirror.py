@@ -0,0 +1,331 @@
+"""A local SQLite mirror of the DataCite DOIs to answer OAI requests from
+
+`FLASK_APP=viringo flask datacite-mirror-sync` pulls the DOIs changed since
+the last sync from the /dois API into DATACITE_MIRROR_PATH, indexed by
+identifier, updated datestamp, provider and client. With the path set,
+DataCiteOAIServer answers GetRecord, ListRecords and ListIdentifiers from it
+with keyset paging on (updated, id) instead of proxying every request to the
+API.
+
+The mirror holds every DOI updated up to its synced_until, which the sync sets
+DATACITE_MIRROR_INDEX_LAG seconds before it started, as the API takes a while
+to show changes. A list request is answered from the mirror up to
+synced_until and then from the live API for the rest of its window. The split
+is kept in the resumption cursor, so no change falls between the two, and
+the API is asked for the changes from the second after it, so none is listed
+by both. Only GetRecord of a DOI changed since the last sync can be out of
+date.
+
+The API doesn't list DOIs once they are deleted or no longer findable, so a
+sync of the changes can't tell they went. A full sync, run on request or every
+DATACITE_MIRROR_RECONCILE_SECONDS, drops the DOIs it wasn't given. Until then
+such DOIs are still answered from the mirror.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+
+from viringo import config
+from viringo import datestamps
+from viringo import incremental
+from viringo.services import datacite
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS dois (
+    id TEXT PRIMARY KEY,
+    updated INTEGER NOT NULL,
+    provider_id TEXT,
+    client_id TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS dois_updated ON dois (updated, id);
+CREATE INDEX IF NOT EXISTS dois_provider_updated ON dois (provider_id, updated, id);
+CREATE INDEX IF NOT EXISTS dois_client_updated ON dois (client_id, updated, id);
+CREATE TABLE IF NOT EXISTS sync_state (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+_local = threading.local()
+
+
+class SyncError(Exception):
+    """The API didn't answer a page of a sync, which is not recorded as done"""
+
+
+def connect(path=None):
+    """This thread's read only connection to the mirror, None when it doesn't exist"""
+    path = path or config.DATACITE_MIRROR_PATH
+    con = getattr(_local, 'con', None)
+    if con is not None and _local.path == path and _local.pid == os.getpid():
+        return con
+    if not path or not os.path.exists(path):
+        return None
+    con = sqlite3.connect('file:%s?mode=ro' % path, uri=True)
+    _local.con, _local.path, _local.pid = con, path, os.getpid()
+    return con
+
+
+def connect_for_sync(path):
+    """A writable connection to the mirror, creating it when missing"""
+    con = sqlite3.connect(path)
+    # Readers in the app workers carry on while a sync writes
+    con.execute('PRAGMA journal_mode=WAL')
+    con.executescript(SCHEMA)
+    return con
+
+
+def sync_state(con, key):
+    """An epoch second recorded by the last completed sync, None before the first"""
+    row = con.execute("SELECT value FROM sync_state WHERE key = ?", [key]).fetchone()
+    return int(row[0]) if row else None
+
+
+def synced_until(con):
+    """Every DOI updated up to this epoch second is in the mirror, None before the first sync"""
+    return sync_state(con, 'synced_until')
+
+
+def reconcile_due(con, now):
+    """Whether the next sync should be a full one, dropping the DOIs the API no longer lists"""
+    if config.DATACITE_MIRROR_RECONCILE_SECONDS <= 0:
+        return False
+    reconciled_at = sync_state(con, 'reconciled_at')
+    return reconciled_at is None or now - reconciled_at >= config.DATACITE_MIRROR_RECONCILE_SECONDS
+
+
+def available():
+    """Whether the mirror is configured and has been synced"""
+    if not config.DATACITE_MIRROR_PATH:
+        return False
+    con = connect()
+    try:
+        return con is not None and synced_until(con) is not None
+    except sqlite3.Error:
+        logging.warning("DataCite mirror unreadable, using the API", exc_info=True)
+        return False
+
+
+def store_entries(con, entries):
+    """Insert or replace API json entries"""
+    rows = []
+    for entry in entries:
+        relationships = entry.get('relationships', {})
+        rows.append((
+            entry['id'].lower(),
+            incremental.to_timestamp(datestamps.to_utc(entry['attributes']['updated'])),
+            (relationships.get('provider', {}).get('data') or {}).get('id', '').lower(),
+            (relationships.get('client', {}).get('data') or {}).get('id', '').lower(),
+            json.dumps(entry)
+        ))
+    con.executemany("INSERT OR REPLACE INTO dois (id, updated, provider_id, client_id, data) "
+                    "VALUES (?, ?, ?, ?, ?)", rows)
+
+
+def fetch_page(params):
+    """The json and next cursor of a page of DOIs, raising SyncError unless the API answered it"""
+    response = datacite.api_call_get(config.DATACITE_API_URL + '/dois', params)
+    if response.status_code != 200:
+        raise SyncError('DataCite REST API responded with %s to page %s' % (
+            response.status_code, params['page[cursor]']))
+    return datacite.cursor_page(response)
+
+
+def sync(path, full=False, page_size=1000):
+    """Pull the DOIs changed since the last sync into the mirror, returns how many were stored
+
+    A full sync pulls every DOI and drops those the API didn't list. Raises
+    SyncError when a page can't be fetched, leaving the last completed sync
+    recorded so the next one starts from there again.
+    """
+    con = connect_for_sync(path)
+    started = int(time.time())
+    full = full or synced_until(con) is None or reconcile_due(con, started)
+    since = None if full else synced_until(con)
+
+    params = {'detail': True, 'page[size]': page_size, 'page[cursor]': 1}
+    if since is not None:
+        params['query'] = "updated:[{0}+TO+*]".format(datetime.utcfromtimestamp(since).isoformat())
+    if full:
+        con.execute('CREATE TEMP TABLE IF NOT EXISTS listed (id TEXT PRIMARY KEY)')
+        con.execute('DELETE FROM listed')
+
+    stored = 0
+    cursor = 1
+    while cursor:
+        params['page[cursor]'] = cursor
+        page, cursor = fetch_page(params)
+        entries = page['data'] if page else []
+        with con:
+            store_entries(con, entries)
+            if full:
+                con.executemany('INSERT OR IGNORE INTO listed (id) VALUES (?)',
+                                [(entry['id'].lower(),) for entry in entries])
+        stored += len(entries)
+
+    state = [('synced_until', started - config.DATACITE_MIRROR_INDEX_LAG)]
+    with con:
+        if full:
+            dropped = con.execute('DELETE FROM dois WHERE id NOT IN (SELECT id FROM listed)').rowcount
+            logging.info("Dropped %d DOIs the DataCite API no longer lists from the mirror", dropped)
+            state.append(('reconciled_at', started))
+        con.executemany("INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)",
+                        [(key, str(value)) for key, value in state])
+    con.close()
+    return stored
+
+
+def records_filter(provider_id, client_id, from_timestamp, until_timestamp):
+    """Build the conditions and parameters for a set and window of updated datestamps"""
+    conditions = ['updated <= ?']
+    params = [until_timestamp]
+    # Only use the provider id if we dont have a client id, as the API does
+    if client_id:
+        conditions.append('client_id = ?')
+        params.append(client_id.lower())
+    elif provider_id:
+        conditions.append('provider_id = ?')
+        params.append(provider_id.lower())
+    if from_timestamp is not None:
+        conditions.append('updated >= ?')
+        params.append(from_timestamp)
+    return ' AND '.join(conditions), params
+
+
+def mirror_page(con, provider_id, client_id, from_timestamp, until_timestamp, after=None, page_size=None):
+    """A page of API json entries after the (updated, id) keyset position and the total matching"""
+    conditions, params = records_filter(provider_id, client_id, from_timestamp, until_timestamp)
+    total = con.execute('SELECT count(*) FROM dois WHERE ' + conditions, params).fetchone()[0]
+
+    page_params = list(params)
+    if after is not None:
+        conditions += ' AND (updated, id) > (?, ?)'
+        page_params.extend(after)
+    # One more than a page tells whether there is a next page
+    rows = con.execute(
+        'SELECT updated, id, data FROM dois WHERE ' + conditions + ' ORDER BY updated, id LIMIT ?',
+        page_params + [(page_size or config.RESULT_SET_SIZE) + 1]).fetchall()
+    return rows, total
+
+
+def is_mirror_cursor(cursor):
+    """Whether a paging cursor was handed out by the mirror rather than the API"""
+    return isinstance(cursor, str) and cursor.startswith('["')
+
+
+def parse_cursor(cursor):
+    """The list a mirror cursor holds, see get_metadata_list, raising ValueError when it can't be one"""
+    position = json.loads(cursor)
+    if not isinstance(position, list) or len(position) != 4 or not isinstance(position[1], int):
+        raise ValueError('Bad mirror cursor %r' % (cursor,))
+    phase, _, first, second = position
+    if phase == 'mirror':
+        valid = isinstance(first, int) and isinstance(second, str)
+    else:
+        valid = phase == 'live' and isinstance(first, (str, int)) and isinstance(second, int) and second >= 0
+    if not valid:
+        raise ValueError('Bad mirror cursor %r' % (cursor,))
+    return position
+
+
+def get_metadata(doi):
+    """Return a parsed metadata result from the mirror, or the API when not yet mirrored"""
+    con = connect()
+    row = con.execute('SELECT data FROM dois WHERE id = ?', [doi.lower()]).fetchone()
+    if row is None:
+        return datacite.get_metadata(doi)
+    return datacite.build_metadata(json.loads(row[0]))
+
+
+def get_metadata_batch(dois):
+    """Return the parsed metadata results of many DOIs from the mirror, and the API for those not yet mirrored"""
+    con = connect()
+    ids = list(dict.fromkeys(doi.lower() for doi in dois))
+    rows = con.execute('SELECT id, data FROM dois WHERE id IN (%s)' % ','.join('?' * len(ids)), ids).fetchall()
+    mirrored = {doi: datacite.build_metadata(json.loads(data)) for doi, data in rows}
+    results = {}
+    missing = []
+    for doi in dois:
+        if doi.lower() in mirrored:
+            results[doi] = mirrored[doi.lower()]
+        else:
+            missing.append(doi)
+    results.update(datacite.get_metadata_batch(missing))
+    return results
+
+
+def get_metadata_list(
+    query=None,
+    provider_id=None,
+    client_id=None,
+    from_datetime=None,
+    until_datetime=None,
+    cursor=None,
+    build=True,
+    page_size=None
+):
+    """Returns a page like datacite.get_metadata_list, from the mirror and then the API
+
+    The cursor is a json list: ['mirror', split, updated, id] while paging the
+    mirror and ['live', split, api cursor, mirror total] once on the API.
+    completeListSize is the number of mirrored records until the API is
+    reached, and then includes the changes since the last sync.
+    """
+    if query:
+        raise ValueError('Search queries are only answered by the API')
+    page_size = page_size or config.RESULT_SET_SIZE
+
+    if cursor:
+        position = parse_cursor(cursor)
+        phase, split = position[0], position[1]
+    else:
+        con = connect()
+        phase, split, position = 'mirror', synced_until(con), None
+
+    until_timestamp = incremental.to_timestamp(until_datetime) if until_datetime else None
+    # Changes after the split, up to until or now, are only in the API
+    live_tail = until_timestamp is None or until_timestamp > split
+
+    mirror_total = 0
+    if phase == 'mirror':
+        from_timestamp = incremental.to_timestamp(from_datetime) if from_datetime else None
+        after = position[2:4] if position else None
+        rows, mirror_total = mirror_page(
+            connect(), provider_id, client_id, from_timestamp,
+            split if live_tail else until_timestamp, after, page_size)
+
+        if len(rows) > page_size:
+            rows = rows[:page_size]
+            next_cursor = json.dumps(['mirror', split, rows[-1][0], rows[-1][1]])
+        elif live_tail:
+            next_cursor = json.dumps(['live', split, 1, mirror_total])
+        else:
+            next_cursor = None
+
+        # An empty mirror page with changes to come goes straight on to the API
+        if rows or not live_tail:
+            entries = [json.loads(data) for _, _, data in rows]
+            results = [datacite.build_metadata(entry) for entry in entries] if build else entries
+            return results, mirror_total, next_cursor
+        position = json.loads(next_cursor)
+
+    api_cursor, mirror_total = position[2], position[3]
+    # The mirror listed the split's second already
+    split_datetime = datetime.utcfromtimestamp(split) + timedelta(seconds=1)
+    results, live_total, api_cursor = datacite.get_metadata_list(
+        provider_id=provider_id,
+        client_id=client_id,
+        from_datetime=max(from_datetime, split_datetime) if from_datetime else split_datetime,
+        until_datetime=until_datetime,
+        cursor=api_cursor,
+        build=build,
+        page_size=page_size
+    )
+    next_cursor = json.dumps(['live', split, api_cursor, mirror_total]) if api_cursor else None
+    return results or [], mirror_total + live_total, next_cursor
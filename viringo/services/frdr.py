@@ -1,11 +1,18 @@
 """Handles DB queries for retrieving metadata"""
 
-import psycopg2
+from psycopg2.extras import DictCursor
+import json
 import re
 from datetime import datetime
-import dateutil.parser
-import dateutil.tz
+from decimal import Decimal
+from viringo import aio
 from viringo import config
+from viringo import datestamps
+from viringo import incremental
+from viringo.cache import cached
+from viringo.singleflight import coalesce
+from viringo.services import frdr_db
+from viringo.services.frdr_db import Statement
 import xml.etree.cElementTree as ET
 import ftfy
 
@@ -283,10 +290,8 @@ def build_metadata(data):
 
     # Here we want to parse a ISO date but convert to UTC and then remove the TZinfo entirely
     # This is because OAI always works in UTC.
-    created = dateutil.parser.parse(data['pub_date'])
-    result.created_datetime = created.astimezone(dateutil.tz.UTC).replace(tzinfo=None)
-    updated = dateutil.parser.parse(data['pub_date'])
-    result.updated_datetime = updated.astimezone(dateutil.tz.UTC).replace(tzinfo=None)
+    result.created_datetime = datestamps.to_utc(data['pub_date'])
+    result.updated_datetime = result.created_datetime
 
     result.xml = construct_datacite_xml(data)
     result.metadata_version = None
@@ -301,7 +306,7 @@ def build_metadata(data):
 
     result.descriptions = data['dc:description_en'] + data['dc:description_fr']
     result.publisher = data['repository_name']
-    result.publication_year = dateutil.parser.parse(data['pub_date']).year
+    result.publication_year = datestamps.parse(data['pub_date']).year
     result.dates = [data['pub_date']]
     result.contributors = data['dc:contributor']
     result.funding_references = ''
@@ -312,7 +317,8 @@ def build_metadata(data):
     result.identifiers = [data['item_url']]
     result.language = ''
     result.relations = []
-    result.rights = data['dc:rights']
+    # A copy, as the access indicator is added to it below
+    result.rights = list(data['dc:rights'])
     result.client = data['repo_oai_name']
     result.active = True
 
@@ -345,96 +351,272 @@ def rows_to_dict(cursor):
         return newdict
 
 
-def assemble_record(record, db, user, password, server, port):
+# Columns selected for a record, in the order of RECORD_FIELDS
+RECORD_COLUMNS = """recs.record_uuid, recs.title, recs.title_fr, recs.pub_date, recs.series, recs.source_url,
+    recs.item_url, recs.deleted, recs.local_identifier, recs.modified_timestamp, repos.repository_url,
+    repos.repository_name, repos.repository_thumbnail, repos.item_url_pattern, repos.last_crawl_timestamp,
+    repos.homepage_url, repos.repo_oai_name"""
 
-    if record["item_url"] is None:
-        return None
-        
-    if int(record["deleted"]) == 1:
-        return None
-
-    if (len(record['title_en']) == 0 and len(record['title_fr']) == 0):
-        return None
+# Keys a record row is mapped to
+RECORD_FIELDS = ['record_uuid', 'title_en', 'title_fr', 'pub_date', 'series', 'source_url', 'item_url', 'deleted', 'local_identifier', 'modified_timestamp', 'repository_url', 'repository_name', 'repository_thumbnail', 'item_url_pattern', 'last_crawl_timestamp', 'homepage_url', 'repo_oai_name']
 
-    con = psycopg2.connect("dbname='%s' user='%s' password='%s' host='%s' port='%s'" % (db, user, password, server, port))
-    with con:
-        from psycopg2.extras import DictCursor
-        lookup_cur = con.cursor(cursor_factory=DictCursor)
-
-        # get geolocation metadata
-        record["datacite_geoLocation"] = {}
-        lookup_cur.execute("""SELECT geobbox.westLon, geobbox.eastLon, geobbox.northLat, geobbox.southLat
-                                           FROM geobbox WHERE geobbox.record_uuid=%s""", [record["record_uuid"]])
-        geobboxes = lookup_cur.fetchall()
-        if len(geobboxes) > 0:
-            record["datacite_geoLocation"]["geoLocationBox"] = []
-            for geobbox in geobboxes:
-                record["datacite_geoLocation"]["geoLocationBox"].append({"westBoundLongitude": geobbox["westlon"],
-                                                          "eastBoundLongitude": geobbox["eastlon"],
-                                                          "northBoundLatitude": geobbox["northlat"],
-                                                          "southBoundLatitude": geobbox["southlat"]})
-        lookup_cur.execute("""SELECT geopoint.lat, geopoint.lon FROM geopoint WHERE geopoint.record_uuid=%s""",
-                        [record["record_uuid"]])
-        geopoints = lookup_cur.fetchall()
-        if len(geopoints) > 0:
-            record["datacite_geoLocation"]["geoLocationPoint"] = []
-            for geopoint in geopoints:
-                record["datacite_geoLocation"]["geoLocationPoint"].append({"pointLatitude": geopoint["lat"],
-                                                            "pointLongitude": geopoint["lon"]})
-
-        lookup_cur.execute("""SELECT country, province_state, city, other, place_name
-                           FROM geoplace
-                           WHERE record_uuid=%s""", [record["record_uuid"]])
-        geoplaces = lookup_cur.fetchall()
-        if len(geoplaces) > 0:
-            record["datacite_geoLocation"]["geoLocationPlace"] = []
-            for geoplace in geoplaces:
-                record["datacite_geoLocation"]["geoLocationPlace"].append({"country": geoplace["country"],
-                                                                           "province_state": geoplace["province_state"],
-                                                                           "city": geoplace["city"],
-                                                                           "additional": geoplace["other"],
-                                                                           "place_name": geoplace["place_name"]})
-
-        # attach the other values to the dict
-        lookup_cur.execute("""SELECT creators.creator FROM creators JOIN records_x_creators on records_x_creators.creator_id = creators.creator_id WHERE records_x_creators.record_uuid=%s AND records_x_creators.is_contributor=0 order by records_x_creators_id asc""", [record["record_uuid"]])
-        record["dc:contributor.author"] = rows_to_dict(lookup_cur)
-
-        lookup_cur.execute("""SELECT affiliations.affiliation FROM affiliations JOIN records_x_affiliations on records_x_affiliations.affiliation_id = affiliations.affiliation_id WHERE records_x_affiliations.record_uuid=%s""", [record["record_uuid"]])
-        record["datacite:creatorAffiliation"] = rows_to_dict(lookup_cur)
-
-        lookup_cur.execute("""SELECT creators.creator FROM creators JOIN records_x_creators on records_x_creators.creator_id = creators.creator_id WHERE records_x_creators.record_uuid=%s AND records_x_creators.is_contributor=1 order by records_x_creators_id asc""", [record["record_uuid"]])
-        record["dc:contributor"] = rows_to_dict(lookup_cur)
-
-        lookup_cur.execute("""SELECT subjects.subject FROM subjects JOIN records_x_subjects on records_x_subjects.subject_id = subjects.subject_id WHERE records_x_subjects.record_uuid=%s and subjects.language = 'en' """, [record["record_uuid"]])
-        record["frdr:category_en"] = rows_to_dict(lookup_cur)
-
-        lookup_cur.execute("""SELECT subjects.subject FROM subjects JOIN records_x_subjects on records_x_subjects.subject_id = subjects.subject_id WHERE records_x_subjects.record_uuid=%s and subjects.language = 'fr' """, [record["record_uuid"]])
-        record["frdr:category_fr"] = rows_to_dict(lookup_cur)
-
-        lookup_cur.execute("""SELECT publishers.publisher FROM publishers JOIN records_x_publishers on records_x_publishers.publisher_id = publishers.publisher_id WHERE records_x_publishers.record_uuid=%s""", [record["record_uuid"]])
-        record["dc:publisher"] = rows_to_dict(lookup_cur)
-
-        lookup_cur.execute("""SELECT rights.rights FROM rights JOIN records_x_rights on records_x_rights.rights_id = rights.rights_id WHERE records_x_rights.record_uuid=%s""", [record["record_uuid"]])
-        record["dc:rights"] = rows_to_dict(lookup_cur)
-
-        lookup_cur.execute("SELECT description FROM descriptions WHERE record_uuid=%s and language='en' ", [record["record_uuid"]])
-        record["dc:description_en"] = rows_to_dict(lookup_cur)
-
-        lookup_cur.execute("SELECT description FROM descriptions WHERE record_uuid=%s and language='fr' ", [record["record_uuid"]])
-        record["dc:description_fr"] = rows_to_dict(lookup_cur)
-
-        lookup_cur.execute("""SELECT tags.tag FROM tags JOIN records_x_tags on records_x_tags.tag_id = tags.tag_id WHERE records_x_tags.record_uuid=%s and tags.language = 'en' """, [record["record_uuid"]])
-        record["frdr:keywords_en"] = rows_to_dict(lookup_cur)
-
-        lookup_cur.execute("""SELECT tags.tag FROM tags JOIN records_x_tags on records_x_tags.tag_id = tags.tag_id WHERE records_x_tags.record_uuid=%s and tags.language = 'fr' """, [record["record_uuid"]])
-        record["frdr:keywords_fr"] = rows_to_dict(lookup_cur)
-
-        lookup_cur.execute("""SELECT access.access FROM access JOIN records_x_access on records_x_access.access_id = access.access_id WHERE records_x_access.record_uuid=%s""", [record["record_uuid"]])
-        record["frdr:access"] = rows_to_dict(lookup_cur)
+GEOBBOX_SQL = Statement('frdr_geobbox', """SELECT geobbox.westLon, geobbox.eastLon, geobbox.northLat, geobbox.southLat
+    FROM geobbox WHERE geobbox.record_uuid=%s""")
+
+GEOPOINT_SQL = Statement('frdr_geopoint', """SELECT geopoint.lat, geopoint.lon FROM geopoint WHERE geopoint.record_uuid=%s""")
+
+GEOPLACE_SQL = Statement('frdr_geoplace', """SELECT country, province_state, city, other, place_name
+    FROM geoplace
+    WHERE record_uuid=%s""")
+
+# Single value lookups of the child tables, keyed by the record field they fill
+CHILD_TABLE_SQL = [
+    ('dc:contributor.author', Statement('frdr_creators', """SELECT creators.creator FROM creators JOIN records_x_creators on records_x_creators.creator_id = creators.creator_id WHERE records_x_creators.record_uuid=%s AND records_x_creators.is_contributor=0 order by records_x_creators_id asc""")),
+    ('datacite:creatorAffiliation', Statement('frdr_affiliations', """SELECT affiliations.affiliation FROM affiliations JOIN records_x_affiliations on records_x_affiliations.affiliation_id = affiliations.affiliation_id WHERE records_x_affiliations.record_uuid=%s""")),
+    ('dc:contributor', Statement('frdr_contributors', """SELECT creators.creator FROM creators JOIN records_x_creators on records_x_creators.creator_id = creators.creator_id WHERE records_x_creators.record_uuid=%s AND records_x_creators.is_contributor=1 order by records_x_creators_id asc""")),
+    ('frdr:category_en', Statement('frdr_subjects_en', """SELECT subjects.subject FROM subjects JOIN records_x_subjects on records_x_subjects.subject_id = subjects.subject_id WHERE records_x_subjects.record_uuid=%s and subjects.language = 'en' """)),
+    ('frdr:category_fr', Statement('frdr_subjects_fr', """SELECT subjects.subject FROM subjects JOIN records_x_subjects on records_x_subjects.subject_id = subjects.subject_id WHERE records_x_subjects.record_uuid=%s and subjects.language = 'fr' """)),
+    ('dc:publisher', Statement('frdr_publishers', """SELECT publishers.publisher FROM publishers JOIN records_x_publishers on records_x_publishers.publisher_id = publishers.publisher_id WHERE records_x_publishers.record_uuid=%s""")),
+    ('dc:rights', Statement('frdr_rights', """SELECT rights.rights FROM rights JOIN records_x_rights on records_x_rights.rights_id = rights.rights_id WHERE records_x_rights.record_uuid=%s""")),
+    ('dc:description_en', Statement('frdr_descriptions_en', "SELECT description FROM descriptions WHERE record_uuid=%s and language='en' ")),
+    ('dc:description_fr', Statement('frdr_descriptions_fr', "SELECT description FROM descriptions WHERE record_uuid=%s and language='fr' ")),
+    ('frdr:keywords_en', Statement('frdr_tags_en', """SELECT tags.tag FROM tags JOIN records_x_tags on records_x_tags.tag_id = tags.tag_id WHERE records_x_tags.record_uuid=%s and tags.language = 'en' """)),
+    ('frdr:keywords_fr', Statement('frdr_tags_fr', """SELECT tags.tag FROM tags JOIN records_x_tags on records_x_tags.tag_id = tags.tag_id WHERE records_x_tags.record_uuid=%s and tags.language = 'fr' """)),
+    ('frdr:access', Statement('frdr_access', """SELECT access.access FROM access JOIN records_x_access on records_x_access.access_id = access.access_id WHERE records_x_access.record_uuid=%s""")),
+]
+
+# Every lookup of a record's child rows, the geo rows are read by column name
+GEO_SQL = [GEOBBOX_SQL, GEOPOINT_SQL, GEOPLACE_SQL]
+CHILD_LOOKUP_SQL = GEO_SQL + [child_sql for _, child_sql in CHILD_TABLE_SQL]
+
+
+def children_statement(name, statements):
+    """One query selecting the rows of each statement as a json array, each statement's own ORDER BY kept"""
+    columns = ["(SELECT coalesce(json_agg(child), '[]')::text FROM (%s) child) AS %s" % (statement.sql.strip(),
+                                                                                         statement.name)
+               for statement in statements]
+    return Statement(name, 'SELECT ' + ',\n    '.join(columns))
+
+
+# Every child lookup of a record in one round trip, bound to its record_uuid once per lookup
+CHILDREN_SQL = children_statement('frdr_children', CHILD_LOOKUP_SQL)
+
+# Records that can be served: live, with a landing page, a title in either language,
+# a publication date and both parts of the OAI identifier
+VALID_RECORD_SQL = """recs.deleted != 1
+    AND recs.item_url IS NOT NULL AND recs.item_url != ''
+    AND (coalesce(recs.title, '') != '' OR coalesce(recs.title_fr, '') != '')
+    AND coalesce(recs.pub_date, '') != ''
+    AND coalesce(recs.local_identifier, '') != '' AND coalesce(repos.repo_oai_name, '') != ''"""
+
+# Query for a single record by its OAI identifier parts
+RECORD_SQL = Statement('frdr_record', """SELECT """ + RECORD_COLUMNS + """ FROM records recs, repositories repos
+    WHERE recs.repository_id = repos.repository_id AND """ + VALID_RECORD_SQL + """
+        AND recs.local_identifier = %s AND repos.repo_oai_name = %s""")
+
+# Query for many records by the parts of their OAI identifiers, pairs not asked for are dropped after
+RECORDS_BATCH_SQL = Statement('frdr_records_batch', """SELECT """ + RECORD_COLUMNS + """ FROM records recs, repositories repos
+    WHERE recs.repository_id = repos.repository_id AND """ + VALID_RECORD_SQL + """
+        AND recs.local_identifier = ANY(%s) AND repos.repo_oai_name = ANY(%s)""")
+
+# Query used to list the sets
+SETS_SQL = Statement('frdr_sets', "SELECT repo_oai_name, repository_name from repositories")
+
+
+def connection(db, user, password, server, port):
+    """Borrow a pooled connection to the FRDR database"""
+    return frdr_db.connection(db, user, password, server, port)
+
+
+def assemble_record(record, con):
+    """Attach the child table values to a record row matching VALID_RECORD_SQL"""
+
+    with con.cursor() as lookup_cur:
+        frdr_db.execute(lookup_cur, CHILDREN_SQL, [record["record_uuid"]] * CHILDREN_SQL.parameter_count)
+        row = lookup_cur.fetchone()
+
+    return attach_children(record, children_rows(row))
+
+
+def children_rows(row):
+    """The child rows of a CHILDREN_SQL row by statement name, as attach_children reads them"""
+    rows = {}
+    for statement, value in zip(CHILD_LOOKUP_SQL, row):
+        # Decimals, so numbers are written out as Postgres sent them
+        children = json.loads(value, parse_float=Decimal)
+        rows[statement.name] = children if statement in GEO_SQL else [list(child.values()) for child in children]
+    return rows
+
+
+def attach_children(record, rows):
+    """Attach a record's child table rows, keyed by the name of the statement they came from"""
+
+    # get geolocation metadata
+    record["datacite_geoLocation"] = {}
+    geobboxes = rows[GEOBBOX_SQL.name]
+    if len(geobboxes) > 0:
+        record["datacite_geoLocation"]["geoLocationBox"] = []
+        for geobbox in geobboxes:
+            record["datacite_geoLocation"]["geoLocationBox"].append({"westBoundLongitude": geobbox["westlon"],
+                                                      "eastBoundLongitude": geobbox["eastlon"],
+                                                      "northBoundLatitude": geobbox["northlat"],
+                                                      "southBoundLatitude": geobbox["southlat"]})
+    geopoints = rows[GEOPOINT_SQL.name]
+    if len(geopoints) > 0:
+        record["datacite_geoLocation"]["geoLocationPoint"] = []
+        for geopoint in geopoints:
+            record["datacite_geoLocation"]["geoLocationPoint"].append({"pointLatitude": geopoint["lat"],
+                                                        "pointLongitude": geopoint["lon"]})
+
+    geoplaces = rows[GEOPLACE_SQL.name]
+    if len(geoplaces) > 0:
+        record["datacite_geoLocation"]["geoLocationPlace"] = []
+        for geoplace in geoplaces:
+            record["datacite_geoLocation"]["geoLocationPlace"].append({"country": geoplace["country"],
+                                                                       "province_state": geoplace["province_state"],
+                                                                       "city": geoplace["city"],
+                                                                       "additional": geoplace["other"],
+                                                                       "place_name": geoplace["place_name"]})
+
+    # attach the other values to the dict
+    for field, child_sql in CHILD_TABLE_SQL:
+        record[field] = rows_to_dict(rows[child_sql.name])
 
     return record
 
 
+def batch_statement(statement):
+    """The statement of a child lookup for many records, selecting the record_uuid as batch_uuid first"""
+    match = re.search(r'([\w.]*record_uuid)\s*=\s*%s', statement.sql)
+    column = match.group(1)
+    sql = statement.sql[:match.start()] + column + ' = ANY(%s::uuid[])' + statement.sql[match.end():]
+    sql = re.sub(r'^SELECT ', 'SELECT ' + column + ' AS batch_uuid, ', sql)
+    return Statement(statement.name + '_batch', sql)
+
+
+# Child lookups of many records, one query per child table
+GEOBBOX_BATCH_SQL = batch_statement(GEOBBOX_SQL)
+GEOPOINT_BATCH_SQL = batch_statement(GEOPOINT_SQL)
+GEOPLACE_BATCH_SQL = batch_statement(GEOPLACE_SQL)
+CHILD_TABLE_BATCH_SQL = [(field, batch_statement(child_sql)) for field, child_sql in CHILD_TABLE_SQL]
+# Each child lookup with its batch statement
+CHILD_LOOKUP_BATCH_SQL = list(zip(CHILD_LOOKUP_SQL, [GEOBBOX_BATCH_SQL, GEOPOINT_BATCH_SQL, GEOPLACE_BATCH_SQL]
+                                  + [batch_sql for _, batch_sql in CHILD_TABLE_BATCH_SQL]))
+
+
+def uuid_array(uuids):
+    """An array literal Postgres casts to uuid[], which a list of str is not"""
+    return '{' + ','.join(str(uuid) for uuid in uuids) + '}'
+
+
+def assemble_records(records, con):
+    """Attach the child table values to many record rows, with one query per child table"""
+    uuids = uuid_array(record["record_uuid"] for record in records)
+    rows = {str(record["record_uuid"]): {} for record in records}
+
+    with con.cursor(cursor_factory=DictCursor) as lookup_cur:
+        for statement, batch_sql in CHILD_LOOKUP_BATCH_SQL:
+            frdr_db.execute(lookup_cur, batch_sql, [uuids])
+            add_batch_rows(rows, statement, lookup_cur.fetchall())
+
+    return [attach_children(record, rows[str(record["record_uuid"])]) for record in records]
+
+
+def add_batch_rows(rows, statement, batch_rows):
+    """Share out the rows of a child lookup's batch statement to the records they belong to"""
+    for record_rows in rows.values():
+        record_rows[statement.name] = []
+    for row in batch_rows:
+        # Single value lookups become single value rows again, geo rows are read by name
+        value = row if statement in GEO_SQL else list(row)[1:]
+        rows[str(row["batch_uuid"])][statement.name].append(value)
+
+
+def records_filter(set=None, from_datetime=None, until_datetime=None):
+    """Build the conditions, statement name suffix and bound parameters for a set and date range"""
+    conditions = ""
+    suffix = ""
+    params = []
+    if set is not None and set != 'openaire_data':
+        conditions = conditions + " AND repos.repo_oai_name = %s"
+        suffix = suffix + '_set'
+        params.append(set)
+    # OAI datestamps are UTC and until is inclusive
+    if from_datetime is not None:
+        conditions = conditions + " AND recs.upstream_modified_timestamp >= %s"
+        suffix = suffix + '_from'
+        params.append(incremental.to_timestamp(from_datetime))
+    if until_datetime is not None:
+        conditions = conditions + " AND recs.upstream_modified_timestamp <= %s"
+        suffix = suffix + '_until'
+        params.append(incremental.to_timestamp(until_datetime))
+    return conditions, suffix, params
+
+
+def records_list_query(set=None, from_datetime=None, until_datetime=None, cursor=None, page_size=None):
+    """Build the statement and bound parameters for a page of records
+
+    Each combination of filters is its own prepared statement so every one gets a plan
+    suited to it, the values themselves are always bound parameters.
+    """
+    conditions, suffix, params = records_filter(set, from_datetime, until_datetime)
+    # The window count is taken before the limit, so it is the number of valid records
+    records_sql = """SELECT """ + RECORD_COLUMNS + """, count(*) OVER() AS full_count FROM records recs, repositories repos
+        WHERE recs.repository_id = repos.repository_id AND """ + VALID_RECORD_SQL + conditions + """
+        ORDER BY recs.record_uuid LIMIT %s OFFSET %s"""
+    params.append(page_size or config.RESULT_SET_SIZE)
+    params.append(int(cursor or 0))
+    return Statement('frdr_records_list' + suffix, records_sql), params
+
+
+def records_stream_query(set=None, from_datetime=None, until_datetime=None, after=None, limit=None):
+    """Build the statement and bound parameters for the matching records after a record_uuid when given
+
+    There is no window count, which would make Postgres materialise the whole
+    result before the first row is sent. limit caps the records of a chunk.
+    """
+    conditions, suffix, params = records_filter(set, from_datetime, until_datetime)
+    # Keyset continuation, the records are in record_uuid order
+    if after is not None:
+        conditions = conditions + " AND recs.record_uuid > %s"
+        suffix = suffix + '_after'
+        params.append(after)
+    records_sql = """SELECT """ + RECORD_COLUMNS + """ FROM records recs, repositories repos
+        WHERE recs.repository_id = repos.repository_id AND """ + VALID_RECORD_SQL + conditions + """
+        ORDER BY recs.record_uuid"""
+    if limit is not None:
+        records_sql += " LIMIT %s"
+        suffix = suffix + '_limit'
+        params.append(limit)
+    return Statement('frdr_records_stream' + suffix, records_sql), params
+
+
+def latest_change_query(set=None):
+    """Build the statement and bound parameters for the latest upstream modification in a set"""
+    conditions, suffix, params = records_filter(set)
+    latest_sql = """SELECT max(recs.upstream_modified_timestamp) FROM records recs, repositories repos
+        WHERE recs.repository_id = repos.repository_id""" + conditions
+    return Statement('frdr_latest_change' + suffix, latest_sql), params
+
+
+# The pages of a set are cached apart so a change only drops that set's pages,
+# every set is one partition, see viringo.services.frdr_notify
+ALL_SETS = 'openaire_data'
+
+
+def page_partition(server, db, user, password, port, query=None, set=None, *args, **kwargs):
+    """The cache partition of a page, its set"""
+    return set or ALL_SETS
+
+
+def record_partition(identifier, *args, **kwargs):
+    """The cache partition of a record, its OAI identifier"""
+    return identifier
+
+
+@cached(partition=page_partition)
+@coalesce
+@aio.delegate('viringo.services.frdr_async')
 def get_metadata_list(
         server,
         db,
@@ -445,45 +627,35 @@ def get_metadata_list(
         set=None,
         from_datetime=None,
         until_datetime=None,
-        cursor=None
+        cursor=None,
+        build=True,
+        page_size=None
     ):
+    """Returns a page of metadata results, or with build False the assembled records
 
-    records_con = psycopg2.connect("dbname='%s' user='%s' password='%s' host='%s' port='%s'" % (db, user, password, server, port))
-    with records_con:
-        db_cursor = records_con.cursor()
-    records_sql = """SELECT recs.record_uuid, recs.title, recs.title_fr, recs.pub_date, recs.series, recs.source_url, 
-        recs.item_url, recs.deleted, recs.local_identifier, recs.modified_timestamp, repos.repository_url, 
-        repos.repository_name, repos.repository_thumbnail, repos.item_url_pattern, repos.last_crawl_timestamp, 
-        repos.homepage_url, repos.repo_oai_name, count(*) OVER() AS full_count FROM records recs, repositories repos 
-        WHERE recs.repository_id = repos.repository_id AND recs.deleted!=1 AND recs.item_url!='' AND 
-        recs.pub_date != ''"""
-    if set is not None and set != 'openaire_data':
-        records_sql = records_sql + " AND (repos.repo_oai_name='" + set + "')"
-    if from_datetime is not None:
-        from_timestamp = int(datetime.timestamp(from_datetime))
-        records_sql = records_sql + " AND recs.upstream_modified_timestamp>=" + str(from_timestamp)
-    if until_datetime is not None:
-        until_timestamp = int(datetime.timestamp(until_datetime))
-        records_sql = records_sql + " AND recs.upstream_modified_timestamp<" + str(until_timestamp)
-    records_sql = records_sql + " ORDER BY recs.record_uuid"
-    if cursor is not None:
-        records_sql = records_sql + " OFFSET " + cursor
-    db_cursor.execute(records_sql)
+    Pages have page_size results, or RESULT_SET_SIZE.
+    """
 
-    record_set = db_cursor.fetchmany(config.RESULT_SET_SIZE)
-    full_count = 0
+    statement, params = records_list_query(set, from_datetime, until_datetime, cursor, page_size)
 
-    results = []
-    for row in record_set:
-        record = (dict(zip(['record_uuid', 'title_en', 'title_fr', 'pub_date', 'series', 'source_url', 'item_url', 'deleted', 'local_identifier', 'modified_timestamp', 'repository_url', 'repository_name', 'repository_thumbnail', 'item_url_pattern', 'last_crawl_timestamp', 'homepage_url', 'repo_oai_name'], row)))
+    with connection(db, user, password, server, port) as records_con:
+        with records_con.cursor() as db_cursor:
+            frdr_db.execute(db_cursor, statement, params)
+            record_set = db_cursor.fetchall()
+
+        full_count = 0
+
+        records = []
+        for row in record_set:
+            records.append(dict(zip(RECORD_FIELDS, row)))
 
-        # This is goofy, but full_count isn't always returned for empty results
-        if int(row[-1]) != 0:
-            full_count = row[-1]
+            # This is goofy, but full_count isn't always returned for empty results
+            if int(row[-1]) != 0:
+                full_count = row[-1]
 
-        full_record = assemble_record(record, db, user, password, server, port)
-        if full_record is not None:
-            results.append(build_metadata(full_record))
+        if records:
+            records = assemble_records(records, records_con)
+        results = [build_metadata(record) for record in records] if build else records
 
     if cursor is not None:
         return results, full_count, (len(record_set) + int(cursor))
@@ -491,36 +663,134 @@ def get_metadata_list(
         return results, full_count, len(record_set)
 
 
-def get_metadata(identifier, db, user, password, server, port):
+def iter_metadata_list(
+        server,
+        db,
+        user,
+        password,
+        port,
+        set=None,
+        from_datetime=None,
+        until_datetime=None,
+        itersize=None,
+        after=None,
+        keyed=False
+    ):
+    """Yield the metadata of every matching record for bulk harvests
+
+    Records are read itersize at a time in record_uuid order, each chunk on a
+    connection borrowed just for it, so memory use does not grow with the
+    number of records and no connection or transaction is held while the
+    caller sends them on. With keyed True (record_uuid, metadata) pairs are
+    yielded, the record_uuid resuming after the record when passed as after.
+    """
+    itersize = itersize or config.POSTGRES_ITERSIZE
+    while True:
+        statement, params = records_stream_query(set, from_datetime, until_datetime, after, itersize)
+        with connection(db, user, password, server, port) as records_con:
+            with records_con.cursor() as records_cursor:
+                frdr_db.execute(records_cursor, statement, params)
+                records = [dict(zip(RECORD_FIELDS, row)) for row in records_cursor.fetchall()]
+            if records:
+                records = assemble_records(records, records_con)
+
+        for record in records:
+            metadata = build_metadata(record)
+            yield (str(record['record_uuid']), metadata) if keyed else metadata
+        if len(records) < itersize:
+            return
+        # Keyset continuation from the last record of the chunk
+        after = str(records[-1]['record_uuid'])
+
+
+def split_identifier(identifier):
+    """The set and local identifier of an oai:<set>:<local identifier> identifier"""
     identifier = identifier[4:]
     namespace = identifier[:identifier.find(":")]
     local_identifier = identifier[identifier.find(":")+1:]
-    records_con = psycopg2.connect("dbname='%s' user='%s' password='%s' host='%s' port='%s'" % (db, user, password, server, port))
-    with records_con:
-        records_cursor = records_con.cursor()
-    records_sql = ("""SELECT recs.record_uuid, recs.title, recs.title_fr, recs.pub_date, recs.series, recs.source_url, 
-    recs.item_url, recs.deleted, recs.local_identifier, recs.modified_timestamp, repos.repository_url, 
-    repos.repository_name, repos.repository_thumbnail, repos.item_url_pattern, repos.last_crawl_timestamp, 
-    repos.homepage_url, repos.repo_oai_name FROM records recs, repositories repos 
-    WHERE recs.repository_id = repos.repository_id 
-        AND recs.local_identifier =\'""" + local_identifier + "\'" + "AND repos.repo_oai_name=\'""" + namespace + "\'")
-    records_cursor.execute(records_sql)
-    row = records_cursor.fetchone()
-    record = (dict(zip(['record_uuid', 'title_en', 'title_fr', 'pub_date', 'series', 'source_url', 'item_url', 'deleted', 'local_identifier', 'modified_timestamp', 'repository_url', 'repository_name', 'repository_thumbnail', 'item_url_pattern', 'last_crawl_timestamp', 'homepage_url', 'repo_oai_name'], row)))
-
-    full_record = assemble_record(record, db, user, password, server, port)
+    return namespace, local_identifier
+
+
+@cached(partition=record_partition)
+@coalesce
+@aio.delegate('viringo.services.frdr_async')
+def get_metadata(identifier, db, user, password, server, port):
+    namespace, local_identifier = split_identifier(identifier)
+
+    with connection(db, user, password, server, port) as records_con:
+        with records_con.cursor() as records_cursor:
+            frdr_db.execute(records_cursor, RECORD_SQL, [local_identifier, namespace])
+            row = records_cursor.fetchone()
+        if row is None:
+            return None
+        record = (dict(zip(RECORD_FIELDS, row)))
+
+        full_record = assemble_record(record, records_con)
     return build_metadata(full_record)
 
 
-def get_sets(db, user, password, server, port):
-    repos_con = psycopg2.connect("dbname='%s' user='%s' password='%s' host='%s' port='%s'" % (db, user, password, server, port))
-    with repos_con:
-        repos_cursor = repos_con.cursor()
+@aio.delegate('viringo.services.frdr_async')
+def get_metadata_batch(identifiers, db, user, password, server, port):
+    """Return the parsed metadata of many records by OAI identifier, leaving out unknown ones
+
+    The records and each of their child tables are looked up with one query
+    for all of them, rather than a record query and a query per child table
+    for each.
+    """
+    wanted = {split_identifier(identifier): identifier for identifier in identifiers}
+    if not wanted:
+        return {}
+    namespaces = sorted({namespace for namespace, _ in wanted})
+    local_identifiers = sorted({local_identifier for _, local_identifier in wanted})
+
+    with connection(db, user, password, server, port) as records_con:
+        with records_con.cursor() as records_cursor:
+            frdr_db.execute(records_cursor, RECORDS_BATCH_SQL, [local_identifiers, namespaces])
+            rows = records_cursor.fetchall()
+
+        records = [dict(zip(RECORD_FIELDS, row)) for row in rows]
+        records = [record for record in records
+                   if (record['repo_oai_name'], record['local_identifier']) in wanted]
+        if records:
+            records = assemble_records(records, records_con)
+
+    results = {}
+    for record in records:
+        identifier = wanted[(record['repo_oai_name'], record['local_identifier'])]
+        results[identifier] = build_metadata(record)
+    return results
+
+
+@coalesce
+@aio.delegate('viringo.services.frdr_async')
+def get_latest_change(db, user, password, server, port, set=None):
+    """Returns when a record of the set was last modified upstream, as a naive UTC datetime
+
+    All records are considered, not just valid ones, so the index on the modified
+    timestamp can answer it. None is returned when the set has no records.
+    """
+    statement, params = latest_change_query(set)
+
+    with connection(db, user, password, server, port) as records_con:
+        with records_con.cursor() as records_cursor:
+            frdr_db.execute(records_cursor, statement, params)
+            latest = records_cursor.fetchone()[0]
+
+    if latest is None:
+        return None
+    return datetime.utcfromtimestamp(int(latest))
 
+
+@cached
+@coalesce
+@aio.delegate('viringo.services.frdr_async')
+def get_sets(db, user, password, server, port):
     results = []
     results.append(['openaire_data', 'OpenAIRE'])
 
-    repos_cursor.execute("SELECT repo_oai_name, repository_name from repositories")
-    results.extend(repos_cursor.fetchall())
+    with connection(db, user, password, server, port) as repos_con:
+        with repos_con.cursor() as repos_cursor:
+            frdr_db.execute(repos_cursor, SETS_SQL)
+            results.extend(repos_cursor.fetchall())
 
-    return results, len(results)
\ No newline at end of file
+    return results, len(results)
@@ -0,0 +1,164 @@
+"""Asynchronous FRDR database queries, see viringo.aio
+
+The queries share one asyncpg pool per database and worker. The child
+lookups of many records run concurrently, each on a connection of its own. The
+statements and record assembly are those of viringo.services.frdr, which
+passes its own calls here while the event loop runs. asyncpg prepares and
+caches statements on each connection itself, unless
+POSTGRES_PREPARED_STATEMENTS is off.
+
+Bulk harvests with iter_metadata_list keep using psycopg2, reading a chunk of
+records at a time on the blocking pool.
+"""
+
+import asyncio
+import time
+from datetime import datetime
+
+from viringo import admission
+from viringo import config
+from viringo import deadline
+from viringo.services import frdr
+
+_pools = {}
+
+
+async def get_pool(db, user, password, server, port):
+    """Return the connection pool for a database, creating it on first use"""
+    key = (db, user, password, server, port)
+    if key not in _pools:
+        # Only needed, and so only installed, for the ASGI entry point
+        import asyncpg
+        _pools[key] = asyncio.ensure_future(asyncpg.create_pool(
+            database=db, user=user, password=password, host=server, port=port,
+            min_size=config.POSTGRES_POOL_MIN, max_size=config.POSTGRES_POOL_MAX,
+            statement_cache_size=100 if config.POSTGRES_PREPARED_STATEMENTS else 0,
+            server_settings={'default_transaction_read_only': 'on'}))
+    try:
+        return await _pools[key]
+    except Exception:
+        # Try again on the next call
+        _pools.pop(key, None)
+        raise
+
+
+async def close():
+    """Close every pooled connection"""
+    pools = list(_pools.values())
+    _pools.clear()
+    for pool in pools:
+        if pool.done() and not pool.exception():
+            await pool.result().close()
+
+
+async def fetch(pool, statement, params=None):
+    """The rows of a statement, on a connection borrowed for it
+
+    Statements are cancelled once the request's deadline runs out, raising
+    DeadlineExceeded.
+    """
+    deadline.check()
+    started = time.monotonic()
+    try:
+        async with pool.acquire() as con:
+            return await con.fetch(statement.numbered_sql, *(params or []), timeout=deadline.remaining())
+    except asyncio.TimeoutError:
+        deadline.check()
+        raise
+    finally:
+        # A load signal for admission control
+        admission.observe_backend('frdr', time.monotonic() - started)
+
+
+async def assemble_record(record, pool):
+    """Attach the child table values to a record row, looked up in one round trip"""
+    rows = await fetch(pool, frdr.CHILDREN_SQL, [record["record_uuid"]] * frdr.CHILDREN_SQL.parameter_count)
+    return frdr.attach_children(record, frdr.children_rows(rows[0]))
+
+
+async def assemble_records(records, pool):
+    """Attach the child table values to many record rows, with one concurrent query per child table"""
+    uuids = [str(record["record_uuid"]) for record in records]
+    results = await asyncio.gather(*[fetch(pool, batch_sql, [uuids])
+                                     for _, batch_sql in frdr.CHILD_LOOKUP_BATCH_SQL])
+    rows = {uuid: {} for uuid in uuids}
+    for (statement, _), batch_rows in zip(frdr.CHILD_LOOKUP_BATCH_SQL, results):
+        frdr.add_batch_rows(rows, statement, batch_rows)
+    return [frdr.attach_children(record, rows[str(record["record_uuid"])]) for record in records]
+
+
+async def get_metadata_list(
+        server,
+        db,
+        user,
+        password,
+        port,
+        query=None,
+        set=None,
+        from_datetime=None,
+        until_datetime=None,
+        cursor=None,
+        build=True,
+        page_size=None
+    ):
+    """Returns a page of metadata results, or with build False the assembled records"""
+    statement, params = frdr.records_list_query(set, from_datetime, until_datetime, cursor, page_size)
+    pool = await get_pool(db, user, password, server, port)
+    record_set = await fetch(pool, statement, params)
+
+    # full_count isn't returned for empty results
+    full_count = record_set[0]['full_count'] if record_set else 0
+    records = [dict(zip(frdr.RECORD_FIELDS, row)) for row in record_set]
+    if records:
+        records = await assemble_records(records, pool)
+    results = [frdr.build_metadata(record) for record in records] if build else records
+
+    return results, full_count, len(record_set) + int(cursor or 0)
+
+
+async def get_metadata(identifier, db, user, password, server, port):
+    """Return the parsed metadata of a record by OAI identifier, None when it is unknown"""
+    namespace, local_identifier = frdr.split_identifier(identifier)
+    pool = await get_pool(db, user, password, server, port)
+    rows = await fetch(pool, frdr.RECORD_SQL, [local_identifier, namespace])
+    if not rows:
+        return None
+    record = await assemble_record(dict(zip(frdr.RECORD_FIELDS, rows[0])), pool)
+    return frdr.build_metadata(record)
+
+
+async def get_metadata_batch(identifiers, db, user, password, server, port):
+    """Return the parsed metadata of many records by OAI identifier, leaving out unknown ones"""
+    wanted = {frdr.split_identifier(identifier): identifier for identifier in identifiers}
+    if not wanted:
+        return {}
+    namespaces = sorted({namespace for namespace, _ in wanted})
+    local_identifiers = sorted({local_identifier for _, local_identifier in wanted})
+
+    pool = await get_pool(db, user, password, server, port)
+    rows = await fetch(pool, frdr.RECORDS_BATCH_SQL, [local_identifiers, namespaces])
+    records = [dict(zip(frdr.RECORD_FIELDS, row)) for row in rows]
+    records = [record for record in records if (record['repo_oai_name'], record['local_identifier']) in wanted]
+    if records:
+        records = await assemble_records(records, pool)
+
+    return {wanted[(record['repo_oai_name'], record['local_identifier'])]: frdr.build_metadata(record)
+            for record in records}
+
+
+async def get_latest_change(db, user, password, server, port, set=None):
+    """Returns when a record of the set was last modified upstream, as a naive UTC datetime"""
+    statement, params = frdr.latest_change_query(set)
+    pool = await get_pool(db, user, password, server, port)
+    latest = (await fetch(pool, statement, params))[0][0]
+    if latest is None:
+        return None
+    return datetime.utcfromtimestamp(int(latest))
+
+
+async def get_sets(db, user, password, server, port):
+    """Returns the sets, the repositories and openaire_data for all of them"""
+    pool = await get_pool(db, user, password, server, port)
+    results = [['openaire_data', 'OpenAIRE']]
+    results.extend(list(row) for row in await fetch(pool, frdr.SETS_SQL))
+    return results, len(results)
@@ -0,0 +1,201 @@
+"""Pooled connections and prepared statements for the FRDR database
+
+Queries are defined once as Statements with bound %s parameters. On each
+pooled connection a statement is prepared server-side the first time it is
+used and executed by name afterwards, so Postgres plans it once per connection
+instead of once per request.
+
+Connections borrowed while handling a request with a deadline get a
+statement_timeout of the time it has left, see viringo.deadline.
+
+Once all POSTGRES_POOL_MAX connections of a worker are borrowed, further
+borrowers wait for one to be returned, for at most the time left of their
+deadline or POSTGRES_POOL_TIMEOUT_SECONDS. A borrower still waiting then gets
+BackendUnavailable, answered with a 503.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+
+from viringo import admission
+from viringo import circuit
+from viringo import config
+from viringo import deadline
+
+
+class PreparingConnection(psycopg2.extensions.connection):
+    """A connection that remembers which statements are prepared on it"""
+
+    def __init__(self, *args, **kwargs):
+        super(PreparingConnection, self).__init__(*args, **kwargs)
+        self.prepared = set()
+        # The statement_timeout in milliseconds set on the connection, None for the server default
+        self.statement_timeout = None
+
+
+class Statement:
+    """A named query with %s placeholders for its bound parameters"""
+
+    def __init__(self, name, sql):
+        self.name = name
+        self.sql = sql
+
+    @property
+    def parameter_count(self):
+        """Number of bound parameters"""
+        return self.sql.count('%s')
+
+    @property
+    def numbered_sql(self):
+        """The query with the placeholders numbered as Postgres expects"""
+        parts = self.sql.split('%s')
+        numbered = parts[0]
+        for number, part in enumerate(parts[1:], 1):
+            numbered += '$%d%s' % (number, part)
+        return numbered
+
+    def prepare_sql(self):
+        """The PREPARE statement"""
+        return 'PREPARE %s AS %s' % (self.name, self.numbered_sql)
+
+    def execute_sql(self):
+        """The EXECUTE statement for the prepared query"""
+        if not self.parameter_count:
+            return 'EXECUTE %s' % self.name
+        return 'EXECUTE %s (%s)' % (self.name, ', '.join(['%s'] * self.parameter_count))
+
+
+class PoolTimeout(psycopg2.pool.PoolError):
+    """No pooled connection was returned in time"""
+
+
+class WaitingConnectionPool(psycopg2.pool.ThreadedConnectionPool):
+    """A threaded pool whose borrowers wait for a free connection instead of failing"""
+
+    def __init__(self, minconn, maxconn, *args, **kwargs):
+        super(WaitingConnectionPool, self).__init__(minconn, maxconn, *args, **kwargs)
+        self.slots = threading.BoundedSemaphore(maxconn)
+
+    def getconn(self, key=None, timeout=None):
+        """Borrow a connection, waiting at most timeout seconds, None for as long as it takes"""
+        if not self.slots.acquire(timeout=timeout):
+            raise PoolTimeout('No connection was returned to the pool within %ss' % timeout)
+        try:
+            return super(WaitingConnectionPool, self).getconn(key)
+        except Exception:
+            self.slots.release()
+            raise
+
+    def putconn(self, conn=None, key=None, close=False):
+        """Return a borrowed connection"""
+        try:
+            super(WaitingConnectionPool, self).putconn(conn, key, close)
+        finally:
+            self.slots.release()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(db, user, password, server, port):
+    """Return the connection pool for a database, creating it on first use"""
+    key = (db, user, password, server, port)
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = WaitingConnectionPool(
+                    config.POSTGRES_POOL_MIN,
+                    config.POSTGRES_POOL_MAX,
+                    "dbname='%s' user='%s' password='%s' host='%s' port='%s'" % (
+                        db, user, password, server, port),
+                    connection_factory=PreparingConnection
+                )
+                _pools[key] = pool
+    return pool
+
+
+@contextmanager
+def connection(db, user, password, server, port):
+    """Borrow a read only autocommit connection from the pool"""
+    deadline.check()
+    remaining = deadline.remaining()
+    pool = get_pool(db, user, password, server, port)
+    try:
+        con = pool.getconn(timeout=deadline.timeout(config.POSTGRES_POOL_TIMEOUT_SECONDS))
+    except psycopg2.pool.PoolError as err:
+        deadline.check()
+        raise circuit.BackendUnavailable(
+            "No FRDR database connection free: %s" % err,
+            retry_after=max(1, int(config.POSTGRES_POOL_TIMEOUT_SECONDS)))
+    broken = False
+    try:
+        if not con.autocommit:
+            con.set_session(readonly=True, autocommit=True)
+        # Kept until the next borrower sets its own, saving a round trip to reset it
+        set_statement_timeout(con, remaining)
+        yield con
+    except psycopg2.extensions.QueryCanceledError:
+        # Cancelled by the statement_timeout of the request's deadline
+        broken = True
+        deadline.check()
+        raise
+    except psycopg2.Error:
+        # Don't hand a connection in an unknown state to the next request
+        broken = True
+        raise
+    finally:
+        pool.putconn(con, close=broken or con.closed != 0)
+
+
+def set_statement_timeout(con, seconds):
+    """Cancel statements running longer than seconds on the connection, None for the server default"""
+    # Zero would turn the timeout off rather than expire straight away
+    milliseconds = None if seconds is None else max(1, int(seconds * 1000))
+    if milliseconds is None and con.statement_timeout is None:
+        return
+    with con.cursor() as cursor:
+        if milliseconds is None:
+            cursor.execute('SET statement_timeout TO DEFAULT')
+        else:
+            cursor.execute('SET statement_timeout = %s', [milliseconds])
+    con.statement_timeout = milliseconds
+
+
+def execute(cursor, statement, params=None):
+    """Execute a statement, preparing it on the cursor's connection when enabled
+
+    Raises DeadlineExceeded instead once the request's deadline has run out.
+    """
+    deadline.check()
+    params = list(params or [])
+
+    started = time.monotonic()
+    try:
+        if not config.POSTGRES_PREPARED_STATEMENTS or not isinstance(cursor.connection, PreparingConnection):
+            cursor.execute(statement.sql, params)
+            return
+
+        con = cursor.connection
+        if statement.name not in con.prepared:
+            cursor.execute(statement.prepare_sql())
+            con.prepared.add(statement.name)
+        cursor.execute(statement.execute_sql(), params)
+    finally:
+        # A load signal for admission control
+        admission.observe_backend('frdr', time.monotonic() - started)
+
+
+def close_pools():
+    """Close every pooled connection, e.g. after forking"""
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.closeall()
+        _pools.clear()
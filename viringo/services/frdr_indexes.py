@@ -0,0 +1,254 @@
+"""Schema check and index advisor for the FRDR queries
+
+Checks the target database has the columns and indexes the access paths of
+viringo.services.frdr rely on, explains each generated query and produces
+the migration DDL for any missing index.
+"""
+
+import json
+from datetime import datetime, timedelta
+
+import psycopg2
+
+from viringo.services import frdr
+
+
+class IndexSpec:
+    """An index an FRDR access path needs"""
+
+    def __init__(self, table, columns, reason):
+        self.table = table
+        self.columns = columns
+        self.reason = reason
+
+    @property
+    def name(self):
+        """Name used for the index when it is created"""
+        return 'viringo_%s_%s_idx' % (self.table, '_'.join(self.columns))
+
+    def ddl(self):
+        """Migration statement creating the index without blocking writes"""
+        return 'CREATE INDEX CONCURRENTLY IF NOT EXISTS %s ON %s (%s);' % (
+            self.name, self.table, ', '.join(self.columns))
+
+    def satisfied_by(self, index_columns):
+        """Whether an existing index with these columns can serve this access path"""
+        return list(index_columns[:len(self.columns)]) == list(self.columns)
+
+
+# Columns read or filtered on by the FRDR queries
+REQUIRED_COLUMNS = {
+    'records': ['record_uuid', 'repository_id', 'title', 'title_fr', 'pub_date', 'series',
+                'source_url', 'item_url', 'deleted', 'local_identifier', 'modified_timestamp',
+                'upstream_modified_timestamp'],
+    'repositories': ['repository_id', 'repository_url', 'repository_name', 'repository_thumbnail',
+                     'item_url_pattern', 'last_crawl_timestamp', 'homepage_url', 'repo_oai_name'],
+    'geobbox': ['record_uuid', 'westlon', 'eastlon', 'northlat', 'southlat'],
+    'geopoint': ['record_uuid', 'lat', 'lon'],
+    'geoplace': ['record_uuid', 'country', 'province_state', 'city', 'other', 'place_name'],
+    'creators': ['creator_id', 'creator'],
+    'records_x_creators': ['records_x_creators_id', 'record_uuid', 'creator_id', 'is_contributor'],
+    'affiliations': ['affiliation_id', 'affiliation'],
+    'records_x_affiliations': ['record_uuid', 'affiliation_id'],
+    'subjects': ['subject_id', 'subject', 'language'],
+    'records_x_subjects': ['record_uuid', 'subject_id'],
+    'publishers': ['publisher_id', 'publisher'],
+    'records_x_publishers': ['record_uuid', 'publisher_id'],
+    'rights': ['rights_id', 'rights'],
+    'records_x_rights': ['record_uuid', 'rights_id'],
+    'descriptions': ['record_uuid', 'description', 'language'],
+    'tags': ['tag_id', 'tag', 'language'],
+    'records_x_tags': ['record_uuid', 'tag_id'],
+    'access': ['access_id', 'access'],
+    'records_x_access': ['record_uuid', 'access_id'],
+}
+
+# Indexes the access paths need, primary keys included
+REQUIRED_INDEXES = [
+    IndexSpec('records', ['record_uuid'], 'ListRecords ordering and child lookups'),
+    IndexSpec('records', ['repository_id', 'record_uuid'], 'ListRecords for a set in record order'),
+    IndexSpec('records', ['upstream_modified_timestamp'], 'ListRecords from/until windows'),
+    IndexSpec('records', ['repository_id', 'upstream_modified_timestamp'],
+              'from/until windows and the latest change within a set'),
+    IndexSpec('records', ['local_identifier'], 'GetRecord by identifier'),
+    IndexSpec('repositories', ['repository_id'], 'records to repositories join'),
+    IndexSpec('repositories', ['repo_oai_name'], 'set and GetRecord namespace lookups'),
+    IndexSpec('geobbox', ['record_uuid'], 'geoLocationBox lookup'),
+    IndexSpec('geopoint', ['record_uuid'], 'geoLocationPoint lookup'),
+    IndexSpec('geoplace', ['record_uuid'], 'geoLocationPlace lookup'),
+    IndexSpec('records_x_creators', ['record_uuid'], 'creator and contributor lookups'),
+    IndexSpec('records_x_affiliations', ['record_uuid'], 'affiliation lookup'),
+    IndexSpec('records_x_subjects', ['record_uuid'], 'subject lookups'),
+    IndexSpec('records_x_publishers', ['record_uuid'], 'publisher lookup'),
+    IndexSpec('records_x_rights', ['record_uuid'], 'rights lookup'),
+    IndexSpec('records_x_tags', ['record_uuid'], 'keyword lookups'),
+    IndexSpec('records_x_access', ['record_uuid'], 'access lookup'),
+    IndexSpec('descriptions', ['record_uuid'], 'description lookups'),
+    IndexSpec('creators', ['creator_id'], 'creator join'),
+    IndexSpec('affiliations', ['affiliation_id'], 'affiliation join'),
+    IndexSpec('subjects', ['subject_id'], 'subject join'),
+    IndexSpec('publishers', ['publisher_id'], 'publisher join'),
+    IndexSpec('rights', ['rights_id'], 'rights join'),
+    IndexSpec('tags', ['tag_id'], 'tag join'),
+    IndexSpec('access', ['access_id'], 'access join'),
+]
+
+EXISTING_INDEXES_SQL = """SELECT t.relname, i.relname, array_agg(a.attname::text ORDER BY k.ord)
+    FROM pg_index ix
+    JOIN pg_class t ON t.oid = ix.indrelid
+    JOIN pg_class i ON i.oid = ix.indexrelid
+    JOIN pg_namespace n ON n.oid = t.relnamespace
+    CROSS JOIN LATERAL unnest(ix.indkey) WITH ORDINALITY AS k(attnum, ord)
+    JOIN pg_attribute a ON a.attrelid = t.oid AND a.attnum = k.attnum
+    WHERE n.nspname = current_schema() AND ix.indisvalid AND ix.indpred IS NULL
+    GROUP BY t.relname, i.relname"""
+
+EXISTING_COLUMNS_SQL = """SELECT table_name, column_name FROM information_schema.columns
+    WHERE table_schema = current_schema()"""
+
+
+def connect(db, user, password, server, port):
+    """Connect to the FRDR database"""
+    return psycopg2.connect("dbname='%s' user='%s' password='%s' host='%s' port='%s'" % (
+        db, user, password, server, port))
+
+
+def existing_indexes(con):
+    """Map of table name to the column lists of its usable indexes"""
+    indexes = {}
+    with con.cursor() as cursor:
+        cursor.execute(EXISTING_INDEXES_SQL)
+        for table, _, columns in cursor.fetchall():
+            indexes.setdefault(table, []).append(columns)
+    return indexes
+
+
+def missing_columns(con):
+    """Required table columns that are not present in the database"""
+    present = set()
+    with con.cursor() as cursor:
+        cursor.execute(EXISTING_COLUMNS_SQL)
+        present = set(cursor.fetchall())
+
+    return [
+        (table, column)
+        for table, columns in REQUIRED_COLUMNS.items()
+        for column in columns
+        if (table, column) not in present
+    ]
+
+
+def missing_indexes(indexes):
+    """Required indexes not served by any of the existing indexes"""
+    return [
+        spec for spec in REQUIRED_INDEXES
+        if not any(spec.satisfied_by(columns) for columns in indexes.get(spec.table, []))
+    ]
+
+
+def migration_ddl(specs):
+    """Migration script creating the given indexes"""
+    lines = [
+        '-- Indexes required by the viringo FRDR queries',
+        '-- CREATE INDEX CONCURRENTLY cannot run inside a transaction block',
+    ]
+    for spec in specs:
+        lines.append('-- %s' % spec.reason)
+        lines.append(spec.ddl())
+    lines.append('ANALYZE;')
+    return '\n'.join(lines) + '\n'
+
+
+def sample_values(con):
+    """Real values from the database to explain the queries with"""
+    with con.cursor() as cursor:
+        cursor.execute("""SELECT recs.record_uuid, recs.local_identifier, repos.repo_oai_name
+            FROM records recs, repositories repos WHERE recs.repository_id = repos.repository_id
+            AND """ + frdr.VALID_RECORD_SQL + """ LIMIT 1""")
+        row = cursor.fetchone()
+        cursor.execute("SELECT max(upstream_modified_timestamp) FROM records")
+        latest = cursor.fetchone()[0]
+
+    if not row:
+        return None
+
+    until_datetime = datetime.utcfromtimestamp(latest or 0)
+    return {
+        'record_uuid': row[0],
+        'local_identifier': row[1],
+        'set': row[2],
+        'from_datetime': until_datetime - timedelta(days=30),
+        'until_datetime': until_datetime,
+    }
+
+
+def generated_queries(sample):
+    """The queries the FRDR service generates, with the parameters to explain them with"""
+    queries = [
+        ('ListRecords', frdr.records_list_query()),
+        ('ListRecords deep page', frdr.records_list_query(cursor='10000')),
+        ('ListRecords set', frdr.records_list_query(set=sample['set'])),
+        ('ListRecords from/until', frdr.records_list_query(
+            from_datetime=sample['from_datetime'], until_datetime=sample['until_datetime'])),
+        ('Latest change in set', frdr.latest_change_query(set=sample['set'])),
+        ('GetRecord', (frdr.RECORD_SQL, [sample['local_identifier'], sample['set']])),
+        ('ListSets', (frdr.SETS_SQL, [])),
+        ('geobbox', (frdr.GEOBBOX_SQL, [sample['record_uuid']])),
+        ('geopoint', (frdr.GEOPOINT_SQL, [sample['record_uuid']])),
+        ('geoplace', (frdr.GEOPLACE_SQL, [sample['record_uuid']])),
+    ]
+    queries.extend(
+        (field, (child_sql, [sample['record_uuid']])) for field, child_sql in frdr.CHILD_TABLE_SQL
+    )
+    return [(name, statement.sql, params) for name, (statement, params) in queries]
+
+
+def explain(con, sql, params):
+    """Run EXPLAIN (ANALYZE, BUFFERS) for a query and return the JSON plan"""
+    with con.cursor() as cursor:
+        cursor.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + sql, params)
+        plan = cursor.fetchone()[0]
+    con.rollback()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]
+
+
+def sequential_scans(node):
+    """Relations read with a sequential scan anywhere in a plan node tree"""
+    scans = []
+    if node.get('Node Type') == 'Seq Scan':
+        scans.append(node.get('Relation Name'))
+    for child in node.get('Plans', []):
+        scans.extend(sequential_scans(child))
+    return scans
+
+
+def format_plan(node, depth=0):
+    """Compact text rendering of a JSON plan tree"""
+    description = node['Node Type']
+    if node.get('Index Name'):
+        description += ' using %s' % node['Index Name']
+    if node.get('Relation Name'):
+        description += ' on %s' % node['Relation Name']
+    lines = ['%s-> %s (actual %.3f..%.3f ms rows=%s loops=%s, buffers hit=%s read=%s)' % (
+        '  ' * depth, description,
+        node.get('Actual Startup Time', 0), node.get('Actual Total Time', 0),
+        node.get('Actual Rows'), node.get('Actual Loops'),
+        node.get('Shared Hit Blocks', 0), node.get('Shared Read Blocks', 0))]
+    for child in node.get('Plans', []):
+        lines.extend(format_plan(child, depth + 1))
+    return lines
+
+
+def explain_report(con, sample, small_tables=('repositories', 'access', 'rights')):
+    """Explain every generated query and flag plans not driven by indexes"""
+    lines = []
+    for name, sql, params in generated_queries(sample):
+        plan = explain(con, sql, params)
+        scans = [table for table in sequential_scans(plan['Plan']) if table not in small_tables]
+        lines.append('%s: planning %.3f ms, execution %.3f ms, %s' % (
+            name, plan.get('Planning Time', 0), plan.get('Execution Time', 0),
+            'sequential scan of %s' % ', '.join(scans) if scans else 'index driven'))
+        lines.extend('  ' + line for line in format_plan(plan['Plan']))
+    return '\n'.join(lines)
@@ -0,0 +1,230 @@
+"""Invalidate cached FRDR results when the harvester changes the database
+
+Triggers on the FRDR tables (see trigger_ddl) send a notification on
+FRDR_NOTIFY_CHANNEL for every changed row, with the set and local identifier of
+the record concerned. A Listener, either in each worker (FRDR_CACHE_LISTEN) or
+run once per host with `flask frdr-cache-listener` when the cache backend is
+shared, drops exactly the cached entries the change affects:
+
+* a record: its GetRecord entry, the pages of its set and of all sets, and the
+  incremental watermarks of both;
+* a repository: the sets, and everything cached for the repository's records;
+* a shared value such as a subject or creator: every FRDR entry.
+
+Notifications sent while no listener was connected are lost, so everything is
+dropped whenever the listener (re)connects. The listener also reconnects when
+the cache store can't be reached, as the changes it was applying are lost too.
+"""
+
+import json
+import logging
+import os
+import select
+import threading
+
+import psycopg2
+import psycopg2.extensions
+from psycopg2 import sql
+
+from viringo import cache
+from viringo import cache_stores
+from viringo import config
+from viringo import incremental
+from viringo.services import frdr
+
+# Tables whose rows belong to a single record through record_uuid
+RECORD_CHILD_TABLES = [
+    'geobbox', 'geopoint', 'geoplace', 'descriptions', 'records_x_creators',
+    'records_x_affiliations', 'records_x_subjects', 'records_x_publishers',
+    'records_x_rights', 'records_x_tags', 'records_x_access'
+]
+# Tables of values shared between many records
+SHARED_VALUE_TABLES = ['creators', 'affiliations', 'subjects', 'publishers', 'rights', 'tags', 'access']
+
+TRIGGER_DDL = """CREATE OR REPLACE FUNCTION viringo_notify_record(rec_repository_id integer, rec_local_identifier text)
+RETURNS void AS $$
+BEGIN
+    PERFORM pg_notify({channel}, json_build_object(
+        'table', 'records',
+        'set', (SELECT repo_oai_name FROM repositories WHERE repository_id = rec_repository_id),
+        'local_identifier', rec_local_identifier)::text);
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION viringo_records_changed() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP <> 'INSERT' THEN
+        PERFORM viringo_notify_record(OLD.repository_id, OLD.local_identifier);
+    END IF;
+    IF TG_OP <> 'DELETE' THEN
+        PERFORM viringo_notify_record(NEW.repository_id, NEW.local_identifier);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION viringo_record_child_changed() RETURNS trigger AS $$
+DECLARE
+    changed_uuid uuid;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        changed_uuid := OLD.record_uuid;
+    ELSE
+        changed_uuid := NEW.record_uuid;
+    END IF;
+    PERFORM viringo_notify_record(recs.repository_id, recs.local_identifier)
+        FROM records recs WHERE recs.record_uuid = changed_uuid;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION viringo_repositories_changed() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP <> 'INSERT' THEN
+        PERFORM pg_notify({channel}, json_build_object('table', 'repositories', 'set', OLD.repo_oai_name)::text);
+    END IF;
+    IF TG_OP <> 'DELETE' THEN
+        PERFORM pg_notify({channel}, json_build_object('table', 'repositories', 'set', NEW.repo_oai_name)::text);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION viringo_shared_value_changed() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify({channel}, json_build_object('table', TG_TABLE_NAME)::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+TRIGGER_SQL = """DROP TRIGGER IF EXISTS viringo_notify ON {table};
+CREATE TRIGGER viringo_notify AFTER INSERT OR UPDATE OR DELETE ON {table}
+    FOR EACH ROW EXECUTE PROCEDURE {function}();
+"""
+
+
+def trigger_ddl(channel=None):
+    """The functions and triggers that notify the channel of FRDR changes"""
+    channel = channel or config.FRDR_NOTIFY_CHANNEL
+    ddl = [TRIGGER_DDL.replace('{channel}', "'%s'" % channel.replace("'", "''"))]
+    triggers = [('records', 'viringo_records_changed'), ('repositories', 'viringo_repositories_changed')]
+    triggers.extend((table, 'viringo_record_child_changed') for table in RECORD_CHILD_TABLES)
+    triggers.extend((table, 'viringo_shared_value_changed') for table in SHARED_VALUE_TABLES)
+    for table, function in triggers:
+        ddl.append(TRIGGER_SQL.format(table=table, function=function))
+    return '\n'.join(ddl)
+
+
+def invalidate_all():
+    """Drop every cached FRDR result and watermark"""
+    for name in ['frdr.get_metadata', 'frdr.get_metadata_list', 'frdr.get_sets']:
+        cache.invalidate(name)
+    incremental.WATERMARKS.clear()
+
+
+def forget_set(set_name):
+    """Drop the cached pages and watermarks a change to a set affects"""
+    for partition in [set_name, frdr.ALL_SETS]:
+        cache.invalidate('frdr.get_metadata_list', partition)
+        incremental.WATERMARKS.forget(('FRDR', partition))
+    incremental.WATERMARKS.forget(('FRDR', None))
+
+
+def invalidate(payloads):
+    """Drop the cached results affected by a batch of notification payloads"""
+    changes = set()
+    for payload in payloads:
+        try:
+            change = json.loads(payload)
+        except ValueError:
+            logging.warning("Unreadable FRDR change notification %r", payload)
+            changes.add(('everything', None, None))
+            continue
+        changes.add((change.get('table'), change.get('set'), change.get('local_identifier')))
+
+    if any(table not in ('records', 'repositories') for table, _, _ in changes):
+        invalidate_all()
+        return
+
+    for set_name in {set_name for _, set_name, _ in changes if set_name}:
+        forget_set(set_name)
+    for table, set_name, local_identifier in changes:
+        if table == 'records' and set_name and local_identifier:
+            cache.invalidate('frdr.get_metadata', 'oai:%s:%s' % (set_name, local_identifier))
+    if any(table == 'repositories' for table, _, _ in changes):
+        # Identifiers of a renamed repository's records change, records aren't cached by set
+        cache.invalidate('frdr.get_sets')
+        cache.invalidate('frdr.get_metadata')
+
+
+class Listener(threading.Thread):
+    """Listens for FRDR change notifications and invalidates the cache, reconnecting when dropped"""
+
+    def __init__(self, db, user, password, server, port, channel=None, poll_seconds=5, retry_seconds=5):
+        super(Listener, self).__init__(name='viringo-frdr-listener', daemon=True)
+        self.dsn = "dbname='%s' user='%s' password='%s' host='%s' port='%s'" % (
+            db, user, password, server, port)
+        self.channel = channel or config.FRDR_NOTIFY_CHANNEL
+        self.poll_seconds = poll_seconds
+        self.retry_seconds = retry_seconds
+        self.counters = {'connects': 0, 'notifications': 0, 'batches': 0}
+        self._stopping = threading.Event()
+
+    def stop(self):
+        """Stop listening after the current wait"""
+        self._stopping.set()
+
+    def run(self):
+        while not self._stopping.is_set():
+            try:
+                self.listen()
+            except (psycopg2.Error, OSError, cache_stores.StoreError):
+                logging.warning("FRDR change listener disconnected, retrying", exc_info=True)
+                self._stopping.wait(self.retry_seconds)
+
+    def listen(self):
+        """Listen on one connection until it drops or the listener is stopped"""
+        con = psycopg2.connect(self.dsn)
+        try:
+            con.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            with con.cursor() as cursor:
+                cursor.execute(sql.SQL('LISTEN {}').format(sql.Identifier(self.channel)))
+            self.counters['connects'] += 1
+            # Changes made while nobody was listening went unnoticed
+            invalidate_all()
+
+            while not self._stopping.is_set():
+                if select.select([con], [], [], self.poll_seconds) == ([], [], []):
+                    continue
+                con.poll()
+                self.apply(con)
+        finally:
+            con.close()
+
+    def apply(self, con):
+        """Invalidate for the notifications received so far, one batch at a time"""
+        payloads = [notify.payload for notify in con.notifies]
+        del con.notifies[:]
+        if payloads:
+            self.counters['notifications'] += len(payloads)
+            self.counters['batches'] += 1
+            invalidate(payloads)
+
+
+_listener = None
+_listener_pid = None
+_listener_lock = threading.Lock()
+
+
+def start_listener():
+    """Start this process's listener, once per process"""
+    global _listener, _listener_pid
+    with _listener_lock:
+        if _listener is None or _listener_pid != os.getpid():
+            _listener = Listener(
+                config.POSTGRES_DB, config.POSTGRES_USER, config.POSTGRES_PASSWORD,
+                config.POSTGRES_SERVER, config.POSTGRES_PORT)
+            _listener_pid = os.getpid()
+            _listener.start()
+        return _listener
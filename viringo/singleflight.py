@@ -0,0 +1,115 @@
+"""Coalesce identical concurrent backend fetches
+
+Harvesters often ask for the same first page of a set, or the same record, at
+the same moment. Service functions decorated with coalesce make concurrent
+callers with the same arguments wait for the one fetch already in flight and
+share its result, instead of each sending the backend the same request.
+Results are shared between callers so they must not be modified.
+"""
+
+import functools
+import threading
+from collections import defaultdict
+
+from viringo import config
+from viringo import deadline
+
+
+class _Call:
+    """A fetch in flight that other callers can wait on"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Runs at most one call per key at a time, sharing its outcome with concurrent callers"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._counters = defaultdict(lambda: {'calls': 0, 'fetches': 0, 'coalesced': 0})
+
+    def do(self, name, key, func, *args, **kwargs):
+        """Call func, or wait for the call already in flight for the same key
+
+        A caller whose leader ran out of its own deadline fetches again with
+        the time it has left, rather than failing with the leader's error.
+        """
+        with self._lock:
+            self._counters[name]['calls'] += 1
+
+        while True:
+            with self._lock:
+                counters = self._counters[name]
+                call = self._calls.get(key)
+                leader = call is None
+                if leader:
+                    call = self._calls[key] = _Call()
+                    counters['fetches'] += 1
+                else:
+                    counters['coalesced'] += 1
+
+            if leader:
+                break
+
+            # Wait no longer than the request has left, see viringo.deadline
+            while not call.done.wait(deadline.remaining()):
+                deadline.check()
+            if isinstance(call.error, deadline.DeadlineExceeded):
+                deadline.check()
+                continue
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+            return call.result
+        except Exception as err:
+            call.error = err
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self):
+        """Counters of calls, backend fetches and coalesced calls per function"""
+        with self._lock:
+            return {name: dict(counters) for name, counters in self._counters.items()}
+
+    def reset(self):
+        """Zero the counters"""
+        with self._lock:
+            self._counters.clear()
+
+
+GROUP = SingleFlight()
+
+
+def coalesce(func):
+    """Decorate a service function so identical concurrent calls share one fetch"""
+    name = '%s.%s' % (func.__module__.rsplit('.', 1)[-1], func.__name__)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not config.SINGLEFLIGHT_ENABLED:
+            return func(*args, **kwargs)
+
+        key = (name, args, tuple(sorted(kwargs.items())))
+        try:
+            hash(key)
+        except TypeError:
+            # Arguments that can't be compared are never coalesced
+            return func(*args, **kwargs)
+        return GROUP.do(name, key, func, *args, **kwargs)
+
+    return wrapper
+
+
+def stats():
+    """Counters of the coalesced service functions"""
+    return GROUP.stats()
@@ -0,0 +1,244 @@
+"""Pre-rendered snapshots of full ListRecords harvests
+
+`FLASK_APP=viringo flask snapshot-export` walks the catalogue for every
+metadata prefix, and optionally every set, in parallel processes. It writes each
+ListRecords page gzipped to SNAPSHOT_DIR/<snapshot id>/ with a manifest, and
+then points SNAPSHOT_DIR/current.json at the new snapshot. A ListRecords
+request without from, until or resumptionToken whose prefix and set are in the
+current snapshot is answered with its first page. The resumption tokens in
+the pages lead to the following pages. Pages are sent as files, so the WSGI
+server can use sendfile, and gzipped to clients that accept it.
+
+The pages keep the responseDate of the export, which is what a harvester
+should use as the from of its next incremental harvest. SNAPSHOT_KEEP
+snapshots are kept so harvests that are under way can finish.
+"""
+
+import gzip
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from urllib.parse import quote
+
+from flask import Response, request, send_file
+from lxml.etree import SubElement
+
+from viringo import config
+from viringo import metadata
+
+TOKEN_PREFIX = 'snapshot:'
+CURRENT = 'current.json'
+# Directory name of the partition of all records
+ALL_RECORDS = '_all'
+
+
+def partition_name(set_spec):
+    """Directory name of a set's partition"""
+    return quote(set_spec, safe='') if set_spec else ALL_RECORDS
+
+
+def page_path(snapshot_id, metadata_prefix, set_spec, page):
+    """Path of a page relative to SNAPSHOT_DIR"""
+    return '%s/%s/%s/%d.xml.gz' % (snapshot_id, metadata_prefix, partition_name(set_spec), page)
+
+
+def page_token(snapshot_id, metadata_prefix, set_spec, page):
+    """The resumption token leading to a page"""
+    return TOKEN_PREFIX + page_path(snapshot_id, metadata_prefix, set_spec, page)[:-len('.xml.gz')]
+
+
+def render_page(tree_server, records, metadata_prefix, set_spec, token, total):
+    """A ListRecords response as the live path would render it"""
+    # Deferred as viringo.oai imports this module
+    from viringo import oai
+
+    request_kw = {'metadataPrefix': metadata_prefix}
+    if set_spec:
+        request_kw['set'] = set_spec
+    envelope, e_list_records = tree_server._outputEnvelope(verb='ListRecords', **request_kw)
+    tree_server.outputRecords(e_list_records, records, metadata_prefix)
+    if token is not None:
+        e_resumption_token = SubElement(e_list_records, '{%s}%s' % (metadata.NS_OAIPMH, 'resumptionToken'))
+        e_resumption_token.text = token
+        e_resumption_token.set('completeListSize', str(total))
+    return oai.add_stylesheet(tree_server.serialize(envelope))
+
+
+def export_partition(snapshot_dir, snapshot_id, metadata_prefix, set_spec):
+    """Write the pages of one prefix and set, returning its manifest entry or None when it is empty"""
+    from viringo import oai
+
+    catalog = oai.get_catalog_server()
+    tree_server = oai.XMLTreeServer(catalog, metadata.metadata_registry())
+    directory = os.path.join(snapshot_dir, snapshot_id, metadata_prefix, partition_name(set_spec))
+    os.makedirs(directory, exist_ok=True)
+
+    page = 0
+    records_written = 0
+    paging_cursor = None
+    while True:
+        records, total, paging_cursor = catalog.listRecords(
+            metadataPrefix=metadata_prefix, set=set_spec, paging_cursor=paging_cursor)
+        if page == 0 and not records:
+            shutil.rmtree(directory)
+            return None
+
+        if paging_cursor:
+            token = page_token(snapshot_id, metadata_prefix, set_spec, page + 1)
+        else:
+            # The last page of a resumed list has an empty token
+            token = '' if page else None
+        xml = render_page(tree_server, records, metadata_prefix, set_spec, token, total)
+        with gzip.open(os.path.join(directory, '%d.xml.gz' % page), 'wb', compresslevel=6) as output:
+            output.write(xml)
+
+        records_written += len(records)
+        page += 1
+        if not paging_cursor:
+            break
+
+    return {'metadataPrefix': metadata_prefix, 'set': set_spec, 'pages': page, 'records': records_written}
+
+
+def catalog_sets():
+    """The setSpec of every set of the catalogue"""
+    from viringo import oai
+
+    catalog = oai.get_catalog_server()
+    sets = []
+    paging_cursor = 0
+    while paging_cursor is not None:
+        results, _, paging_cursor = catalog.listSets(paging_cursor=paging_cursor)
+        sets.extend(set_spec for set_spec, _, _ in results)
+    return sets
+
+
+def export(snapshot_dir=None, metadata_prefixes=None, sets=None, workers=None):
+    """Export a snapshot of every prefix and set given, None standing for all records
+
+    Partitions are exported by parallel processes, or in this process with no
+    workers, and the snapshot becomes current once all of them are written.
+    Returns its manifest.
+    """
+    from viringo import oai
+
+    snapshot_dir = snapshot_dir or config.SNAPSHOT_DIR
+    if not metadata_prefixes:
+        metadata_prefixes = [prefix for prefix, _, _ in oai.get_catalog_server().listMetadataFormats()]
+    sets = sets or [None]
+    snapshot_id = datetime.utcnow().strftime('%Y%m%dT%H%M%S')
+
+    os.makedirs(snapshot_dir, exist_ok=True)
+    jobs = [(snapshot_dir, snapshot_id, prefix, set_spec) for prefix in metadata_prefixes for set_spec in sets]
+    workers = config.SNAPSHOT_WORKERS if workers is None else workers
+    if workers > 0:
+        # spawn, as forking a process with open backend connections and threads is unsafe
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+            futures = [pool.submit(export_partition, *job) for job in jobs]
+            partitions = [future.result() for future in futures]
+    else:
+        partitions = [export_partition(*job) for job in jobs]
+
+    manifest = {
+        'snapshot': snapshot_id,
+        'catalog': config.CATALOG_SET,
+        'created': snapshot_id,
+        'partitions': [partition for partition in partitions if partition is not None],
+    }
+    write_json(os.path.join(snapshot_dir, snapshot_id, 'manifest.json'), manifest)
+    write_json(os.path.join(snapshot_dir, CURRENT), {'snapshot': snapshot_id})
+    prune(snapshot_dir)
+    return manifest
+
+
+def write_json(path, value):
+    """Write a json file atomically, so readers never see half of it"""
+    with open(path + '.tmp', 'w') as output:
+        json.dump(value, output)
+    os.replace(path + '.tmp', path)
+
+
+def prune(snapshot_dir):
+    """Remove all but the SNAPSHOT_KEEP newest snapshots"""
+    snapshots = sorted(name for name in os.listdir(snapshot_dir)
+                       if os.path.isfile(os.path.join(snapshot_dir, name, 'manifest.json')))
+    for name in snapshots[:-max(1, config.SNAPSHOT_KEEP)]:
+        shutil.rmtree(os.path.join(snapshot_dir, name), ignore_errors=True)
+
+
+_current = {'mtime': None, 'manifest': None}
+_current_lock = threading.Lock()
+
+
+def current_manifest():
+    """The manifest of the current snapshot, re-read when current.json changes"""
+    path = os.path.join(config.SNAPSHOT_DIR, CURRENT)
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return None
+    with _current_lock:
+        if _current['mtime'] != mtime:
+            try:
+                with open(path) as current:
+                    snapshot_id = json.load(current)['snapshot']
+                with open(os.path.join(config.SNAPSHOT_DIR, snapshot_id, 'manifest.json')) as manifest:
+                    _current['manifest'] = json.load(manifest)
+            except (OSError, ValueError, KeyError):
+                logging.warning("Unreadable snapshot manifest", exc_info=True)
+                _current['manifest'] = None
+            _current['mtime'] = mtime
+        return _current['manifest']
+
+
+def page_for_request(request_args):
+    """Path of the snapshot page answering a request, or None when it isn't answered from a snapshot"""
+    if not config.SNAPSHOT_DIR or request_args.get('verb') != 'ListRecords':
+        return None
+
+    token = request_args.get('resumptionToken')
+    if token is not None:
+        if not token.startswith(TOKEN_PREFIX):
+            return None
+        relative = token[len(TOKEN_PREFIX):] + '.xml.gz'
+        # Only pages of snapshots, never anything else under the directory
+        if '..' in relative.split('/') or relative.startswith('/'):
+            return None
+        path = os.path.join(config.SNAPSHOT_DIR, relative)
+        return path if os.path.isfile(path) else None
+
+    if 'from' in request_args or 'until' in request_args:
+        return None
+    manifest = current_manifest()
+    if manifest is None:
+        return None
+    for partition in manifest['partitions']:
+        if (partition['metadataPrefix'] == request_args.get('metadataPrefix')
+                and partition['set'] == request_args.get('set')):
+            return os.path.join(config.SNAPSHOT_DIR, page_path(
+                manifest['snapshot'], partition['metadataPrefix'], partition['set'], 0))
+    return None
+
+
+def send_page(path):
+    """Send a gzipped page as is to clients that accept gzip, and decompressed to others"""
+    if 'gzip' in request.headers.get('Accept-Encoding', ''):
+        response = send_file(path, mimetype='application/xml', conditional=True)
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        def decompressed():
+            with gzip.open(path, 'rb') as page:
+                while True:
+                    chunk = page.read(64 * 1024)
+                    if not chunk:
+                        break
+                    yield chunk
+        response = Response(decompressed(), mimetype='application/xml')
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response